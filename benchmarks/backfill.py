@@ -0,0 +1,167 @@
+"""Rebuild of the knowledge base from a school year of archived emails, replayed against the backfill.
+
+--weeks archived emails carry one newsletter each, the first and the one of --handbook-week also
+a handbook. Textract takes --textract-seconds per job and the model --model-ms per newsletter.
+
+  replay    every archived email sent through email-handler.lambda_handler again, in date order,
+            each extracting its attachments and requesting an ingestion
+  backfill  email-handler.lambda_handler({'backfill': {}}) in one invocation
+  resumed   the same with --budget-seconds per invocation, invoked again until it completes
+
+The report gives the invocations, the time, the Textract jobs, model calls and ingestion jobs.
+All modes must leave the same section documents and newsletter store.
+
+    python benchmarks/backfill.py --weeks 36 --handbook-week 18 --textract-seconds 0.5
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import re
+import sys
+import time
+from email.message import EmailMessage
+
+import boto3
+
+from fakes import FakeBedrockAgent, FakeBedrockRuntime, FakeS3, FakeSqs, FakeTextract
+from replay import ENVIRONMENT, load_lambda
+
+FIRST_WEEK = datetime.date(2025, 8, 25)
+EVENTS = ['Report card pickup', 'Basketball tryouts', 'Parent workshop', 'Picture day retakes', 'Science fair',
+          'Band concert', 'Open house', 'College night', 'Food drive', 'Spirit week']
+HANDBOOK_PAGES = [
+    "ATTENDANCE\n" + "Students are expected at school by 8:00 AM every day. " * 12,
+    "DRESS CODE\n" + "Uniform shirts are worn every day, hoodies are not allowed in class. " * 10,
+    "GRADING\n" + "Report cards are issued at the end of every quarter. " * 12,
+]
+
+
+class Context:
+    """Lambda context whose invocation ends budget_seconds after it was created."""
+
+    def __init__(self, budget_seconds):
+        self.deadline = time.monotonic() + budget_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def build_email(message_id, week, attachments):
+    message = EmailMessage()
+    message['Subject'] = f"Pencil It In week {week}"
+    message['From'] = 'office@kelvynpark.example'
+    message['To'] = 'assistant@kelvynpark.example'
+    message['Date'] = f"{(FIRST_WEEK + datetime.timedelta(weeks=week)).strftime('%a, %d %b %Y')} 10:00:00 -0500"
+    message['Message-ID'] = f"<{message_id}@kelvynpark.example>"
+    message.set_content("Please find the latest documents attached.")
+    for file_name in attachments:
+        content = b"%PDF-1.7\n" + f"{message_id} {file_name}".encode('utf-8')
+        message.add_attachment(content, maintype='application', subtype='pdf', filename=file_name)
+    return message.as_bytes()
+
+
+def textract_pages(location):
+    """Page texts of the uploaded PDF, a newsletter issue carries the date of its week."""
+    key = location['S3Object']['Name']
+    if key.startswith('handbooks/'):
+        return HANDBOOK_PAGES
+    week = int(re.search(r'week-(\d+)', key).group(1))
+    return [f"Pencil It In!\nWeek of {(FIRST_WEEK + datetime.timedelta(weeks=week)).isoformat()}\n"
+            f"{EVENTS[week % len(EVENTS)]} and {EVENTS[(week + 3) % len(EVENTS)]} this week.\n"]
+
+
+def extracted_items(body):
+    """Model output for a newsletter issue: two events dated later in the issue's week."""
+    prompt = json.loads(body)['messages'][0]['content'][0]['text']
+    day = datetime.date.fromisoformat(re.search(r'Week of (\d{4}-\d{2}-\d{2})', prompt).group(1))
+    week = (day - FIRST_WEEK).days // 7
+    return json.dumps({'items': [
+        {'category': 'event', 'title': EVENTS[(week + offset) % len(EVENTS)], 'details': f"Week {week}.",
+         'dates': [(day + datetime.timedelta(days=4)).isoformat()]}
+        for offset in (0, 3)
+    ]})
+
+
+def outputs(s3):
+    documents = sorted(key for bucket, key in s3.objects
+                       if bucket == ENVIRONMENT['DESTINATION_BUCKET_NAME'] and key.startswith('documents/'))
+    store = json.loads(s3.objects[(ENVIRONMENT['STATE_BUCKET_NAME'], 'newsletter/store.json')])
+    return documents, sorted(store['items'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weeks', type=int, default=36, help='archived emails, one newsletter each')
+    parser.add_argument('--handbook-week', type=int, default=18, help='week of the second handbook')
+    parser.add_argument('--textract-seconds', type=float, default=0.5)
+    parser.add_argument('--model-ms', type=float, default=300.0)
+    parser.add_argument('--workers', type=int, default=8, help='BACKFILL_WORKERS')
+    parser.add_argument('--budget-seconds', type=float, default=1.5, help='invocation time of the resumed mode')
+    args = parser.parse_args()
+
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    os.environ.update({'METRICS_ENABLED': 'false', 'BACKFILL_WORKERS': str(args.workers),
+                       'BACKFILL_TIME_MARGIN_SECONDS': '0', 'TEXTRACT_POLL_INITIAL_SECONDS': '0.1'})
+    logging.getLogger().addHandler(logging.NullHandler())
+    s3 = FakeS3(latency_ms=5.0)
+    textract = FakeTextract(textract_pages, job_seconds=args.textract_seconds)
+    runtime = FakeBedrockRuntime(summary_latency_ms=args.model_ms, summary_text=extracted_items)
+    agent = FakeBedrockAgent()
+    clients = {'s3': s3, 'textract': textract, 'bedrock-runtime': runtime, 'bedrock-agent': agent, 'sqs': FakeSqs()}
+    boto3.client = lambda service_name, *a, **kw: clients.get(service_name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        email_handler = load_lambda('email-handler', 'email_handler_index')
+
+    archive = {}
+    for week in range(args.weeks):
+        attachments = ['Pencil It In.pdf']
+        if week in (0, args.handbook_week):
+            attachments.insert(0, 'HANDBOOK - Students & Parents.pdf')
+        message_id = f"week-{week:02d}"
+        archive[(ENVIRONMENT['SOURCE_BUCKET_NAME'], f"archive/{message_id}")] = build_email(message_id, week, attachments)
+
+    print(f"{'mode':<9} {'invocations':>12} {'seconds':>8} {'textract jobs':>14} {'model calls':>12} "
+          f"{'ingestion jobs':>15} {'same documents':>15}")
+    expected = None
+    for mode in ('replay', 'backfill', 'resumed'):
+        s3.objects = dict(archive)
+        textract.jobs.clear()
+        runtime.calls.clear()
+        agent.jobs.clear()
+        started = time.perf_counter()
+        invocations = 0
+        if mode == 'replay':
+            for bucket, key in sorted(archive):
+                message_id = key.split('/', 1)[1]
+                s3.objects[(bucket, f"incoming/{message_id}")] = archive[(bucket, key)]
+                response = email_handler.lambda_handler({'Records': [{'ses': {'mail': {'messageId': message_id}}}]}, None)
+                assert response['statusCode'] == 200, response
+                invocations += 1
+        else:
+            while True:
+                context = Context(args.budget_seconds if mode == 'resumed' else 900)
+                response = email_handler.lambda_handler({'backfill': {}}, context)
+                invocations += 1
+                assert response['statusCode'] in (200, 202), response
+                if response['statusCode'] == 200:
+                    break
+        while True:
+            state = email_handler.ingestion_scheduler.state()
+            if not state['job'] and not state['pending']:
+                break
+            email_handler.check_ingestion()
+        seconds = time.perf_counter() - started
+
+        result = outputs(s3)
+        expected = expected or result
+        print(f"{mode:<9} {invocations:>12} {seconds:>8.2f} {len(textract.jobs):>14} {runtime.calls['invoke_model']:>12} "
+              f"{len(agent.jobs):>15} {str(result == expected):>15}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
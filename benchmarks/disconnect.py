@@ -0,0 +1,106 @@
+"""Answers to a client that disconnects, through get-response-from-bedrock with Lambda's async retries.
+
+The model streams --answer-tokens tokens at --tokens-per-second after --ttft-ms. Each scenario
+invokes the handler the way an async invocation is run: an invocation that raises is retried up
+to twice.
+
+  connected       the client stays for the whole answer
+  mid-answer      the connection goes away --disconnect-ms into the answer (410 Gone on the next post)
+  before-answer   the client disconnects while the context is retrieved, $disconnect reaches
+                  web-socket-handler before the first token
+
+The report gives the invocations, handler time, model calls and tokens generated, and the
+OutputTokensSaved and GenerationSecondsSaved metrics of the handler.
+
+    python benchmarks/disconnect.py --answer-tokens 400 --disconnect-ms 1500
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+
+import boto3
+
+from fakes import FakeApiGateway, FakeBedrockAgentRuntime, FakeBedrockRuntime, FakeS3
+from replay import ENVIRONMENT, MetricsCollector, load_corpus, load_lambda
+
+ASYNC_RETRIES = 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--retrieve-ms', type=float, default=300.0)
+    parser.add_argument('--ttft-ms', type=float, default=400.0)
+    parser.add_argument('--tokens-per-second', type=float, default=80.0)
+    parser.add_argument('--answer-tokens', type=int, default=400)
+    parser.add_argument('--disconnect-ms', type=float, default=1500.0, help='time from invoke to the mid-answer disconnect')
+    args = parser.parse_args()
+
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    s3 = FakeS3(latency_ms=15.0)
+    gateway = FakeApiGateway(latency_ms=20.0)
+    runtime = FakeBedrockRuntime(ttft_ms=args.ttft_ms, tokens_per_second=args.tokens_per_second,
+                                 answer_tokens=args.answer_tokens)
+    clients = {
+        's3': s3,
+        'apigatewaymanagementapi': gateway,
+        'bedrock-runtime': runtime,
+        'bedrock-agent-runtime': FakeBedrockAgentRuntime(load_corpus('knowledge_base.json'), latency_ms=args.retrieve_ms),
+    }
+    boto3.client = lambda service_name, *a, **kw: clients.get(service_name)
+
+    import instrumentation
+    collector = MetricsCollector()
+    collector.install(instrumentation)
+    with contextlib.redirect_stdout(io.StringIO()):
+        response_handler = load_lambda('get-response-from-bedrock', 'get_response_from_bedrock_index')
+        web_socket_handler = load_lambda('web-socket-handler', 'web_socket_handler_index')
+    chat_pipeline = sys.modules['chat_pipeline']
+
+    print(f"{'scenario':<14} {'invocations':>12} {'seconds':>8} {'model calls':>12} {'tokens generated':>17} "
+          f"{'tokens saved':>13} {'seconds saved':>14}")
+    for number, scenario in enumerate(('connected', 'mid-answer', 'before-answer')):
+        connection_id = f"conn-{number}"
+        gateway.expect(connection_id)
+        chat_pipeline.answer_cache = None
+        runtime.streams.clear()
+        runtime.calls.clear()
+        collector.take()
+
+        def disconnect():
+            gateway.gone.add(connection_id)
+            if scenario == 'before-answer':
+                web_socket_handler.lambda_handler(
+                    {'requestContext': {'routeKey': '$disconnect', 'connectionId': connection_id}}, None
+                )
+        if scenario != 'connected':
+            delay = args.disconnect_ms if scenario == 'mid-answer' else args.retrieve_ms / 3
+            threading.Timer(delay / 1000, disconnect).start()
+
+        event = {'prompt': 'When can I pick up report cards?', 'connectionId': connection_id, 'language': 'EN'}
+        started = time.perf_counter()
+        invocations = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(1 + ASYNC_RETRIES):
+                invocations += 1
+                try:
+                    response_handler.lambda_handler(dict(event), None)
+                    break
+                except Exception:
+                    continue
+        seconds = time.perf_counter() - started
+
+        metrics = collector.take()
+        tokens = sum(stream.delivered_tokens for stream in runtime.streams)
+        saved = sum(metrics.get('get-response-from-bedrock.OutputTokensSaved', []))
+        seconds_saved = sum(metrics.get('get-response-from-bedrock.GenerationSecondsSaved', []))
+        print(f"{scenario:<14} {invocations:>12} {seconds:>8.2f} {runtime.calls['invoke_model_with_response_stream']:>12} "
+              f"{tokens:>17} {saved:>13} {seconds_saved:>14.2f}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""Peak memory of email-handler for one email with a large handbook attachment.
+
+A MIME email with an --attachment-mb handbook PDF is written to a temporary file and processed
+in a fresh process per mode, so each reports its own peak RSS:
+
+  buffered  the previous path: the whole body read and decoded to a string, parsed with
+            email.message_from_string, the attachment decoded with get_payload and uploaded
+            with one put_object
+  streaming email-handler.lambda_handler: the body parsed as it is read, the attachment
+            spooled to a temporary file and uploaded for text extraction in multipart chunks
+
+S3 is a local stand-in that serves the email from the file and only hashes what is uploaded,
+so the numbers are the handler's own memory. The uploaded handbooks must be the same. The
+attachment is not a readable PDF, so the handler sends it to a Textract stand-in that finds no text.
+
+    python benchmarks/email_memory.py --attachment-mb 64 --spool-mb 8
+"""
+import argparse
+import base64
+import contextlib
+import email
+import hashlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from email import policy
+
+import boto3
+
+from fakes import FakeBedrockAgent, FakeS3, FakeSqs, FakeTextract
+from replay import ENVIRONMENT, load_lambda
+
+MESSAGE_ID = 'memory-benchmark'
+HANDBOOK_NAME = 'HANDBOOK - Students & Parents.pdf'
+
+
+def write_email(path, attachment_mb, seed=7):
+    """MIME email with a text part and a base64 handbook attachment, written without holding either in memory."""
+    boundary = '===============benchmark=='
+    chunk = 57 * 1024  # whole 76 character base64 lines
+    remaining = attachment_mb * 1024 * 1024
+    state = hashlib.sha256(str(seed).encode())
+    digest = hashlib.sha256()
+    with open(path, 'wb') as output:
+        output.write(
+            f"Subject: Handbook\r\nFrom: office@kelvynpark.example\r\nTo: assistant@kelvynpark.example\r\n"
+            f"Date: Mon, 20 Oct 2025 10:00:00 -0500\r\nMessage-ID: <{MESSAGE_ID}@kelvynpark.example>\r\n"
+            f"MIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary=\"{boundary}\"\r\n\r\n"
+            f"--{boundary}\r\nContent-Type: text/plain; charset=\"utf-8\"\r\nContent-Transfer-Encoding: 7bit\r\n\r\n"
+            f"Please find the new handbook attached.\r\n\r\n"
+            f"--{boundary}\r\nContent-Type: application/pdf\r\nContent-Transfer-Encoding: base64\r\n"
+            f"Content-Disposition: attachment; filename=\"{HANDBOOK_NAME}\"\r\n\r\n".encode('ascii')
+        )
+        while remaining > 0:
+            # Cheap deterministic filler, 32 bytes per hash repeated up to the chunk size
+            state = hashlib.sha256(state.digest())
+            data = (state.digest() * (chunk // 32 + 1))[:min(chunk, remaining)]
+            digest.update(data)
+            remaining -= len(data)
+            encoded = base64.b64encode(data)
+            output.write(b"\r\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76)) + b"\r\n")
+        output.write(f"\r\n--{boundary}--\r\n".encode('ascii'))
+    return digest.hexdigest()
+
+
+class SinkS3(FakeS3):
+    """Serves the email from its file and keeps only the size and hash of each upload."""
+
+    def __init__(self, email_path):
+        super().__init__()
+        self.email_path = email_path
+        self.email_key = (ENVIRONMENT['SOURCE_BUCKET_NAME'], f"incoming/{MESSAGE_ID}")
+        self.uploads = {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) == self.email_key:
+            self._call('get_object')
+            return {'Body': open(self.email_path, 'rb'), 'ContentLength': os.path.getsize(self.email_path)}
+        return super().get_object(Bucket, Key, **kwargs)
+
+    def _sink(self, bucket, key, body):
+        digest = hashlib.sha256()
+        size = 0
+        if hasattr(body, 'read'):
+            for chunk in iter(lambda: body.read(8 * 1024 * 1024), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        else:
+            digest.update(body)
+            size = len(body)
+        self.uploads[key] = (size, digest.hexdigest())
+        self.objects[(bucket, key)] = b''
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        if Bucket == ENVIRONMENT['DESTINATION_BUCKET_NAME']:
+            self._call('put_object')
+            return self._sink(Bucket, Key, Body)
+        return super().put_object(Bucket, Key, Body, **kwargs)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None, **kwargs):
+        self._call('upload_fileobj')
+        self._sink(Bucket, Key, Fileobj)
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._call('copy_object')
+        return {}
+
+
+def buffered(s3):
+    """The handbook path of process_email before streaming, reduced to its memory behaviour."""
+    s3_object = s3.get_object(Bucket=ENVIRONMENT['SOURCE_BUCKET_NAME'], Key=f"incoming/{MESSAGE_ID}")
+    email_body = s3_object['Body'].read().decode('utf-8')
+    msg = email.message_from_string(email_body, policy=policy.default)
+    for part in msg.walk():
+        if part.get_content_maintype() == 'multipart' or part.get('Content-Disposition') is None:
+            continue
+        content = part.get_payload(decode=True)
+        s3.put_object(Bucket=ENVIRONMENT['DESTINATION_BUCKET_NAME'], Key='HANDBOOK - Students & Parents.pdf', Body=content)
+
+
+def run(mode, email_path, spool_mb):
+    """Process the email in this process, prints the measurement as JSON."""
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    os.environ['ATTACHMENT_SPOOL_MB'] = str(spool_mb)
+    os.environ['LOCAL_INDEX_ENABLED'] = 'false'
+    os.environ['METRICS_ENABLED'] = 'false'
+    s3 = SinkS3(email_path)
+    clients = {'s3': s3, 'bedrock-agent': FakeBedrockAgent(latency_ms=0.0), 'textract': FakeTextract([]), 'sqs': FakeSqs()}
+    boto3.client = lambda service_name, *a, **kw: clients.get(service_name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        email_handler = load_lambda('email-handler', 'email_handler_index')
+    resting_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    if mode == 'buffered':
+        buffered(s3)
+    else:
+        response = email_handler.lambda_handler({'Records': [{'ses': {'mail': {'messageId': MESSAGE_ID}}}]}, None)
+        assert response['statusCode'] == 200, response
+    seconds = time.perf_counter() - started
+    print(json.dumps({
+        'resting_mib': resting_kb / 1024,
+        'peak_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'seconds': seconds,
+        'handbook': s3.uploads.get(f"handbooks/{MESSAGE_ID}.pdf", s3.uploads.get(f"{email_handler.HANDBOOK_FILE}.pdf")),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--attachment-mb', type=int, default=64, help='size of the decoded handbook attachment')
+    parser.add_argument('--spool-mb', type=int, default=8, help='ATTACHMENT_SPOOL_MB of the streaming run')
+    parser.add_argument('--run', choices=['buffered', 'streaming'], help=argparse.SUPPRESS)
+    parser.add_argument('--email', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run(args.run, args.email, args.spool_mb)
+
+    with tempfile.TemporaryDirectory() as directory:
+        email_path = os.path.join(directory, 'email.eml')
+        expected = write_email(email_path, args.attachment_mb)
+        email_mib = os.path.getsize(email_path) / 1024 / 1024
+        print(f"email {email_mib:.1f} MiB, handbook attachment {args.attachment_mb} MiB, spool {args.spool_mb} MiB")
+        print(f"{'mode':<10} {'resting MiB':>12} {'peak MiB':>9} {'added MiB':>10} {'seconds':>8} {'same handbook':>14}")
+        for mode in ('buffered', 'streaming'):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', mode, '--email', email_path,
+                 '--spool-mb', str(args.spool_mb)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            same = result['handbook'] == [args.attachment_mb * 1024 * 1024, expected]
+            print(f"{mode:<10} {result['resting_mib']:>12.1f} {result['peak_mib']:>9.1f} "
+                  f"{result['peak_mib'] - result['resting_mib']:>10.1f} {result['seconds']:>8.2f} {str(same):>14}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,410 @@
+"""Local stand-ins for the AWS clients used by the Lambdas, with injectable latency."""
+import datetime
+import hashlib
+import io
+import json
+import threading
+import time
+from collections import Counter
+
+from botocore.exceptions import ClientError
+
+
+class FakeClient:
+    """Counts every API call and sleeps for the configured latency before answering."""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, operation, latency_ms=None):
+        with self._lock:
+            self.calls[operation] += 1
+        delay = self.latency_ms if latency_ms is None else latency_ms
+        if delay:
+            time.sleep(delay / 1000)
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class _S3Exceptions:
+    NoSuchKey = NoSuchKey
+
+
+class FakeS3(FakeClient):
+    """In-memory buckets with the subset of the S3 API the Lambdas use."""
+
+    exceptions = _S3Exceptions
+
+    def __init__(self, latency_ms=0.0):
+        super().__init__(latency_ms)
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body=b'', IfMatch=None, IfNoneMatch=None, **kwargs):
+        self._call('put_object')
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        with self._lock:
+            current = self.objects.get((Bucket, Key))
+            if (IfNoneMatch == '*' and current is not None) or \
+                    (IfMatch is not None and (current is None or self._etag(current) != IfMatch)):
+                raise client_error('PreconditionFailed', 'PutObject')
+            self.objects[(Bucket, Key)] = bytes(Body)
+        return {'ETag': self._etag(Body)}
+
+    @staticmethod
+    def _etag(data):
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None, **kwargs):
+        self._call('upload_fileobj')
+        self.objects[(Bucket, Key)] = Fileobj.read()
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call('get_object')
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(Key)
+        data = self.objects[(Bucket, Key)]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'ETag': self._etag(data)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call('delete_object')
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._call('copy_object')
+        self.objects[(Bucket, Key)] = self.objects[(CopySource['Bucket'], CopySource['Key'])]
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self._call('list_objects_v2')
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)])} for key in keys], 'KeyCount': len(keys)}
+
+    def put_bucket_lifecycle_configuration(self, Bucket, LifecycleConfiguration, **kwargs):
+        self._call('put_bucket_lifecycle_configuration')
+        return {}
+
+
+class FakeBedrockAgentRuntime(FakeClient):
+    """Retrieve over a fixed list of chunks, ranked by shared words with the query."""
+
+    def __init__(self, chunks, latency_ms=150.0, top_k=5):
+        super().__init__(latency_ms)
+        self.chunks = chunks
+        self.top_k = top_k
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, **kwargs):
+        self._call('retrieve')
+        words = set(retrievalQuery['text'].lower().split())
+        scored = sorted(
+            ((len(words & set(chunk.lower().split())) / (len(words) or 1), chunk) for chunk in self.chunks),
+            reverse=True
+        )
+        return {'retrievalResults': [
+            {
+                'content': {'text': chunk},
+                'location': {'type': 'S3', 's3Location': {'uri': 's3://kp-doc-bucket/handbook.pdf'}},
+                'score': score
+            }
+            for score, chunk in scored[:self.top_k]
+        ]}
+
+
+class _EventStream:
+    """Iterable model stream that paces its events like a real generation and can be closed early."""
+
+    def __init__(self, events, ttft_ms, tokens_per_second):
+        self.events = events
+        self.ttft_ms = ttft_ms
+        self.tokens_per_second = tokens_per_second
+        self.closed = False
+        self.delivered_tokens = 0
+
+    def __iter__(self):
+        first = True
+        for event in self.events:
+            if self.closed:
+                return
+            if event['type'] == 'content_block_delta':
+                delay = self.ttft_ms / 1000 if first else 1 / self.tokens_per_second
+                first = False
+                time.sleep(delay)
+                self.delivered_tokens += 1
+            yield {'chunk': {'bytes': json.dumps(event).encode('utf-8')}}
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBedrockRuntime(FakeClient):
+    """Claude streaming answers, Claude completions (summary_text, or a function of the request body) and Titan
+    embeddings with configurable pacing."""
+
+    def __init__(self, ttft_ms=400.0, tokens_per_second=80.0, answer_tokens=120, summary_latency_ms=0.0,
+                 summary_text='{"items": []}', embedding_dimension=1536):
+        super().__init__(0.0)
+        self.ttft_ms = ttft_ms
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.summary_latency_ms = summary_latency_ms
+        self.summary_text = summary_text
+        self.embedding_dimension = embedding_dimension
+        self.streams = []
+        self.cached_prefixes = set()
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        self._call('invoke_model_with_response_stream')
+        words = ("Report cards are available in the main office from 8 AM to 3 PM. "
+                 "Please bring a photo ID and let us know if you need anything else.").split()
+        deltas = [
+            {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': words[i % len(words)] + ' '}}
+            for i in range(self.answer_tokens)
+        ]
+        events = (
+            [{'type': 'message_start', 'message': {'usage': {'input_tokens': len(body) // 4, 'output_tokens': 1}}},
+             {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}}]
+            + deltas
+            + [{'type': 'content_block_stop', 'index': 0},
+               {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': self.answer_tokens}},
+               {'type': 'message_stop'}]
+        )
+        events[0]['message']['usage'].update(self._prompt_cache_usage(body))
+        stream = _EventStream(events, self.ttft_ms, self.tokens_per_second)
+        self.streams.append(stream)
+        return {'body': stream, 'contentType': 'application/json'}
+
+    def _prompt_cache_usage(self, body):
+        # A system prompt with a checkpoint is written to the cache on first sight and read afterwards
+        system = json.loads(body).get('system')
+        if not isinstance(system, list) or 'cache_control' not in system[-1]:
+            return {}
+        prefix = system[-1]['text']
+        with self._lock:
+            cached = prefix in self.cached_prefixes
+            self.cached_prefixes.add(prefix)
+        key = 'cache_read_input_tokens' if cached else 'cache_creation_input_tokens'
+        return {key: len(prefix) // 4}
+
+    def invoke_model(self, modelId, body, **kwargs):
+        if modelId.startswith('amazon.titan-embed'):
+            self._call('invoke_model:embedding')
+            text = json.loads(body)['inputText']
+            vector = [0.0] * self.embedding_dimension
+            for word in text.lower().split():
+                vector[hash(word) % self.embedding_dimension] += 1.0
+            payload = {'embedding': vector, 'inputTextTokenCount': len(text) // 4}
+        else:
+            self._call('invoke_model', self.summary_latency_ms)
+            text = self.summary_text(body) if callable(self.summary_text) else self.summary_text
+            payload = {'content': [{'type': 'text', 'text': text}],
+                       'usage': {'input_tokens': len(body) // 4, 'output_tokens': len(text) // 4}}
+        return {'body': io.BytesIO(json.dumps(payload).encode('utf-8')), 'contentType': 'application/json'}
+
+
+class FakeTextract(FakeClient):
+    """Asynchronous text detection that finishes after job_seconds and pages its LINE blocks.
+
+    pages is the list of page texts of every document, or a function of the DocumentLocation returning it.
+    """
+
+    def __init__(self, pages, job_seconds=0.0, latency_ms=50.0, blocks_per_page=1000, queue=None):
+        super().__init__(latency_ms)
+        self.pages = pages
+        self.job_seconds = job_seconds
+        self.blocks_per_page = blocks_per_page
+        self.queue = queue
+        self.jobs = {}
+
+    def start_document_text_detection(self, DocumentLocation, NotificationChannel=None, **kwargs):
+        self._call('start_document_text_detection')
+        with self._lock:
+            job_id = f"job-{len(self.jobs) + 1}"
+            pages = self.pages(DocumentLocation) if callable(self.pages) else self.pages
+            self.jobs[job_id] = (time.monotonic() + self.job_seconds, pages)
+        if NotificationChannel and self.queue:
+            # Completion is published through SNS to the queue, wrapped in the SNS envelope
+            message = json.dumps({'JobId': job_id, 'Status': 'SUCCEEDED', 'API': 'StartDocumentTextDetection'})
+            threading.Timer(self.job_seconds, self.queue.send, args=(json.dumps({'Type': 'Notification', 'Message': message}),)).start()
+        return {'JobId': job_id}
+
+    def get_document_text_detection(self, JobId, NextToken=None, **kwargs):
+        self._call('get_document_text_detection')
+        ready, pages = self.jobs[JobId]
+        if time.monotonic() < ready:
+            return {'JobStatus': 'IN_PROGRESS', 'Blocks': []}
+        blocks = [
+            {'BlockType': 'LINE', 'Text': line, 'Page': page_number}
+            for page_number, page in enumerate(pages, start=1)
+            for line in page.splitlines() if line.strip()
+        ]
+        start = int(NextToken or 0)
+        response = {'JobStatus': 'SUCCEEDED', 'Blocks': blocks[start:start + self.blocks_per_page]}
+        if start + self.blocks_per_page < len(blocks):
+            response['NextToken'] = str(start + self.blocks_per_page)
+        return response
+
+
+class FakeSqs(FakeClient):
+    """A single queue with long polling, messages stay until deleted and reappear when made visible."""
+
+    def __init__(self, latency_ms=10.0):
+        super().__init__(latency_ms)
+        self.messages = {}
+        self.visible = []
+        self._condition = threading.Condition()
+
+    def send(self, body):
+        with self._condition:
+            handle = f"receipt-{len(self.messages) + 1}"
+            self.messages[handle] = body
+            self.visible.append(handle)
+            self._condition.notify_all()
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        self._call('receive_message')
+        with self._condition:
+            self._condition.wait_for(lambda: self.visible, timeout=WaitTimeSeconds)
+            handles, self.visible = self.visible[:MaxNumberOfMessages], self.visible[MaxNumberOfMessages:]
+            return {'Messages': [{'ReceiptHandle': handle, 'Body': self.messages[handle]} for handle in handles]}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self._call('delete_message')
+        with self._condition:
+            self.messages.pop(ReceiptHandle, None)
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        self._call('change_message_visibility')
+        with self._condition:
+            if ReceiptHandle in self.messages and VisibilityTimeout == 0:
+                self.visible.append(ReceiptHandle)
+                self._condition.notify_all()
+
+
+class GoneException(Exception):
+    pass
+
+
+class _GatewayExceptions:
+    GoneException = GoneException
+
+
+class FakeApiGateway(FakeClient):
+    """Collects the frames posted to each connection and signals when the 'end' frame arrives."""
+
+    exceptions = _GatewayExceptions
+
+    def __init__(self, latency_ms=20.0):
+        super().__init__(latency_ms)
+        self.frames = {}
+        self.first_delta_at = {}
+        self.finished = {}
+        self.gone = set()
+        self._frames_lock = threading.Lock()
+
+    def expect(self, connection_id):
+        event = threading.Event()
+        with self._frames_lock:
+            self.frames[connection_id] = []
+            self.finished[connection_id] = event
+        return event
+
+    def post_to_connection(self, ConnectionId, Data, **kwargs):
+        self._call('post_to_connection')
+        if ConnectionId in self.gone:
+            raise GoneException(ConnectionId)
+        frame = json.loads(Data)
+        with self._frames_lock:
+            self.frames.setdefault(ConnectionId, []).append(frame)
+            if frame.get('type') == 'delta':
+                self.first_delta_at.setdefault(ConnectionId, time.perf_counter())
+            finished = self.finished.get(ConnectionId)
+        if frame.get('type') == 'end' and finished:
+            finished.set()
+        return {}
+
+
+class FakeLambda(FakeClient):
+    """Async invocations run the target handler on a background thread after the queueing delay."""
+
+    def __init__(self, handler, queue_delay_ms=80.0, cold_start_ms=0.0, latency_ms=15.0):
+        super().__init__(latency_ms)
+        self.handler = handler
+        self.queue_delay_ms = queue_delay_ms
+        self.cold_start_ms = cold_start_ms
+        self.errors = []
+        self._warm = False
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload='{}', **kwargs):
+        self._call('invoke')
+        delay = self.queue_delay_ms + (0.0 if self._warm else self.cold_start_ms)
+        self._warm = True
+        thread = threading.Thread(target=self._run, args=(json.loads(Payload), delay), daemon=True)
+        thread.start()
+        return {'StatusCode': 202}
+
+    def _run(self, payload, delay_ms):
+        time.sleep(delay_ms / 1000)
+        try:
+            self.handler(payload, None)
+        except Exception as e:
+            self.errors.append(e)
+
+
+class FakeBedrockAgent(FakeClient):
+    """Ingestion jobs that complete after job_seconds.
+
+    Like the service, starting a job while another one of the knowledge base runs raises ConflictException.
+    Each job reports documents_per_job scanned documents, modified_per_job of them modified.
+    """
+
+    def __init__(self, job_seconds=0.0, latency_ms=30.0, documents_per_job=4, modified_per_job=2):
+        super().__init__(latency_ms)
+        self.job_seconds = job_seconds
+        self.documents_per_job = documents_per_job
+        self.modified_per_job = modified_per_job
+        self.jobs = {}
+        self.conflicts = 0
+
+    def _status(self, job):
+        return 'COMPLETE' if time.monotonic() >= job['ready'] else 'IN_PROGRESS'
+
+    def start_ingestion_job(self, knowledgeBaseId, dataSourceId, **kwargs):
+        self._call('start_ingestion_job')
+        with self._lock:
+            if any(self._status(job) == 'IN_PROGRESS' for job in self.jobs.values()):
+                self.conflicts += 1
+                raise client_error('ConflictException', 'StartIngestionJob', 'An ingestion job is already in progress')
+            job_id = f"ingestion-{len(self.jobs) + 1}"
+            self.jobs[job_id] = {'started': time.time(), 'ready': time.monotonic() + self.job_seconds}
+        return {'ingestionJob': {'ingestionJobId': job_id, 'status': 'STARTING'}}
+
+    def get_ingestion_job(self, knowledgeBaseId, dataSourceId, ingestionJobId, **kwargs):
+        self._call('get_ingestion_job')
+        job = self.jobs[ingestionJobId]
+        status = self._status(job)
+        started = datetime.datetime.fromtimestamp(job['started'], datetime.timezone.utc)
+        finished = started + datetime.timedelta(seconds=self.job_seconds)
+        return {'ingestionJob': {
+            'knowledgeBaseId': knowledgeBaseId,
+            'dataSourceId': dataSourceId,
+            'ingestionJobId': ingestionJobId,
+            'status': status,
+            'statistics': {
+                'numberOfDocumentsScanned': self.documents_per_job,
+                'numberOfModifiedDocumentsIndexed': self.modified_per_job,
+                'numberOfDocumentsFailed': 0,
+            } if status == 'COMPLETE' else {},
+            'startedAt': started,
+            'updatedAt': finished if status == 'COMPLETE' else datetime.datetime.now(datetime.timezone.utc),
+        }}
@@ -0,0 +1,110 @@
+"""Knowledge base syncs for a burst of processed emails, started blindly against the ingestion scheduler.
+
+--requests sync requests arrive from --clients threads over --burst-seconds. The bedrock-agent
+stand-in runs each ingestion job for --job-seconds and, like the service, rejects a start while a job
+is running with ConflictException.
+
+  blind      the previous sync_knowledge_base: start_ingestion_job on every request, conflicts logged and dropped
+  scheduler  email-handler.sync_knowledge_base with INGESTION_DEBOUNCE_SECONDS=--debounce-seconds, plus the
+             scheduled check every --tick-seconds until no job is running or pending
+
+The report gives the jobs started, rejected starts, whether the last request's changes were
+ingested (a job started after it completed) and the time from the last request until then.
+
+    python benchmarks/ingestion_burst.py --requests 20 --burst-seconds 3 --job-seconds 2
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+from fakes import FakeBedrockAgent, FakeS3
+from replay import ENVIRONMENT, load_lambda
+
+
+def burst(args, request):
+    """Call request() --requests times spread over the burst, returns the time of the last call."""
+    last = [0.0]
+    lock = threading.Lock()
+    started = time.monotonic()
+
+    def send(i):
+        time.sleep(max(0.0, started + args.burst_seconds * i / max(1, args.requests - 1) - time.monotonic()))
+        request()
+        with lock:
+            last[0] = max(last[0], time.monotonic())
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        list(executor.map(send, range(args.requests)))
+    return last[0]
+
+
+def fresh_after(agent, last_request, job_seconds):
+    """Seconds from the last request until a job started after it completed, None when none did."""
+    started = [job['ready'] - job_seconds for job in agent.jobs.values() if job['ready'] - job_seconds >= last_request]
+    return min(started) + job_seconds - last_request if started else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20, help='sync requests in the burst')
+    parser.add_argument('--clients', type=int, default=4, help='emails processed concurrently')
+    parser.add_argument('--burst-seconds', type=float, default=3.0)
+    parser.add_argument('--job-seconds', type=float, default=2.0, help='duration of each ingestion job')
+    parser.add_argument('--debounce-seconds', type=float, default=1.0)
+    parser.add_argument('--tick-seconds', type=float, default=0.25, help='interval of the scheduled check')
+    args = parser.parse_args()
+
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    os.environ['INGESTION_DEBOUNCE_SECONDS'] = str(args.debounce_seconds)
+    os.environ['METRICS_ENABLED'] = 'false'
+    s3 = FakeS3(latency_ms=5.0)
+    clients = {'s3': s3, 'bedrock-agent': FakeBedrockAgent()}
+    boto3.client = lambda service_name, *a, **kw: clients.get(service_name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        email_handler = load_lambda('email-handler', 'email_handler_index')
+
+    print(f"{'mode':<10} {'jobs started':>13} {'rejected':>9} {'last request ingested':>22} {'seconds to fresh':>17}")
+    for mode in ('blind', 'scheduler'):
+        agent = FakeBedrockAgent(job_seconds=args.job_seconds, latency_ms=30.0)
+        email_handler.bedrock = agent
+        email_handler.ingestion_scheduler.agent = agent
+        s3.objects.clear()
+
+        if mode == 'blind':
+            def request():
+                try:
+                    agent.start_ingestion_job(knowledgeBaseId=email_handler.KNOWLEDGE_BASE_ID,
+                                              dataSourceId=email_handler.DATA_SOURCE_ID)
+                except ClientError:
+                    pass
+            last_request = burst(args, request)
+            time.sleep(args.job_seconds)
+        else:
+            last_request = burst(args, email_handler.sync_knowledge_base)
+            while True:
+                state = email_handler.ingestion_scheduler.state()
+                if not state['job'] and not state['pending']:
+                    break
+                time.sleep(args.tick_seconds)
+                email_handler.check_ingestion()
+
+        fresh = fresh_after(agent, last_request, args.job_seconds)
+        print(f"{mode:<10} {len(agent.jobs):>13} {agent.conflicts:>9} {str(fresh is not None):>22} "
+              f"{'-' if fresh is None else f'{fresh:.2f}':>17}")
+        if mode == 'scheduler':
+            version = json.loads(s3.objects[(ENVIRONMENT['STATE_BUCKET_NAME'], email_handler.KB_VERSION_KEY)])
+            print(f"published knowledge base version [{version['version']}], "
+                  f"history: {[(job['job_id'], job['requests']) for job in state['history']]}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""Recall and latency of the local vector index against a stubbed Retrieve call.
+
+A synthetic corpus is chunked and embedded with a deterministic hashing embedder,
+written with email-handler's snapshot writer and read back by the response Lambda's
+LocalIndex. The stubbed Retrieve ranks the same chunks exactly and sleeps for the
+configured round trip, so recall@k measures what the snapshot loses and latency shows
+what skipping the round trip saves. Needs NumPy.
+
+    python benchmarks/local_retrieval.py --queries 200 --retrieve-ms 150
+"""
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(ROOT), 'lambda', 'email-handler'))
+sys.path.insert(0, os.path.join(os.path.dirname(ROOT), 'lambda', 'shared', 'python'))
+
+import numpy as np  # noqa: E402
+import vector_snapshot  # noqa: E402
+from fakes import FakeClient, FakeS3  # noqa: E402
+from local_index import LocalIndex  # noqa: E402
+
+BUCKET = 'state-bucket'
+DIMENSION = 1536
+TOPICS = ['report card pickup', 'school start time', 'uniform policy', 'attendance', 'bus routes',
+          'parent teacher conference', 'graduation', 'lunch menu', 'after school clubs', 'sports tryouts',
+          'field trip forms', 'cell phone policy', 'winter break', 'testing schedule', 'tutoring']
+FILLER = ('students parents office please bring the on at in for with and our school week day '
+          'grade class teacher room time information form contact').split()
+
+
+def hashed_embedding(text):
+    """Bag of hashed words, a stand-in for Titan that keeps lexical neighbours close."""
+    vector = [0.0] * DIMENSION
+    for word in text.lower().split():
+        digest = hashlib.md5(word.encode('utf-8')).digest()
+        vector[int.from_bytes(digest[:4], 'little') % DIMENSION] += 1.0 if digest[4] % 2 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+class FakeEmbeddingRuntime(FakeClient):
+    def invoke_model(self, modelId, body):
+        self._call('invoke_model')
+        embedding = hashed_embedding(json.loads(body)['inputText'])
+        return {'body': io.BytesIO(json.dumps({'embedding': embedding}).encode('utf-8'))}
+
+
+class StubRetrieve(FakeClient):
+    """Exact ranking over the same chunks, standing in for bedrock-agent-runtime.retrieve."""
+
+    def __init__(self, chunks, latency_ms):
+        super().__init__(latency_ms)
+        self.texts = chunks
+        self.vectors = np.array([hashed_embedding(text) for text in chunks], dtype=np.float64)
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, top_k=5):
+        self._call('retrieve')
+        scores = self.vectors @ np.array(hashed_embedding(retrievalQuery['text']))
+        ranked = np.argsort(-scores)[:top_k]
+        return {'retrievalResults': [{'content': {'text': self.texts[i]}, 'score': float(scores[i])} for i in ranked]}
+
+
+def build_corpus(rng, paragraphs):
+    lines = []
+    for i in range(paragraphs):
+        topic = TOPICS[i % len(TOPICS)]
+        lines.append(f"{topic} " + " ".join(rng.choice(FILLER) for _ in range(80)) + f" {topic}")
+    return "\n".join(lines)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def json_embedding(runtime, text):
+    response = runtime.invoke_model(modelId=vector_snapshot.EMBEDDING_MODEL_ID, body=json.dumps({'inputText': text}))
+    return json.loads(response['body'].read())['embedding']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--paragraphs', type=int, default=120)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--retrieve-ms', type=float, default=150.0, help='injected Retrieve round trip')
+    parser.add_argument('--embed-ms', type=float, default=25.0, help='injected query embedding round trip')
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    s3 = FakeS3()
+    runtime = FakeEmbeddingRuntime()
+    handbook = build_corpus(rng, args.paragraphs)
+    newsletter = build_corpus(rng, args.paragraphs // 4)
+    vector_snapshot.write_source_snapshot(s3, runtime, BUCKET, 'handbook', handbook, 's3://docs/handbook.pdf')
+    vector_snapshot.write_source_snapshot(s3, runtime, BUCKET, 'newsletter', newsletter, 's3://docs/newsletter.txt')
+    vector_snapshot.write_manifest(s3, BUCKET, 'v1')
+
+    runtime.latency_ms = args.embed_ms
+    index = LocalIndex(s3, BUCKET, lambda text: json_embedding(runtime, text), cache_dir=os.path.join('/tmp', 'kp-bench-index'))
+    started = time.perf_counter()
+    index.load('v1')
+    load_ms = (time.perf_counter() - started) * 1000
+
+    managed = StubRetrieve(vector_snapshot.chunk_text(handbook) + vector_snapshot.chunk_text(newsletter), args.retrieve_ms)
+    local_ms, managed_ms, recalls = [], [], []
+    for _ in range(args.queries):
+        query = f"{rng.choice(TOPICS)} {rng.choice(FILLER)} {rng.choice(FILLER)}"
+        started = time.perf_counter()
+        local = index.retrieve(query, top_k=args.top_k)
+        local_ms.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        expected = managed.retrieve(knowledgeBaseId='kb', retrievalQuery={'text': query}, top_k=args.top_k)
+        managed_ms.append((time.perf_counter() - started) * 1000)
+        expected_texts = {result['content']['text'] for result in expected['retrievalResults']}
+        local_texts = {result['content']['text'] for result in local['retrievalResults']}
+        recalls.append(len(expected_texts & local_texts) / len(expected_texts))
+
+    print(f"snapshot load: {load_ms:.1f} ms (once per container and knowledge base version)")
+    print(f"recall@{args.top_k}: {statistics.mean(recalls):.3f}")
+    print(f"{'path':<10} {'p50 ms':>8} {'p95 ms':>8}")
+    print(f"{'local':<10} {percentile(local_ms, 0.5):>8.1f} {percentile(local_ms, 0.95):>8.1f}")
+    print(f"{'retrieve':<10} {percentile(managed_ms, 0.5):>8.1f} {percentile(managed_ms, 0.95):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
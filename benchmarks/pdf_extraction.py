@@ -0,0 +1,127 @@
+"""Text layer fast path against whole-document Textract OCR in email-handler.
+
+Sample newsletter PDFs with several stacked issues are generated with a text layer on every
+page (digital), on some pages (mixed, scanned first) or on none (scanned), and the latest issue is extracted
+with PDF_EXTRACTION=textract and PDF_EXTRACTION=auto. Textract is a local stand-in that takes
+--textract-seconds per job and reads the text of a scanned page from the page itself, so both
+paths must return the same newsletter. Needs pypdf.
+
+    python benchmarks/pdf_extraction.py --issues 6 --textract-seconds 8
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import boto3
+
+from fakes import FakeS3, FakeSqs, FakeTextract
+from replay import ENVIRONMENT, load_lambda
+
+ISSUE_LINES = [
+    "Pencil It In!",
+    "Week of October {day}",
+    "Report card pickup is Friday from 8:00 AM to 3:00 PM in the main office.",
+    "Basketball tryouts begin Monday after school in the main gym.",
+    "Parent workshop on college applications Thursday at 5:30 PM in the library.",
+    "Picture day retakes are next Wednesday, order forms are available in the main office.",
+]
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def build_pdf(pages):
+    """PDF bytes with one page per (text, scanned) pair.
+
+    A scanned page only draws an image, its text is kept in a /BenchmarkText entry for the stand-in OCR.
+    """
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+               b"<< /Type /XObject /Subtype /Image /Width 1 /Height 1 /ColorSpace /DeviceGray "
+               b"/BitsPerComponent 8 /Length 1 >>\nstream\n\x80\nendstream"]
+    kids = []
+    for text, scanned in pages:
+        if scanned:
+            content = b"q 612 0 0 792 0 0 cm /Im1 Do Q"
+        else:
+            rows = " T* ".join(f"({_escape(line)}) Tj" for line in text.splitlines())
+            content = f"BT /F1 11 Tf 50 740 Td 14 TL {rows} ET".encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        content_number = len(objects)
+        extra = f" /BenchmarkText ({_escape(text)})".encode('latin-1') if scanned else b""
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 3 0 R >> /XObject << /Im1 4 0 R >> >>%s >>" % (content_number, extra))
+        kids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{kid} 0 R" for kid in kids).encode(), len(kids))
+
+    output = io.BytesIO()
+    output.write(b"%PDF-1.7\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(output.tell())
+        output.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = output.tell()
+    output.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        output.write(b"%010d 00000 n \n" % offset)
+    output.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return output.getvalue()
+
+
+def stand_in_ocr(s3):
+    """Page texts of the PDF a Textract job was started on, as the stand-in would read them."""
+    from pypdf import PdfReader
+
+    def pages(document_location):
+        location = document_location['S3Object']
+        reader = PdfReader(io.BytesIO(s3.objects[(location['Bucket'], location['Name'])]))
+        return [str(page.get('/BenchmarkText', page.extract_text())) for page in reader.pages]
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--issues', type=int, default=6, help='newsletter issues stacked in each PDF, one page each')
+    parser.add_argument('--textract-seconds', type=float, default=8.0, help='time until a Textract job succeeds')
+    parser.add_argument('--blocks-per-page', type=int, default=1000, help='blocks per Textract result page')
+    args = parser.parse_args()
+
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    s3 = FakeS3(latency_ms=15.0)
+    textract = FakeTextract(stand_in_ocr(s3), job_seconds=args.textract_seconds, blocks_per_page=args.blocks_per_page)
+    clients = {'s3': s3, 'textract': textract, 'sqs': FakeSqs()}
+    # Bedrock clients are created at import but not used by the extraction
+    boto3.client = lambda service_name, *a, **kw: clients.get(service_name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        email_handler = load_lambda('email-handler', 'email_handler_index')
+
+    issues = ["\n".join(ISSUE_LINES).format(day=28 - 7 * i) for i in range(args.issues)]
+    samples = {
+        'digital': [(issue, False) for issue in issues],
+        'mixed': [(issue, i % 3 == 2) for i, issue in enumerate(issues)],
+        'scanned': [(issue, True) for issue in issues],
+        'scanned first': [(issue, i == 0) for i, issue in enumerate(issues)],
+    }
+
+    print(f"{'sample':<14} {'extraction':<10} {'ms':>9} {'textract calls':>15} {'same text':>10}")
+    for sample, pages in samples.items():
+        pdf = build_pdf(pages)
+        expected = None
+        for mode in ('textract', 'auto'):
+            email_handler.PDF_EXTRACTION = mode
+            textract.calls.clear()
+            started = time.perf_counter()
+            newsletter = email_handler.extract_latest_newsletter(io.BytesIO(pdf), f"newsletters/{sample}-{mode}.pdf")
+            milliseconds = (time.perf_counter() - started) * 1000
+            expected = expected or newsletter
+            print(f"{sample:<14} {mode:<10} {milliseconds:>9.1f} {sum(textract.calls.values()):>15} "
+                  f"{str(' '.join(newsletter.split()) == ' '.join(expected.split())):>10}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,354 @@
+"""Offline load and replay benchmark for the three Lambdas.
+
+Recorded questions (English and Spanish) are replayed through
+web-socket-handler.lambda_handler -> get-response-from-bedrock.lambda_handler by
+concurrent clients, and sample SES emails carrying handbook and newsletter
+attachments are replayed through email-handler.lambda_handler. Bedrock, Textract,
+S3, API Gateway and Lambda are local stand-ins (see fakes.py) with injected latency
+and token rates, so no network or AWS account is needed.
+
+    python benchmarks/replay.py --clients 8 --rounds 2 --emails 4
+    python benchmarks/replay.py --retrieve-ms 300 --ttft-ms 900 --json > run.json
+    python benchmarks/replay.py --modes async inline --emails 0
+    python benchmarks/replay.py --emails 4 --textract-seconds 20 --textract-blocks-per-page 5 --textract-wait notification
+
+With --modes async inline the questions are replayed once per web-socket-handler
+CHAT_MODE, starting each run with an empty answer cache, so the queueing delay of the
+Lambda-to-Lambda hop shows up as the difference in end-to-end and first-delta latency.
+
+The report gives p50/p95/p99 end-to-end and per-stage latency (the stages come
+from the instrumentation module), the API calls made and the peak memory.
+Lambda environment variables set in the shell (for example ANSWER_CACHE_BACKEND=none)
+are passed through to the functions.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+import boto3
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_ROOT = os.path.join(os.path.dirname(BENCHMARK_DIR), 'lambda')
+sys.path.insert(0, os.path.join(LAMBDA_ROOT, 'shared', 'python'))
+
+from fakes import (FakeApiGateway, FakeBedrockAgent, FakeBedrockAgentRuntime,  # noqa: E402
+                   FakeBedrockRuntime, FakeLambda, FakeS3, FakeSqs, FakeTextract)
+
+ENVIRONMENT = {
+    'URL': 'https://local.execute-api.us-west-2.amazonaws.com/production',
+    'KNOWLEDGE_BASE_ID': 'KBLOCAL000',
+    'DATA_SOURCE_ID': 'DSLOCAL000',
+    'RESPONSE_FUNCTION_ARN': 'arn:aws:lambda:us-west-2:000000000000:function:kp-get-response-from-bedrock',
+    'SOURCE_BUCKET_NAME': 'kp-email-bucket',
+    'DESTINATION_BUCKET_NAME': 'kp-doc-bucket',
+    'STATE_BUCKET_NAME': 'kp-state-bucket',
+    'MAX_RETRIES': '3',
+    'ENABLE_LIFECYCLE_RULE': 'false',
+    'INGESTION_DEBOUNCE_SECONDS': '0',
+    'METRICS_ENABLED': 'true',
+    'AWS_DEFAULT_REGION': 'us-west-2',
+}
+
+NEWSLETTER_ISSUE = """Pencil It In!
+Week of {date}
+Report card pickup is Friday from 8:00 AM to 3:00 PM in the main office.
+Basketball tryouts begin Monday after school in the main gym.
+Parent workshop on college applications Thursday at 5:30 PM in the library.
+Picture day retakes are next Wednesday, order forms are available in the main office.
+"""
+
+# What the model extracts from the latest issue, the dates stay in the future so the items never expire
+NEWSLETTER_ITEMS = [
+    {'category': 'event', 'title': 'Report card pickup', 'details': 'Pick up report cards in the main office.',
+     'dates': ['2099-10-25'], 'time': '8:00 AM to 3:00 PM', 'location': 'Main office'},
+    {'category': 'activity', 'title': 'Basketball tryouts', 'details': 'Tryouts begin Monday after school.',
+     'dates': ['2099-10-28'], 'location': 'Main gym'},
+    {'category': 'announcement', 'title': 'Picture day retakes',
+     'details': 'Retakes are next Wednesday, order forms are available in the main office.'},
+]
+
+
+def load_corpus(name):
+    with open(os.path.join(BENCHMARK_DIR, 'corpus', name), encoding='utf-8') as corpus_file:
+        return json.load(corpus_file)
+
+
+def load_lambda(directory, module_name):
+    """Import a function's index.py under its own module name, the three handlers all live in index.py."""
+    path = os.path.join(LAMBDA_ROOT, directory)
+    sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(path, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class LocalAws:
+    """Hands out the stand-in clients in place of boto3.client."""
+
+    def __init__(self, args):
+        issues = [NEWSLETTER_ISSUE.format(date=f"October {day}") for day in (21, 14, 7)]
+        self.s3 = FakeS3(latency_ms=args.s3_ms)
+        self.agent_runtime = FakeBedrockAgentRuntime(load_corpus('knowledge_base.json'), latency_ms=args.retrieve_ms)
+        self.runtime = FakeBedrockRuntime(
+            ttft_ms=args.ttft_ms, tokens_per_second=args.tokens_per_second,
+            answer_tokens=args.answer_tokens, summary_latency_ms=args.summary_ms,
+            summary_text=json.dumps({'items': NEWSLETTER_ITEMS})
+        )
+        self.sqs = FakeSqs()
+        self.textract = FakeTextract(issues * args.newsletter_issues, job_seconds=args.textract_seconds,
+                                     blocks_per_page=args.textract_blocks_per_page, queue=self.sqs)
+        self.gateway = FakeApiGateway(latency_ms=args.post_ms)
+        self.agent = FakeBedrockAgent()
+        self.lambda_client = FakeLambda(None, queue_delay_ms=args.queue_ms, cold_start_ms=args.cold_start_ms)
+
+    def client(self, service_name, *args, **kwargs):
+        return {
+            's3': self.s3,
+            'bedrock-agent-runtime': self.agent_runtime,
+            'bedrock-runtime': self.runtime,
+            'textract': self.textract,
+            'apigatewaymanagementapi': self.gateway,
+            'bedrock-agent': self.agent,
+            'lambda': self.lambda_client,
+            'sqs': self.sqs,
+        }[service_name]
+
+    def api_calls(self):
+        calls = {}
+        for service, client in (('s3', self.s3), ('bedrock-agent-runtime', self.agent_runtime),
+                                ('bedrock-runtime', self.runtime), ('textract', self.textract),
+                                ('apigatewaymanagementapi', self.gateway), ('bedrock-agent', self.agent),
+                                ('lambda', self.lambda_client), ('sqs', self.sqs)):
+            for operation, count in sorted(client.calls.items()):
+                calls[f"{service}.{operation}"] = count
+        return calls
+
+
+class MetricsCollector:
+    """Captures the instrumentation records instead of printing them."""
+
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def install(self, instrumentation):
+        collector = self
+
+        def emit(trace):
+            with collector._lock:
+                for name, (_, values) in trace.metrics.items():
+                    collector.samples.setdefault(f"{trace.function_name}.{name}", []).extend(values)
+            trace.metrics = {}
+        instrumentation.Trace.emit = emit
+
+    def add(self, name, value):
+        with self._lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def take(self):
+        with self._lock:
+            samples, self.samples = self.samples, {}
+        return samples
+
+
+def build_email(message_id, attachments, size_kb, rng):
+    message = EmailMessage()
+    message['Subject'] = f"Documents {message_id}"
+    message['From'] = 'office@kelvynpark.example'
+    message['To'] = 'assistant@kelvynpark.example'
+    message['Message-ID'] = f"<{message_id}@kelvynpark.example>"
+    message.set_content("Please find the latest documents attached.")
+    for file_name in attachments:
+        content = b"%PDF-1.7\n" + rng.randbytes(size_kb * 1024)
+        message.add_attachment(content, maintype='application', subtype='pdf', filename=file_name)
+    return message.as_bytes()
+
+
+def replay_chat(args, aws, web_socket_handler, collector):
+    questions = load_corpus('questions.json')
+    workload = [(language, question) for _ in range(args.rounds)
+                for language in args.languages for question in questions[language]]
+    random.Random(args.seed).shuffle(workload)
+
+    def ask(item):
+        language, question = item
+        connection_id = f"conn-{uuid.uuid4().hex[:12]}"
+        finished = aws.gateway.expect(connection_id)
+        started = time.perf_counter()
+        web_socket_handler.lambda_handler({
+            'requestContext': {'routeKey': 'sendMessage', 'connectionId': connection_id},
+            'body': json.dumps({'action': 'sendMessage', 'prompt': question, 'Language': language})
+        }, None)
+        if not finished.wait(args.timeout):
+            collector.add('client.Timeouts', 1)
+            return
+        collector.add('client.EndToEnd', (time.perf_counter() - started) * 1000)
+        collector.add('client.FirstDelta', (aws.gateway.first_delta_at[connection_id] - started) * 1000)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        list(executor.map(ask, workload))
+    return len(workload), time.perf_counter() - started
+
+
+def replay_email(args, aws, email_handler, collector):
+    rng = random.Random(args.seed)
+    mix = [['HANDBOOK - Students & Parents 2024-2025.pdf'], ['Pencil It In 10-21.pdf'],
+           ['HANDBOOK - Students & Parents 2024-2025.pdf', 'Pencil It In 10-21.pdf'], ['Field Trip Flyer.pdf']]
+    message_ids = []
+    for i in range(args.emails):
+        message_id = f"local-{i:04d}-{uuid.uuid4().hex[:8]}"
+        aws.s3.objects[(ENVIRONMENT['SOURCE_BUCKET_NAME'], f"incoming/{message_id}")] = build_email(
+            message_id, mix[i % len(mix)], args.attachment_kb, rng
+        )
+        message_ids.append(message_id)
+
+    def deliver(message_id):
+        started = time.perf_counter()
+        response = email_handler.lambda_handler({'Records': [{'ses': {'mail': {'messageId': message_id}}}]}, None)
+        collector.add('client.EmailEndToEnd', (time.perf_counter() - started) * 1000)
+        if response['statusCode'] != 200:
+            collector.add('client.EmailFailures', 1)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.email_clients) as executor:
+        list(executor.map(deliver, message_ids))
+    return len(message_ids), time.perf_counter() - started
+
+
+def summarize(samples):
+    summary = {}
+    for name, values in sorted(samples.items()):
+        summary[name] = {
+            'count': len(values),
+            'p50': percentile(values, 0.50),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99),
+        }
+    return summary
+
+
+def print_phase(title, requests, seconds, summary, peak_bytes):
+    print(f"\n{title}: {requests} requests in {seconds:.2f}s ({requests / seconds if seconds else 0:.1f}/s), "
+          f"peak traced memory {peak_bytes / 1024 / 1024:.1f} MiB")
+    print(f"{'stage':<48} {'count':>6} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for name, stats in summary.items():
+        print(f"{name:<48} {stats['count']:>6} {stats['p50']:>10.1f} {stats['p95']:>10.1f} {stats['p99']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent chat clients')
+    parser.add_argument('--rounds', type=int, default=1, help='times the question corpus is replayed')
+    parser.add_argument('--languages', nargs='+', default=['EN', 'ES'], choices=['EN', 'ES'])
+    parser.add_argument('--modes', nargs='+', default=['async'], choices=['async', 'inline'],
+                        help='web-socket-handler CHAT_MODE values to replay the questions with')
+    parser.add_argument('--emails', type=int, default=4, help='SES emails to replay, 0 to skip')
+    parser.add_argument('--email-clients', type=int, default=1, help='emails processed concurrently')
+    parser.add_argument('--attachment-kb', type=int, default=512)
+    parser.add_argument('--newsletter-issues', type=int, default=4, help='issues stacked in each newsletter PDF')
+    parser.add_argument('--retrieve-ms', type=float, default=150.0)
+    parser.add_argument('--ttft-ms', type=float, default=400.0)
+    parser.add_argument('--tokens-per-second', type=float, default=80.0)
+    parser.add_argument('--answer-tokens', type=int, default=120)
+    parser.add_argument('--post-ms', type=float, default=20.0, help='post_to_connection round trip')
+    parser.add_argument('--queue-ms', type=float, default=80.0, help='async Lambda invoke queueing delay')
+    parser.add_argument('--cold-start-ms', type=float, default=600.0, help='added to the first async invoke')
+    parser.add_argument('--s3-ms', type=float, default=15.0)
+    parser.add_argument('--summary-ms', type=float, default=2000.0, help='newsletter item extraction latency')
+    parser.add_argument('--textract-seconds', type=float, default=0.0, help='time until a Textract job succeeds')
+    parser.add_argument('--textract-blocks-per-page', type=int, default=1000, help='blocks per Textract result page')
+    parser.add_argument('--textract-wait', choices=['poll', 'notification'], default='poll',
+                        help='poll the job status or wait on the completion notification queue')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    for name, value in ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    if args.textract_wait == 'notification':
+        os.environ.update({
+            'TEXTRACT_NOTIFICATION_TOPIC_ARN': 'arn:aws:sns:us-west-2:000000000000:AmazonTextract-kp-local',
+            'TEXTRACT_NOTIFICATION_ROLE_ARN': 'arn:aws:iam::000000000000:role/kp-textract-local',
+            'TEXTRACT_NOTIFICATION_QUEUE_URL': 'https://sqs.us-west-2.amazonaws.com/000000000000/kp-textract-local',
+        })
+    aws = LocalAws(args)
+    boto3.client = aws.client
+
+    import instrumentation
+    collector = MetricsCollector()
+    collector.install(instrumentation)
+
+    # Handlers print their progress, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        response_handler = load_lambda('get-response-from-bedrock', 'get_response_from_bedrock_index')
+        web_socket_handler = load_lambda('web-socket-handler', 'web_socket_handler_index')
+        email_handler = load_lambda('email-handler', 'email_handler_index')
+    aws.lambda_client.handler = response_handler.lambda_handler
+    chat_pipeline = sys.modules['chat_pipeline']
+
+    def chat_phase(mode):
+        def run():
+            web_socket_handler.CHAT_MODE = mode
+            # Every mode starts cold so cached answers do not favour the later runs
+            chat_pipeline.answer_cache = None
+            return replay_chat(args, aws, web_socket_handler, collector)
+        return run
+
+    report = {'settings': vars(args), 'phases': {}}
+    tracemalloc.start()
+    phases = [(f"chat ({mode})", chat_phase(mode)) for mode in args.modes]
+    if args.emails:
+        phases.append(('email', lambda: replay_email(args, aws, email_handler, collector)))
+    for phase, replay in phases:
+        tracemalloc.reset_peak()
+        with contextlib.redirect_stdout(io.StringIO()):
+            requests, seconds = replay()
+            # Let async invocations that outlived their client finish reporting
+            time.sleep(0.2)
+        report['phases'][phase] = {
+            'requests': requests,
+            'seconds': seconds,
+            'peak_traced_bytes': tracemalloc.get_traced_memory()[1],
+            'stages': summarize(collector.take()),
+        }
+    tracemalloc.stop()
+    report['api_calls'] = aws.api_calls()
+    report['async_errors'] = [repr(error) for error in aws.lambda_client.errors]
+    report['peak_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for phase, result in report['phases'].items():
+        print_phase(phase, result['requests'], result['seconds'], result['stages'], result['peak_traced_bytes'])
+    print(f"\n{'api call':<48} {'count':>6}")
+    for name, count in report['api_calls'].items():
+        print(f"{name:<48} {count:>6}")
+    print(f"\npeak RSS {report['peak_rss_kib'] / 1024:.1f} MiB, async invocation errors: {len(report['async_errors'])}")
+    for error in report['async_errors']:
+        print(f"  {error}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Cold-start and warm-start timing for the get-response-from-bedrock Lambda.
+
+Every AWS call is answered by botocore Stubber, so the benchmark runs offline and
+measures only import, client construction and request handling overhead.
+
+    python benchmarks/response_startup.py --requests 50
+
+Each mode runs in a fresh interpreter so the first request is a real cold start:
+  pooled       clients are created once per container (current behaviour)
+  per-request  the client pool is emptied before every request (previous behaviour)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT, 'lambda', 'get-response-from-bedrock')
+SHARED_DIR = os.path.join(ROOT, 'lambda', 'shared', 'python')
+STUBBED_CALLS = 1000
+
+STREAM_EVENTS = [{'type': 'message_start'}, {'type': 'content_block_start'}] + [
+    {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': word + ' '}}
+    for word in "Report cards can be picked up in the main office from 8 AM to 3 PM. Bring a photo ID.".split()
+] + [{'type': 'content_block_stop'}, {'type': 'message_delta'}, {'type': 'message_stop'}]
+
+
+def _stub_client(client, service_name):
+    from botocore.stub import Stubber
+
+    stubber = Stubber(client)
+    for _ in range(STUBBED_CALLS):
+        if service_name == 'bedrock-agent-runtime':
+            stubber.add_response('retrieve', {'retrievalResults': [
+                {'content': {'text': 'Report card pickup is in the main office.'}, 'score': 0.8}
+            ]})
+        elif service_name == 'bedrock-runtime':
+            # The event stream cannot be expressed as a stubbed response, it is swapped in after the call
+            stubber.add_response('invoke_model_with_response_stream', {'body': {}, 'contentType': 'application/json'})
+        elif service_name == 'apigatewaymanagementapi':
+            stubber.add_response('post_to_connection', {})
+    if service_name == 'bedrock-runtime':
+        client.meta.events.register(
+            'after-call.bedrock-runtime.InvokeModelWithResponseStream',
+            lambda parsed, **kwargs: parsed.update(body=iter(
+                {'chunk': {'bytes': json.dumps(event).encode('utf-8')}} for event in STREAM_EVENTS
+            ))
+        )
+    stubber.activate()
+    return client
+
+
+def run_child(mode, requests):
+    os.environ.update({
+        'URL': 'https://example.execute-api.us-west-2.amazonaws.com/production',
+        'KNOWLEDGE_BASE_ID': 'KBSTUB0000',
+        'AWS_DEFAULT_REGION': 'us-west-2',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+    })
+    sys.path[:0] = [LAMBDA_DIR, SHARED_DIR]
+
+    started = time.perf_counter()
+    import client_pool
+    import index
+    import_ms = (time.perf_counter() - started) * 1000
+
+    create_client = client_pool._create_client
+    client_pool._create_client = lambda service_name, **kwargs: _stub_client(
+        create_client(service_name, **kwargs), service_name
+    )
+
+    event = {'connectionId': 'conn-1', 'prompt': 'When is report card pickup?', 'language': 'EN'}
+    timings = []
+    for _ in range(requests):
+        if mode == 'per-request':
+            client_pool.reset()
+        started = time.perf_counter()
+        index.lambda_handler(event, None)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    warm = sorted(timings[1:]) or timings
+    print(json.dumps({
+        'mode': mode,
+        'import_ms': import_ms,
+        'first_request_ms': timings[0],
+        'warm_p50_ms': statistics.median(warm),
+        'warm_p95_ms': warm[int(len(warm) * 0.95) - 1] if len(warm) > 1 else warm[0],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--child', choices=['pooled', 'per-request'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.requests)
+        return
+
+    print(f"{'mode':<12} {'import ms':>10} {'first ms':>10} {'warm p50':>10} {'warm p95':>10}")
+    for mode in ('pooled', 'per-request'):
+        output = subprocess.run(
+            [sys.executable, __file__, '--child', mode, '--requests', str(args.requests)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode:<12} {result['import_ms']:>10.1f} {result['first_request_ms']:>10.1f} "
+              f"{result['warm_p50_ms']:>10.2f} {result['warm_p95_ms']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,9 @@ import { useLanguage } from "../utilities/LanguageContext";
 import { ALLOW_MARKDOWN_BOT } from "../utilities/constants";
 import ReactMarkdown from "react-markdown";
 
+// Identifies the conversation for follow-up questions, every question opens its own WebSocket connection
+const SESSION_ID = crypto.randomUUID();
+
 const StreamingMessage = ({ initialMessage, setProcessing }) => {
   const [responses, setResponses] = useState([]);
   const ws = useRef(null);
@@ -19,7 +22,7 @@ const StreamingMessage = ({ initialMessage, setProcessing }) => {
     ws.current.onopen = () => {
       console.log("WebSocket Connected");
       // Send initial message
-      ws.current.send(JSON.stringify({ action: "sendMessage", prompt: initialMessage, Language: language }));
+      ws.current.send(JSON.stringify({ action: "sendMessage", prompt: initialMessage, Language: language, sessionId: SESSION_ID }));
     };
 
     ws.current.onmessage = (event) => {
@@ -0,0 +1,88 @@
+"""Rebuild of the handbook and newsletter documents from the stored emails, resumable across invocations.
+
+The stored emails are scanned for their date and the content hashes of their handbook and
+newsletter attachments. Only the attachments that still shape the documents are extracted:
+the latest handbook, and the newsletters from the email of that handbook on, since every
+handbook resets the newsletter. Their issues are then folded in date order as if they had
+arrived one by one.
+
+The progress is kept in a state object in the state bucket after every email, and the
+extraction outputs in the attachment checkpoints, so an invocation that runs out of time is
+continued by the next one.
+"""
+import json
+import logging
+import time
+
+logger = logging.getLogger()
+
+STATE_KEY = 'backfill/state.json'
+# The checkpoint stage whose output the fold reads for each kind of attachment
+FOLD_STAGES = {'handbook': 'text', 'newsletter': 'items'}
+
+
+def new_state(prefixes, refresh):
+    return {'started_at': time.time(), 'completed_at': None, 'prefixes': prefixes, 'refresh': refresh,
+            'emails': {}, 'failed': {}}
+
+
+def load_state(s3, bucket):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=STATE_KEY)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def save_state(s3, bucket, state):
+    s3.put_object(
+        Bucket=bucket,
+        Key=STATE_KEY,
+        Body=json.dumps(state).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+
+def list_emails(s3, bucket, prefixes):
+    """Keys of the stored emails under the prefixes, an email in an earlier prefix wins over the same message ID in a later one."""
+    keys = {}
+    for prefix in prefixes:
+        kwargs = {'Bucket': bucket, 'Prefix': prefix}
+        while True:
+            response = s3.list_objects_v2(**kwargs)
+            for item in response.get('Contents', []):
+                keys.setdefault(item['Key'][len(prefix):], item['Key'])
+            if not response.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+    return sorted(keys.values())
+
+
+def plan(emails):
+    """(handbook, newsletters) to fold, as (key, attachment) pairs of the scanned emails.
+
+    handbook is the last handbook attachment by email date, None when no email has one.
+    newsletters are the newsletter attachments of that email and the later ones, in date order.
+    """
+    ordered = sorted(emails, key=lambda key: (emails[key]['date'], key))
+    handbook = None
+    newsletters = []
+    for key in ordered:
+        for attachment in emails[key]['attachments']:
+            if attachment['kind'] == 'handbook':
+                handbook = (key, attachment)
+                newsletters = []
+        newsletters.extend((key, attachment) for attachment in emails[key]['attachments']
+                           if attachment['kind'] == 'newsletter')
+    return handbook, newsletters
+
+
+def progress(state):
+    """Counts reported by each invocation."""
+    emails = state['emails'].values()
+    return {
+        'emails': len(state['emails']),
+        'extracted': sum(1 for email in emails if email.get('extracted')),
+        'failed': len(state['failed']),
+        'seconds': time.time() - state['started_at'],
+    }
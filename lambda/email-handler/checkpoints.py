@@ -0,0 +1,87 @@
+"""Stage checkpoints and processed markers keyed by the SHA-256 of an attachment's content.
+
+A retry of a failed email resumes each attachment at the first stage without a stored output,
+and an attachment whose content was already fully processed (including the knowledge base sync)
+is skipped, whatever email it arrives in. Processed markers are kept per kind of attachment, so
+the newsletter ones can be cleared when a handbook resets the newsletter.
+"""
+import json
+import logging
+import time
+
+logger = logging.getLogger()
+
+CHECKPOINT_PREFIX = 'checkpoints/'
+PROCESSED_PREFIX = 'processed/'
+
+
+class Checkpoint:
+    """Stored stage outputs of one attachment, with refresh every stage runs again and overwrites its output."""
+
+    def __init__(self, s3, bucket, digest, refresh=False):
+        self.s3 = s3
+        self.bucket = bucket
+        self.digest = digest
+        self.refresh = refresh
+        self.resumed = 0
+
+    def _key(self, stage):
+        return f"{CHECKPOINT_PREFIX}{self.digest}/{stage}.json"
+
+    def load(self, stage):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self._key(stage))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read().decode('utf-8'))['value']
+
+    def save(self, stage, value):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self._key(stage),
+            Body=json.dumps({'value': value, 'saved_at': time.time()}).encode('utf-8'),
+            ContentType='application/json'
+        )
+
+    def run(self, stage, function, *args, **kwargs):
+        """Output of the stage, from the checkpoint when an earlier attempt stored it."""
+        value = None if self.refresh else self.load(stage)
+        if value is not None:
+            logger.info(f"Resuming from the [{stage}] checkpoint of attachment [{self.digest[:12]}]")
+            self.resumed += 1
+            return value
+        value = function(*args, **kwargs)
+        self.save(stage, value)
+        return value
+
+
+def is_processed(s3, bucket, kind, digest):
+    try:
+        s3.get_object(Bucket=bucket, Key=f"{PROCESSED_PREFIX}{kind}/{digest}.json")
+    except s3.exceptions.NoSuchKey:
+        return False
+    return True
+
+
+def mark_processed(s3, bucket, kind, digest, message_id, file_name):
+    s3.put_object(
+        Bucket=bucket,
+        Key=f"{PROCESSED_PREFIX}{kind}/{digest}.json",
+        Body=json.dumps({'message_id': message_id, 'file_name': file_name, 'processed_at': time.time()}).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+
+def clear_processed(s3, bucket, kind):
+    """Delete the processed markers of a kind of attachment, returns how many were deleted."""
+    kwargs = {'Bucket': bucket, 'Prefix': f"{PROCESSED_PREFIX}{kind}/"}
+    cleared = 0
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        for item in response.get('Contents', []):
+            s3.delete_object(Bucket=bucket, Key=item['Key'])
+            cleared += 1
+        if not response.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+    return cleared
@@ -1,12 +1,27 @@
 import os
 import boto3
-import email
+import contextvars
 import json
+import threading
 import time
-from email import policy
+import datetime
+import email.utils
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from botocore.config import Config
+import backfill
+import checkpoints
+import ingestion
+import instrumentation
+import kb_documents
+from kb_layout import KB_VERSION_KEY
+import mime_stream
+import newsletter_store
+import pdf_text
+import textract_reader
+import vector_snapshot
 
 # Set up logging
 logger = logging.getLogger()
@@ -25,151 +40,161 @@ SOURCE_BUCKET = os.environ['SOURCE_BUCKET_NAME']
 DESTINATION_BUCKET = os.environ['DESTINATION_BUCKET_NAME']
 KNOWLEDGE_BASE_ID = os.environ['KNOWLEDGE_BASE_ID']
 DATA_SOURCE_ID = os.environ['DATA_SOURCE_ID']
+STATE_BUCKET = os.environ['STATE_BUCKET_NAME']
+LOCAL_INDEX_ENABLED = os.environ.get('LOCAL_INDEX_ENABLED', 'false').lower() == 'true'
 INCOMING_PREFIX = 'incoming/'
 ARCHIVE_PREFIX = 'archive/'
 ERROR_PREFIX = 'processing_errors/'
 MAX_RETRIES = int(os.environ['MAX_RETRIES'])
 ENABLE_LIFECYCLE_RULE = os.environ.get('ENABLE_LIFECYCLE_RULE', 'false').lower() == 'true'
+ARCHIVE_RETENTION_DAYS = int(os.environ.get('ARCHIVE_RETENTION_DAYS', '365'))
 HANDBOOK_FILE = "HANDBOOK - Students & Parents"
 NEWSLETTER_FILE = "Pencil It In"
+# Whole-document object of each source written before the documents were split into sections
+LEGACY_DOCUMENT_KEYS = {'handbook': f'{HANDBOOK_FILE}.pdf', 'newsletter': f'{NEWSLETTER_FILE}.txt'}
+NEWSLETTER_MARKER = "Pencil It In!"
+NEWSLETTER_MODEL_ID = os.environ.get('NEWSLETTER_MODEL_ID', 'anthropic.claude-3-sonnet-20240229-v1:0')
+NEWSLETTER_DATED_RETENTION_DAYS = int(os.environ.get('NEWSLETTER_DATED_RETENTION_DAYS', '7'))
+PDF_EXTRACTION = os.environ.get('PDF_EXTRACTION', 'auto').lower()  # 'auto' (text layer, Textract for scanned pages) or 'textract'
+TEXTRACT_POLL_INITIAL_SECONDS = float(os.environ.get('TEXTRACT_POLL_INITIAL_SECONDS', '1'))
+TEXTRACT_POLL_MAX_SECONDS = float(os.environ.get('TEXTRACT_POLL_MAX_SECONDS', '10'))
+# Set all three to wait on the Textract completion notification instead of polling
+TEXTRACT_NOTIFICATION_TOPIC_ARN = os.environ.get('TEXTRACT_NOTIFICATION_TOPIC_ARN')
+TEXTRACT_NOTIFICATION_ROLE_ARN = os.environ.get('TEXTRACT_NOTIFICATION_ROLE_ARN')
+TEXTRACT_NOTIFICATION_QUEUE_URL = os.environ.get('TEXTRACT_NOTIFICATION_QUEUE_URL') if TEXTRACT_NOTIFICATION_TOPIC_ARN and TEXTRACT_NOTIFICATION_ROLE_ARN else None
+# Attachments are decoded in memory up to this size, larger ones spill to /tmp
+ATTACHMENT_SPOOL_BYTES = int(os.environ.get('ATTACHMENT_SPOOL_MB', '8')) * 1024 * 1024
+EMAIL_READ_CHUNK_BYTES = 1024 * 1024
+ATTACHMENT_WORKERS = int(os.environ.get('ATTACHMENT_WORKERS', '2'))
+# Sync requests within this window of the first one share one ingestion job
+INGESTION_DEBOUNCE_SECONDS = float(os.environ.get('INGESTION_DEBOUNCE_SECONDS', '60'))
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', '8'))
+# A backfill starts no new email with less invocation time left than this and saves its progress
+BACKFILL_TIME_MARGIN_SECONDS = float(os.environ.get('BACKFILL_TIME_MARGIN_SECONDS', '180'))
+UPLOAD_CONFIG = TransferConfig(
+    multipart_threshold=int(os.environ.get('UPLOAD_PART_MB', '8')) * 1024 * 1024,
+    multipart_chunksize=int(os.environ.get('UPLOAD_PART_MB', '8')) * 1024 * 1024,
+    max_concurrency=int(os.environ.get('UPLOAD_CONCURRENCY', '4'))
+)
 
-def extract_latest_newsletter(pdf_key):
+textract_waiter = None
+# Newsletter store merges and writes of Pencil It In.txt happen one at a time
+newsletter_write_lock = threading.Lock()
+
+def upload_file(file, bucket, key):
+    """Upload a file object from its start, in multipart chunks when it is large."""
+    file.seek(0)
+    s3.upload_fileobj(file, bucket, key, Config=UPLOAD_CONFIG)
+
+@instrumentation.timed("TextExtraction")
+def extract_pdf_text(pdf_file, pdf_key, stop_marker=None):
+    """Text of the PDF one line per line, or only up to the second occurrence of stop_marker when it is given.
+
+    With PDF_EXTRACTION 'auto' the text layer is read in-process and only pages without one are
+    sent to Textract, otherwise the whole PDF is uploaded to pdf_key and sent to Textract.
+    """
+    if PDF_EXTRACTION == 'auto' and pdf_text.available():
+        try:
+            return extract_with_text_layer(pdf_file, pdf_key, stop_marker)
+        except Exception as e:
+            logger.warning(f"Text layer extraction failed, sending the whole PDF to Textract: {str(e)}")
+
+    logger.info(f"Saving the PDF in [{SOURCE_BUCKET}] at [{pdf_key}] for text extraction")
+    upload_file(pdf_file, SOURCE_BUCKET, pdf_key)
+    lines = []
+    markers_seen = 0
+    for _, line in textract_page_lines(pdf_key):
+        lines.append(line)
+        if stop_marker and stop_marker in line:
+            markers_seen += line.count(stop_marker)
+            if markers_seen >= 2:
+                # Everything after the second marker is older issues, the remaining pages are not requested
+                logger.info(f"Found the second [{stop_marker}] marker, skipping the remaining Textract pages")
+                break
+    return "\n".join(lines) + "\n" if lines else ""
+
+def extract_with_text_layer(pdf_file, pdf_key, stop_marker=None):
+    """Text layer of each page, with the pages that have none read by Textract and merged back in page order."""
+    logger.info(f"Reading the PDF text layer...")
+    pages = {}
+    ocr_pages = []
+    markers_seen = 0
+    for page_number, text, milliseconds in pdf_text.text_layer_pages(pdf_file):
+        if text is None:
+            logger.info(f"Page [{page_number}]: no text layer ([{milliseconds:.1f}] ms), queued for Textract")
+            ocr_pages.append(page_number)
+            continue
+        logger.info(f"Page [{page_number}]: text layer, [{len(text)}] characters in [{milliseconds:.1f}] ms")
+        pages[page_number] = [text]
+        if stop_marker:
+            markers_seen += text.count(stop_marker)
+            if markers_seen >= 2:
+                logger.info(f"Found the second [{stop_marker}] marker on page [{page_number}], skipping the remaining pages")
+                break
+
+    text_layer_pages = len(pages)
+    if ocr_pages:
+        # Only the scanned pages go to Textract, as a smaller PDF whose page N is ocr_pages[N - 1]
+        ocr_key = pdf_key[:-len(".pdf")] + "-ocr.pdf" if pdf_key.endswith(".pdf") else pdf_key + "-ocr"
+        logger.info(f"Saving [{len(ocr_pages)}] pages without a text layer in [{SOURCE_BUCKET}] at [{ocr_key}]")
+        with pdf_text.sub_document(pdf_file, ocr_pages, spool_bytes=ATTACHMENT_SPOOL_BYTES) as ocr_file:
+            upload_file(ocr_file, SOURCE_BUCKET, ocr_key)
+        started = time.perf_counter()
+        for ocr_page, line in textract_page_lines(ocr_key):
+            pages.setdefault(ocr_pages[ocr_page - 1], []).append(line)
+        logger.info(f"Pages {ocr_pages}: Textract OCR in [{(time.perf_counter() - started) * 1000:.1f}] ms")
+
+    trace = instrumentation.current_trace()
+    trace.record("TextLayerPages", text_layer_pages, "Count")
+    trace.record("OcrPages", len(ocr_pages), "Count")
+    lines = [line for page_number in sorted(pages) for line in pages[page_number]]
+    return "\n".join(lines) + "\n" if lines else ""
+
+def textract_page_lines(pdf_key):
+    """(page_number, text) of every LINE Textract detects in the PDF at pdf_key."""
     logger.info(f"Starting asynchronous text extraction from the PDF...")
-    # Start asynchronous job
-    textract_response = textract.start_document_text_detection(
-        DocumentLocation={
-            'S3Object': {
-                'Bucket': SOURCE_BUCKET,
-                'Name': pdf_key
-            }
-        }
+    detection = textract_reader.TextDetection(
+        textract,
+        waiter=get_textract_waiter(),
+        initial_delay=TEXTRACT_POLL_INITIAL_SECONDS,
+        max_delay=TEXTRACT_POLL_MAX_SECONDS
     )
-    job_id = textract_response['JobId']
-    logger.info(f"Started asynchronous Textract job with ID: {job_id}")
-
-    # Wait for the job to complete
-    while True:
-        textract_response = textract.get_document_text_detection(JobId=job_id)
-        status = textract_response['JobStatus']
-        logger.info(f"Job status: {status}")
-        if status in ['SUCCEEDED', 'FAILED']:
-            break
-        time.sleep(10)  # Wait for 5 seconds before checking again
-
-    if status == 'FAILED':
-        logger.error("Textract job failed")
-        raise Exception("Textract job failed")
-
-    logger.info(f"Textract job with ID: {job_id} complete!")
-    # Extract text from the job results
-    full_text = ""
-    pages = textract_response['Blocks']
-    while True:
-        for item in pages:
-            if item['BlockType'] == 'LINE':
-                full_text += item['Text'] + " "
-        
-        if 'NextToken' not in textract_response:
-            break
-        
-        textract_response = textract.get_document_text_detection(JobId=job_id, NextToken=textract_response['NextToken'])
-        pages = textract_response['Blocks']
+    detection.start(SOURCE_BUCKET, pdf_key)
+    try:
+        yield from detection.page_lines()
+    finally:
+        logger.info(f"Read [{detection.result_pages}] Textract result pages after [{detection.polls}] status checks")
+
+def get_textract_waiter():
+    """Notification queue waiter when Textract notifications are configured, None to poll."""
+    global textract_waiter
+    if textract_waiter is None and TEXTRACT_NOTIFICATION_QUEUE_URL:
+        textract_waiter = textract_reader.QueueWaiter(
+            boto3.client('sqs'),
+            TEXTRACT_NOTIFICATION_QUEUE_URL,
+            TEXTRACT_NOTIFICATION_TOPIC_ARN,
+            TEXTRACT_NOTIFICATION_ROLE_ARN
+        )
+    return textract_waiter
+
+def extract_latest_newsletter(pdf_file, pdf_key):
+    full_text = extract_pdf_text(pdf_file, pdf_key, stop_marker=NEWSLETTER_MARKER)
     logger.info(f"Extracting latest newsletter from text...")
-    newsletters = full_text.split("Pencil It In!")
+    newsletters = full_text.split(NEWSLETTER_MARKER)
     if len(newsletters) > 1:
         logger.info(f"Retreived latest newsletter")
-        return "Pencil It In!" + newsletters[1]
+        return NEWSLETTER_MARKER + newsletters[1]
     logger.info(f"Returning full text")
     return full_text
 
-def generate_summary_xml(previous_summary_content, latest_newsletter):
-    prompt = f"""
-    <prompt>
-        <task>
-            You are an AI assistant tasked with summarizing and cleaning school newsletter data. 
-            Your goal is to create an up-to-date compilation of all information, particularly focusing on events, important dates, policies, and announcements. This compilation will be used as a knowledge base for a chat assistant that will answer queries from parents and students about the day-to-day activities of the school.
-        </task>
-        <instructions>
-            <step>Keep the length of the output under 1500 words.</step>
-            <step>If needed, remove older information from previous summary to stay under 1500 word limit.</step>
-            <step>Read through the newsletter content and the previous summary chronologically.</step>
-            <step>Update the summary with new information from the current newsletter.</step>
-            <step>Keep the summary concise, and focus more on the recent newsletter.</step>
-            <step>Retain all the relevant information from the previous summary that is still applicable.</step>
-
-            <step>
-            Extract and organize all information into the following categories:
-            <categories>
-                <category>School Policies and Procedures</category>
-                <category>Academic Information</category>
-                <category>Upcoming Events (sorted chronologically)</category>
-                <category>Extracurricular Activities</category>
-                <category>Important Announcements</category>
-            </categories>
-            </step>
-
-            <step>
-            For each piece of information:
-            <sub-step>Retain specific dates, times, and locations whenever mentioned.</sub-step>
-            <sub-step>If information is updated in later newsletters, use the most recent version.</sub-step>
-            </step>
-
-            <step>
-            For each School Policy and Procedure:
-            <sub-step>Summarize the full content of the policy details in a sentence, not just the title.</sub-step>
-            <sub-step>Provide any specific rules, guidelines, or procedures mentioned.</sub-step>
-            <sub-step>Include any exceptions or special circumstances related to the policy.</sub-step>
-            </step>
-
-            <step>
-            For each Important Announcement:
-            <sub-step>Summarize the full content of the announcement, not just the heading.</sub-step>
-            <sub-step>Provide all details, context, and implications of the announcement.</sub-step>
-            <sub-step>Include any action items or responses required from students or parents.</sub-step>
-            </step>
-            
-            <step>
-            For events:
-            <sub-step>List all events chronologically, including past events from the current school year.</sub-step>
-            <sub-step>Include the most up-to-date details (date, time, location, description).</sub-step>
-            <sub-step>Retain information about recurring events or series.</sub-step>
-            <sub-step>When there are multiple dates for an event, keep track of all the dates for the event in a list chronologically.</sub-step>
-            </step>
-
-            <step>Maintain all numerical data, statistics, and specific figures mentioned.</step>
-
-            <step>Preserve mentions of individuals, roles, and responsibilities.</step>
-
-            <step>Keep track of all forms, documents, and resources mentioned, including their purposes and links if provided.</step>
-
-            <step>Retain information about external organizations, partnerships, or visitors to the school.</step>
-
-            <step>
-            After creating the compilation:
-            <sub-step>Review for any remaining redundancies or contradictions.</sub-step>
-            <sub-step>Ensure all information is present in concise manner.</sub-step>
-            <sub-step>Format the final compilation for easy readability, using headers, subheaders, and bullet points as necessary.</sub-step>
-            </step>
-        </instructions>
-
-        <input>
-            Current Newsletter Content:
-            {latest_newsletter}
-            Previous Summary XML:
-            {previous_summary_content}
-        </input>
-        
-        <output_request>
-            Please provide an updated, comprehensive, chronological compilation of all events, policies, procedures, and important information based on these instructions in less than 1500 words. Use XML tags to structure your response. Ensure that full details of policies, procedures, and announcements are included, not just titles or headings.
-        </output_request>
-    </prompt>
-    """
-    
+@instrumentation.timed("ItemExtraction")
+def extract_newsletter_items(latest_newsletter, issue_date):
+    """Events, policies, announcements and activities of one newsletter issue, extracted by the model."""
+    prompt = newsletter_store.EXTRACTION_PROMPT.format(issue_date=issue_date.isoformat(), newsletter=latest_newsletter)
     native_request = {
         "anthropic_version": "bedrock-2023-05-31",
         "max_tokens": 4000,
-        "temperature": 0.1,
-        "top_p": 0.9,
+        "temperature": 0,
         "messages": [
             {
                 "role": "user",
@@ -177,38 +202,44 @@ def generate_summary_xml(previous_summary_content, latest_newsletter):
             }
         ],
     }
-    logger.info(f"Asking Bedrock to generate summary...")
+    logger.info(f"Asking Bedrock to extract the newsletter items...")
     claude_response = bedrock_runtime.invoke_model(
-        modelId='anthropic.claude-3-sonnet-20240229-v1:0',
+        modelId=NEWSLETTER_MODEL_ID,
         body=json.dumps(native_request)
     )
     json_response = json.loads(claude_response['body'].read())
-    claude_response_list = json_response['content']
-    summary = ""
-    for item in claude_response_list:
-        summary = summary + "\n" + item['text']
-    logger.info(f"Received response from  Bedrock!")
-    return summary
-
-def process_newsletter(pdf_content, message_id, file_name_key):
+    output = "".join(item['text'] for item in json_response['content'] if item.get('type', 'text') == 'text')
+    items = newsletter_store.parse_items(output)
+    logger.info(f"Received [{len(items)}] newsletter items from Bedrock!")
+    return items
+
+def process_newsletter(pdf_file, message_id, issue_date, checkpoint):
+    """Items of the latest issue in the newsletter PDF, the extracted text and items are checkpointed."""
     pdf_key = f"newsletters/{message_id}.pdf"
-    logger.info(f"Savinig the Newsletter PDF in [{SOURCE_BUCKET}] at [{pdf_key}]")
-    s3.put_object(Bucket=SOURCE_BUCKET, Key=pdf_key, Body=pdf_content)
-    
-    latest_newsletter = extract_latest_newsletter(pdf_key)
+    latest_newsletter = checkpoint.run('text', extract_latest_newsletter, pdf_file, pdf_key)
     logger.info(f"Extracted the latest newsletter from PDF!")
-    
-    logger.info(f"Retrieving the previous summary XML from S3")
-    try:
-        previous_summary = s3.get_object(Bucket=DESTINATION_BUCKET, Key=file_name_key)
-        previous_summary_content = previous_summary['Body'].read().decode('utf-8')
-        logger.info(f"Retrieved previous summary from S3")
-    except s3.exceptions.NoSuchKey:
-        previous_summary_content = "<summary></summary>"
-        logger.info(f"No previous summary found, starting fresh")
+    return checkpoint.run('items', extract_newsletter_items, latest_newsletter, issue_date)
+
+def merge_newsletter(items, message_id, issue_date):
+    """Merge one issue into the newsletter store and return the store.
 
-    summary = generate_summary_xml(previous_summary_content, latest_newsletter)
-    return summary
+    Merging the same issue again changes nothing. Call with newsletter_write_lock held.
+    """
+    store = newsletter_store.load(s3, STATE_BUCKET)
+    added, updated, expired = newsletter_store.merge(
+        store, items, message_id, issue_date, dated_retention_days=NEWSLETTER_DATED_RETENTION_DAYS
+    )
+    logger.info(f"Newsletter store: [{added}] items added, [{updated}] updated, [{expired}] items expired, "
+                f"[{len(store['items'])}] items from [{len(store['issues'])}] issues")
+    newsletter_store.save(s3, STATE_BUCKET, store)
+    return store
+
+def email_date(headers):
+    """Date the email was sent, today when the header is missing or malformed."""
+    try:
+        return email.utils.parsedate_to_datetime(headers['Date']).date()
+    except (TypeError, ValueError):
+        return datetime.date.today()
 
 def process_email(message_id, retry_count):
     """Process a single email."""    
@@ -217,54 +248,52 @@ def process_email(message_id, retry_count):
         # Retrieve the email from S3
         logger.info(f"Retreiving object [{message_key}] from [{SOURCE_BUCKET}]...")
         s3_object = s3.get_object(Bucket=SOURCE_BUCKET, Key=message_key)
-        email_body = s3_object['Body'].read().decode('utf-8')
         logger.info(f"Parsing the email...")
-        msg = email.message_from_string(email_body, policy=policy.default)
-        attachments_added = False
-        
-        # Process attachments
-        for part in msg.walk():
-            if part.get_content_maintype() == 'multipart':
-                continue
-            if part.get('Content-Disposition') is None:
-                continue
-            
-            file_name = part.get_filename()
-            if file_name:
-                logger.info(f"E-mail contains attachment with name [{file_name}]")
-                # Upload attachment to destination S3 bucket
-                file_name_key=file_name
-                attachments_added = False
-                if HANDBOOK_FILE in file_name:
-                    file_name_key = f'{HANDBOOK_FILE}.pdf'
-                    s3.put_object(
-                        Bucket=DESTINATION_BUCKET,
-                        Key=file_name_key,
-                        Body=part.get_payload(decode=True)
-                    )
-                    logger.info(f"Uploaded attachment: [{file_name}] to bucket: [{DESTINATION_BUCKET}] with name: [{file_name_key}]")
-                    logger.info(f"Deleting the newsletter summary from the data source...")
-                    s3.delete_object(Bucket=DESTINATION_BUCKET, Key=f'{NEWSLETTER_FILE}.txt')
-                    logger.info(f"Successfully deleted file {NEWSLETTER_FILE}.txt from {DESTINATION_BUCKET}.")
-                    attachments_added = True
-                elif NEWSLETTER_FILE in file_name:
-                    file_name_key = f'{NEWSLETTER_FILE}.txt'
-                    pdf_content = part.get_payload(decode=True)
-                    claude_response = process_newsletter(pdf_content, message_id, file_name_key)
-                    s3.put_object(
-                        Bucket=DESTINATION_BUCKET,
-                        Key=file_name_key,
-                        Body=claude_response.encode('utf-8'),
+        # The body is parsed as it is read, attachments are spooled to /tmp when large
+        msg = mime_stream.MessageStream(
+            mime_stream.read_chunks(s3_object['Body'], EMAIL_READ_CHUNK_BYTES), spool_bytes=ATTACHMENT_SPOOL_BYTES
+        )
+        issue_date = email_date(msg.headers)
+        attachments = []
+        handbook_resets = {}
+        try:
+            for attachment in msg.attachments():
+                logger.info(f"E-mail contains attachment with name [{attachment.file_name}]")
+                if HANDBOOK_FILE not in attachment.file_name and NEWSLETTER_FILE not in attachment.file_name:
+                    logger.info(f"Received attachment [{attachment.file_name}], ignoring...")
+                    attachment.close()
+                    continue
+                logger.info(f"Decoded attachment [{attachment.file_name}], [{attachment.size}] bytes")
+                attachments.append(attachment)
+                if HANDBOOK_FILE in attachment.file_name:
+                    # Set once this handbook has reset the newsletter document, newsletter writes wait for it
+                    handbook_resets[attachment] = threading.Event()
+            # Handbooks are queued first so a newsletter waiting on them never holds the only worker
+            attachments.sort(key=lambda attachment: attachment not in handbook_resets)
+
+            # The spooled attachments are processed concurrently, each worker carries the request's trace
+            with ThreadPoolExecutor(max_workers=max(1, min(ATTACHMENT_WORKERS, len(attachments)))) as executor:
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run, process_attachment, attachment, message_id, issue_date,
+                        [handbook_resets[attachment]] if attachment in handbook_resets else list(handbook_resets.values())
                     )
-                    logger.info(f"Uploaded attachment: [{file_name}] to bucket: [{DESTINATION_BUCKET}] with name: [{file_name_key}]")
-                    attachments_added = True
-                else:
-                    logger.info(f"Received attachment [{file_name}], ignoring...")
+                    for attachment in attachments
+                ]
+                processed = [future.result() for future in futures]
+        finally:
+            for attachment in attachments:
+                attachment.close()
+        processed = [result for result in processed if result]
         
-        # Sync knowledge base if attachments were added
-        if attachments_added:
+        # Sync knowledge base once if the attachments changed any of its documents
+        if any(changed for _, _, changed in processed):
             logger.info(f"Synching Knowledge Base now...")
             sync_knowledge_base()
+
+        # Only once the knowledge base sync has been requested is an attachment skipped when it arrives again
+        for digest, file_name, _ in processed:
+            checkpoints.mark_processed(s3, STATE_BUCKET, attachment_kind(file_name), digest, message_id, file_name)
         
         # Move the original email to the archive prefix
         archive_key = f"{ARCHIVE_PREFIX}{message_id}"
@@ -293,34 +322,394 @@ def process_email(message_id, retry_count):
             logger.exception(f"Error moving problematic email: {str(copy_error)}")
         raise
 
-def sync_knowledge_base():
-    """Sync the knowledge base."""
+def process_attachment(attachment, message_id, issue_date, handbook_resets):
+    """Fold a handbook or newsletter into the knowledge base documents, returns (digest, file_name, changed) once done.
+
+    A handbook sets its event in handbook_resets once the newsletter documents are reset (or it failed),
+    a newsletter waits for all the handbook events of its email before writing. changed tells whether
+    any knowledge base document was written or deleted. Returns None when an attachment with the same
+    content was already processed.
+    """
+    file_name = attachment.file_name
+    digest = attachment.sha256
     try:
-        logger.info(f"Starting Bedrock Ingestion Job for Knowledge Base [{KNOWLEDGE_BASE_ID}], Data Source: [{DATA_SOURCE_ID}]...")
-        response = bedrock.start_ingestion_job(
-            knowledgeBaseId=KNOWLEDGE_BASE_ID,
-            dataSourceId=DATA_SOURCE_ID
+        if checkpoints.is_processed(s3, STATE_BUCKET, attachment_kind(file_name), digest):
+            logger.info(f"Attachment [{file_name}] with hash [{digest[:12]}] was already processed, skipping")
+            instrumentation.current_trace().record("SkippedAttachments", 1, "Count")
+            return None
+        checkpoint = checkpoints.Checkpoint(s3, STATE_BUCKET, digest)
+        if HANDBOOK_FILE in file_name:
+            changed = process_handbook(attachment.file, message_id, checkpoint, handbook_resets[0])
+        else:
+            items = process_newsletter(attachment.file, message_id, issue_date, checkpoint)
+            # A handbook in the same email resets the newsletter documents first, this issue is then merged into the empty store
+            for handbook_reset in handbook_resets:
+                handbook_reset.wait()
+            with newsletter_write_lock:
+                changed = write_newsletter(items, message_id, issue_date)
+        instrumentation.current_trace().record("ResumedStages", checkpoint.resumed, "Count")
+        return digest, file_name, changed
+    finally:
+        if HANDBOOK_FILE in file_name:
+            handbook_resets[0].set()
+
+def write_documents(source, heading, sections):
+    """Sync the section documents of a source, True when any was written or deleted."""
+    written, unchanged, deleted = kb_documents.sync(s3, DESTINATION_BUCKET, source, heading, sections)
+    trace = instrumentation.current_trace()
+    trace.record("SectionsWritten", written, "Count")
+    trace.record("SectionsUnchanged", unchanged, "Count")
+    trace.record("SectionsDeleted", deleted, "Count")
+    return bool(written or deleted)
+
+def delete_legacy_document(source):
+    s3.delete_object(Bucket=DESTINATION_BUCKET, Key=LEGACY_DOCUMENT_KEYS[source])
+
+def process_handbook(pdf_file, message_id, checkpoint, handbook_reset):
+    """Reset the newsletter documents the handbook supersedes, set handbook_reset, then write the handbook sections."""
+    logger.info(f"Deleting the newsletter documents from the data source...")
+    changed = write_documents('newsletter', newsletter_store.HEADING, [])
+    newsletter_store.reset(s3, STATE_BUCKET)
+    # A newsletter processed before the reset is folded into the new store when it is sent again
+    cleared = checkpoints.clear_processed(s3, STATE_BUCKET, 'newsletter')
+    logger.info(f"Cleared the processed markers of [{cleared}] newsletters")
+    if LOCAL_INDEX_ENABLED:
+        vector_snapshot.delete_source_snapshot(s3, STATE_BUCKET, 'newsletter')
+    delete_legacy_document('newsletter')
+    logger.info(f"Successfully deleted the newsletter documents from {DESTINATION_BUCKET}.")
+    handbook_reset.set()
+
+    pdf_key = f"handbooks/{message_id}.pdf"
+    handbook_text = checkpoint.run('text', extract_pdf_text, pdf_file, pdf_key)
+    return write_handbook(handbook_text) or changed
+
+def write_handbook(handbook_text):
+    """Write the sections of the handbook text, True when any document was written or deleted.
+
+    Raises ValueError when the text has no sections (nothing was extracted), the current handbook
+    documents are then left in place.
+    """
+    sections = [kb_documents.Section(title, body)
+                for title, body in kb_documents.split_sections(handbook_text, HANDBOOK_FILE)]
+    if not sections:
+        raise ValueError("No text was extracted from the handbook, keeping the current handbook documents")
+    logger.info(f"Split the handbook into [{len(sections)}] sections")
+    changed = write_documents('handbook', HANDBOOK_FILE, sections)
+    # The whole-document handbook is only replaced once its sections are written
+    delete_legacy_document('handbook')
+    if LOCAL_INDEX_ENABLED:
+        vector_snapshot.write_source_snapshot(
+            s3, bedrock_runtime, STATE_BUCKET, 'handbook', handbook_text,
+            f"s3://{DESTINATION_BUCKET}/{kb_documents.DOCUMENTS_PREFIX}handbook/"
+        )
+    return changed
+
+def write_newsletter(items, message_id, issue_date):
+    """Merge the issue and write the newsletter sections, call with newsletter_write_lock held."""
+    store = merge_newsletter(items, message_id, issue_date)
+    return write_newsletter_documents(store)
+
+def write_newsletter_documents(store):
+    """Write the section of each category of the store, True when any document was written or deleted."""
+    sections = [
+        kb_documents.Section(
+            heading, "\n".join(newsletter_store.render_items(category_items)),
+            # The issue that brought the newest item of the section, re-mentioned items leave it unchanged
+            {'issue_date': max(item['first_seen'] for item in category_items)}
         )
-        logger.info(f"Started knowledge base sync: {response['ingestionJob']['ingestionJobId']}")
+        for heading, category_items in newsletter_store.category_items(store)
+    ]
+    changed = write_documents('newsletter', newsletter_store.HEADING, sections)
+    if LOCAL_INDEX_ENABLED and changed:
+        vector_snapshot.write_source_snapshot(
+            s3, bedrock_runtime, STATE_BUCKET, 'newsletter', newsletter_store.render(store),
+            f"s3://{DESTINATION_BUCKET}/{kb_documents.DOCUMENTS_PREFIX}newsletter/"
+        )
+    return changed
+
+@instrumentation.timed("KnowledgeBaseSync")
+def sync_knowledge_base():
+    """Request a sync of the knowledge base, the ingestion scheduler coalesces it with other requests."""
+    try:
+        logger.info(f"Requesting a sync of Knowledge Base [{KNOWLEDGE_BASE_ID}], Data Source: [{DATA_SOURCE_ID}]...")
+        status = ingestion_scheduler.request()
+        logger.info(f"Knowledge base sync requested, ingestion is [{status}]")
     except ClientError as e:
         logger.exception(f"Error syncing knowledge base: {str(e)}")
 
+def ingestion_completed(job_id, record):
+    """Publish the new knowledge base version once its ingestion job has completed."""
+    trace = instrumentation.current_trace()
+    trace.record("IngestionSeconds", record['duration_seconds'] or 0, "Seconds")
+    trace.record("DocumentsScanned", record['scanned'], "Count")
+    trace.record("DocumentsChanged", record['new'] + record['modified'] + record['deleted'], "Count")
+    trace.record("DocumentsFailed", record['failed'], "Count")
+    if record['freshness_seconds'] is not None:
+        trace.record("FreshnessSeconds", record['freshness_seconds'], "Seconds")
+    if record['status'] != 'COMPLETE':
+        logger.error(f"Ingestion job [{job_id}] ended with status [{record['status']}]: {record['failure_reasons']}")
+        return
+    publish_kb_version(job_id, record)
+    if LOCAL_INDEX_ENABLED:
+        vector_snapshot.write_manifest(s3, STATE_BUCKET, job_id, written_before=record['claimed_at'])
+
+def publish_kb_version(version, ingestion_record=None):
+    """Record a new knowledge base version so answers cached for the old content are no longer served."""
+    s3.put_object(
+        Bucket=STATE_BUCKET,
+        Key=KB_VERSION_KEY,
+        Body=json.dumps({'version': version, 'updated_at': time.time(), 'ingestion': ingestion_record}).encode('utf-8'),
+        ContentType='application/json'
+    )
+    logger.info(f"Published knowledge base version [{version}] to [{STATE_BUCKET}]")
+
+ingestion_scheduler = ingestion.IngestionScheduler(
+    bedrock, s3, STATE_BUCKET, KNOWLEDGE_BASE_ID, DATA_SOURCE_ID,
+    debounce_seconds=INGESTION_DEBOUNCE_SECONDS,
+    on_complete=ingestion_completed
+)
+
+def check_ingestion():
+    """Scheduled run: start a due ingestion job, or record the running one once it has finished."""
+    trace = instrumentation.start_trace("email-handler")
+    try:
+        status = ingestion_scheduler.tick()
+    finally:
+        trace.emit()
+    logger.info(f"Ingestion is [{status}]")
+    return {
+        'statusCode': 200,
+        'body': f'Ingestion {status}'
+    }
+
+def attachment_kind(file_name):
+    if HANDBOOK_FILE in file_name:
+        return 'handbook'
+    if NEWSLETTER_FILE in file_name:
+        return 'newsletter'
+    return None
+
+def read_stored_email(key):
+    s3_object = s3.get_object(Bucket=SOURCE_BUCKET, Key=key)
+    return mime_stream.MessageStream(
+        mime_stream.read_chunks(s3_object['Body'], EMAIL_READ_CHUNK_BYTES), spool_bytes=ATTACHMENT_SPOOL_BYTES
+    )
+
+def message_id_of(key):
+    return key.split('/', 1)[1]
+
+def scan_email(key):
+    """Date of a stored email and the kind, name and content hash of its handbook and newsletter attachments."""
+    msg = read_stored_email(key)
+    attachments = []
+    for attachment in msg.attachments():
+        with attachment:
+            kind = attachment_kind(attachment.file_name)
+            if kind:
+                attachments.append({'kind': kind, 'file_name': attachment.file_name, 'digest': attachment.sha256})
+    return {'message_id': message_id_of(key), 'date': email_date(msg.headers).isoformat(), 'attachments': attachments}
+
+def extract_email(key, record, digests, refresh):
+    """Run the extraction stages of the attachments of a stored email whose hash is in digests.
+
+    The outputs are kept in the attachment checkpoints. The email is only read when a stage has
+    no stored output, or always with refresh.
+    """
+    wanted = [attachment for attachment in record['attachments'] if attachment['digest'] in digests]
+    if not refresh and all(
+        checkpoints.Checkpoint(s3, STATE_BUCKET, attachment['digest']).load(backfill.FOLD_STAGES[attachment['kind']]) is not None
+        for attachment in wanted
+    ):
+        return
+    message_id = record['message_id']
+    issue_date = datetime.date.fromisoformat(record['date'])
+    for attachment in read_stored_email(key).attachments():
+        with attachment:
+            if attachment.sha256 not in digests:
+                continue
+            checkpoint = checkpoints.Checkpoint(s3, STATE_BUCKET, attachment.sha256, refresh=refresh)
+            if attachment_kind(attachment.file_name) == 'handbook':
+                checkpoint.run('text', extract_pdf_text, attachment.file, f"handbooks/{message_id}.pdf")
+            else:
+                process_newsletter(attachment.file, message_id, issue_date, checkpoint)
+
+def run_backfill_stage(stage, keys, function, state, out_of_time):
+    """Run function(key) for the keys in the worker pool, saving the state as each one completes.
+
+    function returns the update of the key's record, a key that fails is recorded in state['failed'].
+    Returns the number of keys not started because the invocation ran out of time.
+    """
+    lock = threading.Lock()
+    counts = {'completed': 0, 'skipped': 0}
+
+    def run(key):
+        if out_of_time():
+            with lock:
+                counts['skipped'] += 1
+            return
+        try:
+            update = function(key)
+        except Exception as e:
+            logger.exception(f"Backfill {stage} of [{key}] failed: {str(e)}")
+            update = None
+            error = f"{stage}: {str(e)}"
+        with lock:
+            if update is None:
+                state['failed'][key] = error
+            else:
+                state['emails'].setdefault(key, {}).update(update)
+                state['failed'].pop(key, None)
+            counts['completed'] += 1
+            backfill.save_state(s3, STATE_BUCKET, state)
+            logger.info(f"Backfill {stage}: [{counts['completed']}/{len(keys)}] emails")
+
+    # Each worker carries the invocation's trace
+    with ThreadPoolExecutor(max_workers=max(1, min(BACKFILL_WORKERS, len(keys)))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run, key) for key in keys]
+        for future in futures:
+            future.result()
+    return counts['skipped']
+
+def rebuild_knowledge_base(options, context):
+    """Rebuild the handbook and newsletter documents from the archived emails and start one ingestion.
+
+    options: include_errors also reads processing_errors/, refresh runs the extraction stages
+    again instead of using their checkpoints (after a prompt change), restart drops the progress of
+    an unfinished run and skip_failed folds without the emails that failed. An invocation that
+    runs out of time returns 202 with its progress, the next one continues from there.
+    """
+    prefixes = [ARCHIVE_PREFIX] + ([ERROR_PREFIX] if options.get('include_errors') else [])
+    refresh = bool(options.get('refresh'))
+    state = backfill.load_state(s3, STATE_BUCKET)
+    if (state is None or state['completed_at'] or options.get('restart')
+            or state['prefixes'] != prefixes or state['refresh'] != refresh):
+        state = backfill.new_state(prefixes, refresh)
+    else:
+        logger.info(f"Resuming the backfill started at [{state['started_at']}]")
+
+    def out_of_time():
+        return context is not None and context.get_remaining_time_in_millis() < BACKFILL_TIME_MARGIN_SECONDS * 1000
+
+    keys = backfill.list_emails(s3, SOURCE_BUCKET, prefixes)
+    if not keys:
+        logger.warning(f"No stored emails under {prefixes}, leaving the documents as they are")
+        return 'empty', state
+    # Emails deleted since the last invocation (by the lifecycle rule) are forgotten
+    state['emails'] = {key: record for key, record in state['emails'].items() if key in set(keys)}
+    state['failed'] = {key: error for key, error in state['failed'].items() if key in set(keys)}
+    logger.info(f"Backfill of [{len(keys)}] emails, [{len(state['emails'])}] already scanned")
+    skipped = run_backfill_stage(
+        'scan', [key for key in keys if key not in state['emails']], scan_email, state, out_of_time
+    )
+
+    handbook, newsletters = backfill.plan(state['emails'])
+    if handbook is None:
+        if skipped:
+            logger.info(f"Backfill stopped with [{skipped}] emails left to scan, invoke it again to continue")
+            return 'incomplete', state
+        # The newsletter store is only rebuilt from a handbook on, without one it would lose the current issues
+        logger.warning(f"No stored email under {prefixes} has a handbook, leaving the documents as they are")
+        return 'no_handbook', state
+    digests = {}
+    for key, attachment in [handbook] + newsletters:
+        digests.setdefault(key, set()).add(attachment['digest'])
+    logger.info(f"Folding one handbook and [{len(newsletters)}] newsletters from [{len(digests)}] emails")
+
+    def extract(key):
+        extract_email(key, state['emails'][key], digests[key], refresh)
+        return {'extracted': True}
+    skipped += run_backfill_stage(
+        'extraction', [key for key in sorted(digests) if not state['emails'][key].get('extracted')],
+        extract, state, out_of_time
+    )
+    if skipped:
+        logger.info(f"Backfill stopped with [{skipped}] emails left, invoke it again to continue")
+        return 'incomplete', state
+    if state['failed']:
+        if not options.get('skip_failed'):
+            logger.error(f"Backfill of [{len(state['failed'])}] emails failed: {state['failed']}")
+            return 'failed', state
+        if handbook[0] in state['failed']:
+            logger.error(f"The email of the handbook [{handbook[0]}] failed, the newsletters are not folded without it")
+            return 'failed', state
+        logger.warning(f"Folding without the [{len(state['failed'])}] emails that failed")
+        newsletters = [(key, attachment) for key, attachment in newsletters if key not in state['failed']]
+
+    fold_backfill(state, handbook, newsletters)
+    state['completed_at'] = time.time()
+    backfill.save_state(s3, STATE_BUCKET, state)
+    return 'complete', state
+
+def fold_backfill(state, handbook, newsletters):
+    """Write the handbook and the newsletters from it on merged in date order, then request one ingestion."""
+    key, attachment = handbook
+    handbook_text = checkpoints.Checkpoint(s3, STATE_BUCKET, attachment['digest']).load('text')
+    changed = write_handbook(handbook_text)
+    # The store is rebuilt from the handbook on, like the reset of a handbook email
+    delete_legacy_document('newsletter')
+    store = newsletter_store.empty_store()
+    for key, attachment in newsletters:
+        record = state['emails'][key]
+        items = checkpoints.Checkpoint(s3, STATE_BUCKET, attachment['digest']).load('items')
+        newsletter_store.merge(store, items, record['message_id'], datetime.date.fromisoformat(record['date']),
+                               dated_retention_days=NEWSLETTER_DATED_RETENTION_DAYS)
+    logger.info(f"Newsletter store rebuilt with [{len(store['items'])}] items from [{len(store['issues'])}] issues")
+    with newsletter_write_lock:
+        newsletter_store.save(s3, STATE_BUCKET, store)
+        changed = write_newsletter_documents(store) or changed
+
+    if changed:
+        logger.info(f"Synching Knowledge Base now...")
+        sync_knowledge_base()
+    # A folded attachment sent again later is skipped like any processed one, a newsletter left out of the store is not
+    checkpoints.clear_processed(s3, STATE_BUCKET, 'newsletter')
+    for key, attachment in [handbook] + newsletters:
+        checkpoints.mark_processed(s3, STATE_BUCKET, attachment['kind'], attachment['digest'],
+                                   state['emails'][key]['message_id'], attachment['file_name'])
+
+def run_backfill(options, context):
+    trace = instrumentation.start_trace("email-handler", "backfill")
+    try:
+        with trace.timer("Backfill"):
+            status, state = rebuild_knowledge_base(options, context)
+        counts = backfill.progress(state)
+        trace.record("BackfillEmails", counts['emails'], "Count")
+        trace.record("BackfillExtracted", counts['extracted'], "Count")
+        trace.record("BackfillFailed", counts['failed'], "Count")
+    finally:
+        trace.emit()
+    logger.info(f"Backfill is [{status}]: {counts}")
+    return {
+        'statusCode': {'complete': 200, 'empty': 200, 'incomplete': 202, 'no_handbook': 409}.get(status, 500),
+        'body': json.dumps(dict(counts, status=status, failed_emails=state['failed']))
+    }
+
 def lambda_handler(event, context):
+    if event.get('source') == 'aws.events':
+        return check_ingestion()
+    if 'backfill' in event:
+        return run_backfill(event['backfill'], context)
     # Get the email data from the SES event
     ses_notification = event['Records'][0]['ses']
     message_id = ses_notification['mail']['messageId']
     logger.info(f"Received email with Message ID: [{message_id}]")
+    trace = instrumentation.start_trace("email-handler", message_id)
     retry_count = 0
-    while retry_count < MAX_RETRIES:
-        try:
-            process_email(message_id, retry_count)
-            return {
-                'statusCode': 200,
-                'body': 'Email processed successfully'
-            }
-        except Exception as e:
-            retry_count += 1
-            logger.warning(f"Attempt {retry_count} failed. Retrying... Error: {str(e)}")
+    try:
+        while retry_count < MAX_RETRIES:
+            try:
+                with trace.timer("ProcessEmail"):
+                    process_email(message_id, retry_count)
+                trace.record("Attempts", retry_count + 1, "Count")
+                return {
+                    'statusCode': 200,
+                    'body': 'Email processed successfully'
+                }
+            except Exception as e:
+                retry_count += 1
+                logger.warning(f"Attempt {retry_count} failed. Retrying... Error: {str(e)}")
+    finally:
+        trace.emit()
     
     logger.error(f"Failed to process email after {MAX_RETRIES} attempts")
     return {
@@ -343,7 +732,7 @@ def setup_s3_lifecycle_rule(enable=False):
                         'ID': 'Delete archived emails',
                         'Status': 'Enabled',
                         'Prefix': ARCHIVE_PREFIX,
-                        'Expiration': {'Days': 7}  # Adjust the number of days as needed
+                        'Expiration': {'Days': ARCHIVE_RETENTION_DAYS}  # The emails a backfill can rebuild from
                     },
                     {
                         'ID': 'Delete error emails',
@@ -0,0 +1,196 @@
+"""Coalesced knowledge base ingestion jobs, tracked until they finish.
+
+request() only marks the data source as pending in a small state object in the state bucket. A job
+is started once the first pending request is debounce_seconds old and no job is running, so a burst
+of emails leads to one ingestion, and requests arriving while a job runs lead to exactly one
+follow-up job. tick() runs after every request and on a schedule: it checks the running job, keeps
+its statistics and calls on_complete(job_id, record) when it completes.
+
+The state object is written with If-Match on its ETag, so concurrent invocations do not lose a
+request or start the same job twice.
+"""
+import json
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+STATE_KEY = 'ingestion/state.json'
+RUNNING_STATUSES = ('STARTING', 'IN_PROGRESS', 'STOPPING')
+HISTORY_LENGTH = 20
+# A claimed start that never recorded its job ID (the invocation died) is released after this
+CLAIM_TIMEOUT_SECONDS = 300
+MAX_WRITE_ATTEMPTS = 5
+
+
+def empty_state():
+    return {'pending': False, 'requested_at': None, 'requests': 0, 'job': None, 'history': []}
+
+
+def job_record(ingestion_job):
+    """Statistics of a finished get_ingestion_job result, in the form kept in the history."""
+    statistics = ingestion_job.get('statistics', {})
+    started, updated = ingestion_job.get('startedAt'), ingestion_job.get('updatedAt')
+    return {
+        'job_id': ingestion_job['ingestionJobId'],
+        'status': ingestion_job['status'],
+        'scanned': statistics.get('numberOfDocumentsScanned', 0),
+        'new': statistics.get('numberOfNewDocumentsIndexed', 0),
+        'modified': statistics.get('numberOfModifiedDocumentsIndexed', 0) + statistics.get('numberOfMetadataDocumentsModified', 0),
+        'deleted': statistics.get('numberOfDocumentsDeleted', 0),
+        'failed': statistics.get('numberOfDocumentsFailed', 0),
+        'duration_seconds': (updated - started).total_seconds() if started and updated else None,
+        'failure_reasons': ingestion_job.get('failureReasons', []),
+    }
+
+
+class IngestionScheduler:
+    """Starts and tracks the ingestion jobs of one knowledge base data source."""
+
+    def __init__(self, agent, s3, bucket, knowledge_base_id, data_source_id, debounce_seconds=60, on_complete=None,
+                 clock=time.time):
+        self.agent = agent
+        self.s3 = s3
+        self.bucket = bucket
+        self.knowledge_base_id = knowledge_base_id
+        self.data_source_id = data_source_id
+        self.debounce_seconds = debounce_seconds
+        self.on_complete = on_complete
+        self.clock = clock
+
+    def _load(self):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=STATE_KEY)
+        except self.s3.exceptions.NoSuchKey:
+            return empty_state(), None
+        return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+
+    def _modify(self, change):
+        """Apply change(state) and write it back, re-reading on a concurrent write. False when change returns False."""
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            state, etag = self._load()
+            if change(state) is False:
+                return False
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=STATE_KEY,
+                    Body=json.dumps(state).encode('utf-8'),
+                    ContentType='application/json',
+                    **condition
+                )
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+                logger.info(f"Ingestion state changed concurrently, retrying")
+        raise RuntimeError(f"Could not update [{STATE_KEY}] after {MAX_WRITE_ATTEMPTS} attempts")
+
+    def state(self):
+        return self._load()[0]
+
+    def request(self):
+        """Ask for an ingestion of the data source, then tick() to start it when it is due."""
+        now = self.clock()
+
+        def mark_pending(state):
+            if not state['pending']:
+                state['pending'] = True
+                state['requested_at'] = now
+            state['requests'] += 1
+        self._modify(mark_pending)
+        return self.tick()
+
+    def tick(self):
+        """Move the scheduler forward, returns 'running', 'started', 'waiting' or 'idle'."""
+        state = self.state()
+        job = state['job']
+        if job and job.get('id'):
+            ingestion_job = self.agent.get_ingestion_job(
+                knowledgeBaseId=self.knowledge_base_id, dataSourceId=self.data_source_id, ingestionJobId=job['id']
+            )['ingestionJob']
+            if ingestion_job['status'] in RUNNING_STATUSES:
+                return 'running'
+            record = job_record(ingestion_job)
+            record['requests'] = job.get('requests', 0)
+            # Documents written before the claim are in the job, later ones may not be
+            record['claimed_at'] = job['claimed_at']
+            # Time from the first coalesced request until its changes were searchable
+            record['completed_at'] = self.clock()
+            record['freshness_seconds'] = record['completed_at'] - job['requested_at'] if job.get('requested_at') else None
+            self._finish(job['id'], record)
+        elif job and self.clock() - job['claimed_at'] > CLAIM_TIMEOUT_SECONDS:
+            logger.warning(f"Releasing an ingestion start claimed at [{job['claimed_at']}] without a job ID")
+            self._modify(lambda state: self._release(state, job['claimed_at']))
+        elif job:
+            return 'running'
+        return self._start_if_due()
+
+    def _finish(self, job_id, record):
+        def finish(state):
+            if not state['job'] or state['job'].get('id') != job_id:
+                # Another invocation already recorded this job
+                return False
+            state['job'] = None
+            state['history'] = ([record] + state['history'])[:HISTORY_LENGTH]
+        if not self._modify(finish):
+            return
+        logger.info(f"Ingestion job [{job_id}] {record['status']} in [{record['duration_seconds']}] s: "
+                    f"[{record['scanned']}] scanned, [{record['new']}] new, [{record['modified']}] modified, "
+                    f"[{record['deleted']}] deleted, [{record['failed']}] failed")
+        if self.on_complete:
+            self.on_complete(job_id, record)
+
+    def _start_if_due(self):
+        now = self.clock()
+        claimed_at = now
+
+        def claim(state):
+            if state['job'] or not state['pending']:
+                return False
+            if now - state['requested_at'] < self.debounce_seconds:
+                return False
+            state['job'] = {'id': None, 'claimed_at': claimed_at, 'requested_at': state['requested_at'],
+                            'requests': state['requests']}
+            state['pending'] = False
+            state['requested_at'] = None
+            state['requests'] = 0
+
+        if not self._modify(claim):
+            state = self.state()
+            return 'waiting' if state['pending'] and not state['job'] else 'running' if state['job'] else 'idle'
+
+        try:
+            response = self.agent.start_ingestion_job(
+                knowledgeBaseId=self.knowledge_base_id,
+                dataSourceId=self.data_source_id
+            )
+        except ClientError as e:
+            # Another job of the knowledge base (for example started from the console) holds it, try again later
+            logger.warning(f"Could not start an ingestion job: {str(e)}")
+            self._modify(lambda state: self._release(state, claimed_at))
+            if e.response['Error']['Code'] == 'ConflictException':
+                return 'waiting'
+            raise
+        job_id = response['ingestionJob']['ingestionJobId']
+
+        def record_job(state):
+            state['job'] = dict(state['job'] or {'requested_at': now, 'requests': 0}, id=job_id, claimed_at=claimed_at,
+                                started_at=self.clock())
+        self._modify(record_job)
+        logger.info(f"Started ingestion job [{job_id}]")
+        return 'started'
+
+    @staticmethod
+    def _release(state, claimed_at):
+        """Put a claimed start back as pending."""
+        job = state['job']
+        if not job or job.get('id') or job['claimed_at'] != claimed_at:
+            return False
+        state['job'] = None
+        state['pending'] = True
+        state['requested_at'] = min(filter(None, [state['requested_at'], job['requested_at']]))
+        state['requests'] += job['requests']
@@ -0,0 +1,131 @@
+"""Knowledge base documents written per section and named by the hash of their content.
+
+A source (handbook or newsletter) is a set of section documents under documents/<source>/ in the
+knowledge base bucket. Each has a .metadata.json sidecar that the Bedrock S3 data source attaches
+to its chunks (source, section, issue date). sync() writes only the sections whose content is new
+and deletes the ones no longer present, so an ingestion job re-embeds only what changed.
+"""
+import hashlib
+import json
+import logging
+import re
+
+logger = logging.getLogger()
+
+DOCUMENTS_PREFIX = 'documents/'
+METADATA_SUFFIX = '.metadata.json'
+# Sections shorter than this are folded into the previous one, longer ones are split at line breaks
+MIN_SECTION_CHARACTERS = 400
+MAX_SECTION_CHARACTERS = 6000
+
+
+class Section:
+    def __init__(self, title, text, attributes=None):
+        self.title = title
+        self.text = text
+        self.attributes = attributes or {}
+
+    def document(self, heading):
+        """Text of the section document, led by the source heading and section title so every chunk has context."""
+        return f"{heading}\n{self.title}\n\n{self.text.strip()}\n"
+
+
+def is_heading(line):
+    """A short line in capitals without closing punctuation, as the handbook headings are set."""
+    letters = [c for c in line if c.isalpha()]
+    if len(letters) < 4 or len(line) > 80 or len(line.split()) > 12 or line.rstrip().endswith(('.', ',', ';')):
+        return False
+    return sum(c.isupper() for c in letters) / len(letters) >= 0.8
+
+
+def _split_long(title, lines):
+    parts, current, size = [], [], 0
+    for line in lines:
+        if current and size + len(line) > MAX_SECTION_CHARACTERS:
+            parts.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        parts.append(current)
+    if len(parts) == 1:
+        return [(title, parts[0])]
+    return [(f"{title} (part {number})", part) for number, part in enumerate(parts, start=1)]
+
+
+def split_sections(text, default_title):
+    """(title, body) of each headed section of extracted text, lines before the first heading go under default_title."""
+    sections = [[default_title, []]]
+    for line in (line.strip() for line in text.splitlines()):
+        if not line:
+            continue
+        if is_heading(line):
+            lines = sections[-1][1]
+            if (lines or len(sections) > 1) and sum(len(body_line) for body_line in lines) < MIN_SECTION_CHARACTERS:
+                # A heading right after a short section (a subheading, a table of contents line) stays in it
+                lines.append(line)
+                continue
+            sections.append([" ".join(line.split()).title(), []])
+        else:
+            sections[-1][1].append(line)
+    result = []
+    for title, lines in sections:
+        if lines:
+            result.extend((part_title, "\n".join(part)) for part_title, part in _split_long(title, lines))
+    return result
+
+
+def content_key(source, heading, section):
+    """Key of a section document, the hash covers everything the document and its metadata are built from."""
+    digest = hashlib.sha256(json.dumps(
+        [heading, section.title, section.text, section.attributes], sort_keys=True
+    ).encode('utf-8')).hexdigest()[:24]
+    slug = re.sub(r'[^a-z0-9]+', '-', section.title.lower()).strip('-')[:40] or 'section'
+    return f"{DOCUMENTS_PREFIX}{source}/{slug}-{digest}.txt"
+
+
+def existing_keys(s3, bucket, source):
+    keys = set()
+    kwargs = {'Bucket': bucket, 'Prefix': f"{DOCUMENTS_PREFIX}{source}/"}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        keys.update(item['Key'] for item in response.get('Contents', []) if not item['Key'].endswith(METADATA_SUFFIX))
+        if not response.get('IsTruncated'):
+            return keys
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def sync(s3, bucket, source, heading, sections):
+    """Make documents/<source>/ hold exactly these sections, returns (written, unchanged, deleted) counts."""
+    wanted = {}
+    for section in sections:
+        wanted.setdefault(content_key(source, heading, section), section)
+    present = existing_keys(s3, bucket, source)
+
+    written = 0
+    for key, section in wanted.items():
+        if key in present:
+            continue
+        attributes = dict(section.attributes, source=source, section=section.title)
+        # The sidecar goes first so the document is never ingested without its metadata
+        s3.put_object(
+            Bucket=bucket,
+            Key=key + METADATA_SUFFIX,
+            Body=json.dumps({'metadataAttributes': attributes}).encode('utf-8'),
+            ContentType='application/json'
+        )
+        s3.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=section.document(heading).encode('utf-8'),
+            ContentType='text/plain; charset=utf-8'
+        )
+        written += 1
+
+    obsolete = sorted(present - set(wanted))
+    for key in obsolete:
+        s3.delete_object(Bucket=bucket, Key=key)
+        s3.delete_object(Bucket=bucket, Key=key + METADATA_SUFFIX)
+    unchanged = len(wanted) - written
+    logger.info(f"Documents of [{source}]: [{written}] sections written, [{unchanged}] unchanged, [{len(obsolete)}] deleted")
+    return written, unchanged, len(obsolete)
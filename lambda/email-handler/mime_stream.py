@@ -0,0 +1,193 @@
+"""Streaming MIME parsing of a stored SES message.
+
+The message is read from a chunk iterator line by line. Each attachment is decoded as it is read
+into a SpooledTemporaryFile, which moves to disk past spool_bytes, and the other part bodies are
+skipped, so memory use does not depend on the size of the message or its attachments. A
+forwarded message (message/rfc822) is walked like the message itself.
+"""
+import base64
+import binascii
+import hashlib
+import quopri
+import tempfile
+from email import policy
+from email.parser import BytesParser
+
+DEFAULT_SPOOL_BYTES = 8 * 1024 * 1024
+BASE64_BATCH_BYTES = 64 * 1024
+
+
+def read_chunks(body, chunk_size=1024 * 1024):
+    """Chunks of a file-like body, such as the StreamingBody of get_object."""
+    return iter(lambda: body.read(chunk_size), b'')
+
+
+def _lines(chunks):
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        start = 0
+        while True:
+            end = pending.find(b'\n', start)
+            if end == -1:
+                break
+            yield pending[start:end + 1]
+            start = end + 1
+        pending = pending[start:]
+    if pending:
+        yield pending
+
+
+def _parse_headers(lines):
+    """Headers up to the blank line that ends them, as a headers-only EmailMessage."""
+    raw = []
+    for line in lines:
+        if line in (b'\r\n', b'\n'):
+            break
+        raw.append(line)
+    return BytesParser(policy=policy.default).parsebytes(b''.join(raw) + b'\r\n', headersonly=True)
+
+
+class Attachment:
+    """An attachment decoded to a spooled file, rewound and ready to read. Close it when done."""
+
+    def __init__(self, file_name, content_type, file, size, sha256):
+        self.file_name = file_name
+        self.content_type = content_type
+        self.file = file
+        self.size = size
+        self.sha256 = sha256
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class _Decoder:
+    """Writes a part body to a file through its Content-Transfer-Encoding, hashing the decoded bytes."""
+
+    def __init__(self, file, encoding):
+        self.file = file
+        self.encoding = encoding
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self._base64 = []
+        self._base64_bytes = 0
+
+    def _emit(self, data):
+        if data:
+            self.file.write(data)
+            self.digest.update(data)
+            self.size += len(data)
+
+    def _decode_base64(self, final=False):
+        data = b''.join(self._base64)
+        usable = len(data) if final else len(data) // 4 * 4
+        self._base64 = [data[usable:]] if usable < len(data) else []
+        self._base64_bytes = len(data) - usable
+        try:
+            self._emit(base64.b64decode(data[:usable]))
+        except binascii.Error:
+            # Missing padding at the very end, decode what is complete
+            self._emit(base64.b64decode(data[:usable // 4 * 4]))
+
+    def write(self, line):
+        if self.encoding == 'base64':
+            stripped = b''.join(line.split())
+            self._base64.append(stripped)
+            self._base64_bytes += len(stripped)
+            if self._base64_bytes >= BASE64_BATCH_BYTES:
+                self._decode_base64()
+        elif self.encoding == 'quoted-printable':
+            self._emit(quopri.decodestring(line))
+        else:
+            self._emit(line)
+
+    def close(self):
+        if self.encoding == 'base64' and self._base64:
+            self._decode_base64(final=True)
+
+
+class MessageStream:
+    """Headers and attachments of a MIME message read once, in order, from chunks of bytes.
+
+    attachments() yields parts with a Content-Disposition and a file name, the way process_email
+    picked them from msg.walk(), including those of forwarded messages. The caller owns (and
+    closes) each Attachment.
+    """
+
+    def __init__(self, chunks, spool_bytes=DEFAULT_SPOOL_BYTES):
+        self._lines = _lines(chunks)
+        self.spool_bytes = spool_bytes
+        self.headers = _parse_headers(self._lines)
+
+    def attachments(self):
+        yield from self._walk(self.headers, [])
+
+    def _walk(self, headers, boundaries):
+        """Consume one part, attachments are yielded, returns the delimiter line that ended the part."""
+        if headers.get_content_maintype() == 'multipart' and headers.get_boundary():
+            return (yield from self._walk_multipart(headers.get_boundary().encode('utf-8'), boundaries))
+        if headers.get_content_type() == 'message/rfc822':
+            # An email forwarded as an attachment: its headers, then its body as a part of its own
+            return (yield from self._walk(_parse_headers(self._lines), boundaries))
+
+        file_name = headers.get_filename() if headers.get('Content-Disposition') is not None else None
+        if not file_name:
+            return self._skip_body(boundaries)
+
+        file = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        encoding = str(headers.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        decoder = _Decoder(file, encoding)
+        previous = None
+        delimiter = None
+        for line in self._lines:
+            if self._is_delimiter(line, boundaries):
+                delimiter = line
+                break
+            if previous is not None:
+                decoder.write(previous)
+            previous = line
+        if previous is not None and delimiter is not None:
+            # The line break before a delimiter belongs to the delimiter
+            previous = previous[:-2] if previous.endswith(b'\r\n') else previous[:-1] if previous.endswith(b'\n') else previous
+        if previous is not None:
+            decoder.write(previous)
+        decoder.close()
+        file.seek(0)
+        yield Attachment(file_name, headers.get_content_type(), file, decoder.size, decoder.digest.hexdigest())
+        return delimiter
+
+    def _walk_multipart(self, boundary, boundaries):
+        inner = boundaries + [boundary]
+        # Preamble up to the first delimiter of this multipart
+        delimiter = self._skip_body(inner)
+        while delimiter is not None and delimiter.rstrip() == b'--' + boundary:
+            part_headers = _parse_headers(self._lines)
+            delimiter = yield from self._walk(part_headers, inner)
+        if delimiter is not None and delimiter.rstrip() == b'--' + boundary + b'--':
+            # Epilogue up to the next delimiter of an enclosing multipart
+            return self._skip_body(boundaries)
+        return delimiter
+
+    def _skip_body(self, boundaries):
+        for line in self._lines:
+            if self._is_delimiter(line, boundaries):
+                return line
+        return None
+
+    @staticmethod
+    def _is_delimiter(line, boundaries):
+        if not boundaries or not line.startswith(b'--'):
+            return False
+        stripped = line.rstrip()
+        return any(stripped == b'--' + boundary or stripped == b'--' + boundary + b'--' for boundary in boundaries)
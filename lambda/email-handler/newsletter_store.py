@@ -0,0 +1,193 @@
+"""Structured store of the newsletter items behind the 'Pencil It In' knowledge base document.
+
+Each issue is reduced to items by the model (extraction only), then merged into the store
+deterministically: items are identified by category and normalized title, the most recent issue
+wins and dates accumulate. A dated item expires once its last date has passed, an undated one
+(a policy, an announcement) stays until a handbook resets the store. The documents the knowledge
+base indexes, one per category, are rendered from the store, so the work per issue does not grow
+with the history kept.
+"""
+import datetime
+import hashlib
+import json
+from text_normalize import normalize
+
+STORE_KEY = 'newsletter/store.json'
+
+# Category, heading in the rendered document
+CATEGORIES = [
+    ('event', 'Upcoming Events'),
+    ('policy', 'School Policies and Procedures'),
+    ('academic', 'Academic Information'),
+    ('activity', 'Extracurricular Activities'),
+    ('announcement', 'Important Announcements'),
+]
+CATEGORY_NAMES = [category for category, _ in CATEGORIES]
+
+# Titles sharing this fraction of their words name the same item
+SIMILAR_TITLE_THRESHOLD = 0.8
+
+EXTRACTION_PROMPT = """<task>
+Extract every event, policy or procedure, piece of academic information, extracurricular activity and important announcement from this school newsletter. The items are stored in a knowledge base for a chat assistant that answers questions from parents and students.
+</task>
+<instructions>
+<step>Only use information from the newsletter below.</step>
+<step>Give each item a short title that names it (for example "Basketball tryouts"), without dates.</step>
+<step>Put the full content in details: what it is, who it is for, rules, action items and links, not just a heading.</step>
+<step>Resolve relative dates such as "next Wednesday" against the issue date {issue_date} and write dates as YYYY-MM-DD.</step>
+<step>Use the category "event" for anything happening on specific dates, and list all of its dates.</step>
+</instructions>
+<output>
+Reply with JSON only, in this form:
+{{"items": [{{"category": "event|policy|academic|activity|announcement", "title": "...", "details": "...", "dates": ["YYYY-MM-DD"], "time": "...", "location": "..."}}]}}
+Leave out dates, time and location when the newsletter does not give them.
+</output>
+<newsletter>
+{newsletter}
+</newsletter>"""
+
+
+def item_id(category, title):
+    return hashlib.sha1(f"{category}|{normalize(title)}".encode('utf-8')).hexdigest()[:12]
+
+
+def _similar(a, b):
+    words_a, words_b = set(normalize(a).split()), set(normalize(b).split())
+    if not words_a or not words_b:
+        return False
+    return len(words_a & words_b) / len(words_a | words_b) >= SIMILAR_TITLE_THRESHOLD
+
+
+def _valid_dates(dates):
+    valid = []
+    for value in dates or []:
+        try:
+            valid.append(datetime.date.fromisoformat(str(value)).isoformat())
+        except ValueError:
+            continue
+    return valid
+
+
+def parse_items(model_output):
+    """Items of the model's JSON reply, anything that is not a usable item is dropped."""
+    start, end = model_output.find('{'), model_output.rfind('}')
+    if start == -1 or end == -1:
+        raise ValueError("No JSON object in the extraction output")
+    items = []
+    for raw in json.loads(model_output[start:end + 1]).get('items', []):
+        category = str(raw.get('category', '')).strip().lower()
+        title = str(raw.get('title', '')).strip()
+        if category not in CATEGORY_NAMES or not title:
+            continue
+        items.append({
+            'category': category,
+            'title': title,
+            'details': str(raw.get('details', '')).strip(),
+            'dates': _valid_dates(raw.get('dates')),
+            'time': str(raw.get('time') or '').strip(),
+            'location': str(raw.get('location') or '').strip(),
+        })
+    return items
+
+
+def empty_store():
+    return {'items': {}, 'issues': []}
+
+
+def merge(store, items, issue_id, issue_date, dated_retention_days=7):
+    """Fold the items of one issue into the store, returns (added, updated, expired) counts.
+
+    An item with dates expires dated_retention_days after its last date, an item without dates is kept.
+    """
+    issue_day = issue_date.isoformat()
+    added = updated = 0
+    for item in items:
+        key = item_id(item['category'], item['title'])
+        if key not in store['items']:
+            # A reworded title of an item already stored updates it instead of duplicating it
+            key = next((existing_key for existing_key, existing in store['items'].items()
+                        if existing['category'] == item['category'] and _similar(existing['title'], item['title'])), key)
+        existing = store['items'].get(key)
+        if existing is None:
+            store['items'][key] = dict(item, id=key, source_issue=issue_id, first_seen=issue_day, last_seen=issue_day)
+            added += 1
+            continue
+        dates = sorted(set(existing['dates']) | set(item['dates']))
+        if issue_day >= existing['last_seen']:
+            # The most recent issue has the current version of the item
+            existing.update(item, dates=dates, source_issue=issue_id, last_seen=issue_day)
+        else:
+            existing['dates'] = dates
+        updated += 1
+
+    cutoff = (issue_date - datetime.timedelta(days=dated_retention_days)).isoformat()
+    expired = [key for key, item in store['items'].items() if item['dates'] and max(item['dates']) < cutoff]
+    for key in expired:
+        del store['items'][key]
+    if issue_id not in store['issues']:
+        store['issues'].append(issue_id)
+    return added, updated, len(expired)
+
+
+def _format_date(value):
+    day = datetime.date.fromisoformat(value)
+    return f"{day.strftime('%A, %B')} {day.day}, {day.year}"
+
+
+HEADING = "Pencil It In! School newsletter information for Kelvyn Park Junior & Senior High School"
+
+
+def render_items(items):
+    """One line per item, events in date order."""
+    items = sorted(items, key=lambda item: (min(item['dates']) if item['dates'] else '9999', item['title'].lower()))
+    lines = []
+    for item in items:
+        line = f"- {item['title']}"
+        if item['dates']:
+            line += f" ({'; '.join(_format_date(value) for value in item['dates'])}"
+            line += f", {item['time']})" if item['time'] else ")"
+        elif item['time']:
+            line += f" ({item['time']})"
+        if item['location']:
+            line += f" at {item['location']}"
+        if item['details']:
+            line += f": {item['details']}"
+        lines.append(line)
+    return lines
+
+
+def category_items(store):
+    """(heading, items) of each category that has items, in document order."""
+    for category, heading in CATEGORIES:
+        items = [item for item in store['items'].values() if item['category'] == category]
+        if items:
+            yield heading, items
+
+
+def render(store):
+    """Plain text document of the whole store."""
+    sections = [HEADING]
+    for heading, items in category_items(store):
+        sections.append("\n".join([heading] + render_items(items)))
+    return "\n\n".join(sections) + "\n"
+
+
+def load(s3, bucket):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=STORE_KEY)
+    except s3.exceptions.NoSuchKey:
+        return empty_store()
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def save(s3, bucket, store):
+    s3.put_object(
+        Bucket=bucket,
+        Key=STORE_KEY,
+        Body=json.dumps(store).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+
+def reset(s3, bucket):
+    s3.delete_object(Bucket=bucket, Key=STORE_KEY)
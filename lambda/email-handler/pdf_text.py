@@ -0,0 +1,56 @@
+"""In-process extraction of the PDF text layer, the fast path before Textract OCR.
+
+pypdf is optional: without it, or for a PDF it cannot read, every page goes to Textract.
+"""
+import importlib.util
+import logging
+import tempfile
+import time
+
+logger = logging.getLogger()
+
+# A page with fewer letters and digits than this in its text layer is treated as scanned
+MIN_PAGE_CHARACTERS = 20
+
+
+def available():
+    return importlib.util.find_spec('pypdf') is not None
+
+
+def usable(text, min_characters=MIN_PAGE_CHARACTERS):
+    return sum(c.isalnum() for c in text) >= min_characters
+
+
+def text_layer_pages(pdf_file, min_characters=MIN_PAGE_CHARACTERS):
+    """Yield (page_number, text, milliseconds) per page, text is None when the page needs OCR.
+
+    pdf_file is a seekable file object. Text keeps one line per line of the page, with whitespace
+    collapsed to single spaces like the Textract LINE output.
+    """
+    from pypdf import PdfReader
+
+    pdf_file.seek(0)
+    reader = PdfReader(pdf_file)
+    for page_number, page in enumerate(reader.pages, start=1):
+        started = time.perf_counter()
+        try:
+            text = "\n".join(" ".join(line.split()) for line in (page.extract_text() or "").splitlines() if line.strip())
+        except Exception as e:
+            logger.warning(f"Could not read the text layer of page {page_number}: {str(e)}")
+            text = ""
+        yield page_number, text if usable(text, min_characters) else None, (time.perf_counter() - started) * 1000
+
+
+def sub_document(pdf_file, page_numbers, spool_bytes=8 * 1024 * 1024):
+    """PDF holding only the given pages (numbered from 1), in that order, as a rewound spooled file."""
+    from pypdf import PdfReader, PdfWriter
+
+    pdf_file.seek(0)
+    reader = PdfReader(pdf_file)
+    writer = PdfWriter()
+    for page_number in page_numbers:
+        writer.add_page(reader.pages[page_number - 1])
+    output = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    writer.write(output)
+    output.seek(0)
+    return output
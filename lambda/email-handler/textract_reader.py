@@ -0,0 +1,125 @@
+"""Asynchronous Textract text detection, read as a lazy stream of LINE blocks."""
+import json
+import logging
+import time
+
+logger = logging.getLogger()
+
+
+class TextractJobFailed(Exception):
+    pass
+
+
+class QueueWaiter:
+    """Waits for the Textract completion notification (SNS topic -> SQS queue) instead of polling.
+
+    Notifications of other jobs are made visible again right away for the invocation waiting on them.
+    Any client exposing receive_message/delete_message/change_message_visibility can stand in for SQS.
+    """
+
+    def __init__(self, sqs, queue_url, topic_arn, role_arn):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.topic_arn = topic_arn
+        self.role_arn = role_arn
+
+    def notification_channel(self):
+        return {'SNSTopicArn': self.topic_arn, 'RoleArn': self.role_arn}
+
+    def wait(self, job_id, timeout_seconds):
+        """Status of the job once notified, None when no notification arrived in time."""
+        deadline = time.monotonic() + timeout_seconds
+        while time.monotonic() < deadline:
+            response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=max(1, min(20, int(deadline - time.monotonic())))
+            )
+            for message in response.get('Messages', []):
+                body = json.loads(message['Body'])
+                # Raw delivery carries the Textract message itself, otherwise it is wrapped in the SNS envelope
+                notification = json.loads(body['Message']) if 'Message' in body else body
+                if notification.get('JobId') == job_id:
+                    self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+                    return notification.get('Status')
+                self.sqs.change_message_visibility(
+                    QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'], VisibilityTimeout=0
+                )
+        return None
+
+
+class TextDetection:
+    """One document text detection job.
+
+    wait() polls with exponential backoff (initial_delay doubling up to max_delay), or waits on the
+    notification queue when a QueueWaiter is given and falls back to polling if it stays silent.
+    page_lines() and lines() then yield the LINE blocks page by page, requesting the next result page
+    only when the consumer asks for more, so stopping early saves the remaining
+    get_document_text_detection calls.
+    """
+
+    def __init__(self, textract, waiter=None, initial_delay=1.0, max_delay=10.0, timeout_seconds=600):
+        self.textract = textract
+        self.waiter = waiter
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout_seconds = timeout_seconds
+        self.job_id = None
+        self.polls = 0
+        self.result_pages = 0
+
+    def start(self, bucket, key):
+        kwargs = {'DocumentLocation': {'S3Object': {'Bucket': bucket, 'Name': key}}}
+        if self.waiter:
+            kwargs['NotificationChannel'] = self.waiter.notification_channel()
+        self.job_id = self.textract.start_document_text_detection(**kwargs)['JobId']
+        logger.info(f"Started asynchronous Textract job with ID: {self.job_id}")
+        return self.job_id
+
+    def _get(self, next_token=None):
+        kwargs = {'JobId': self.job_id}
+        if next_token:
+            kwargs['NextToken'] = next_token
+        return self.textract.get_document_text_detection(**kwargs)
+
+    def wait(self):
+        """First page of results once the job has finished."""
+        if self.waiter:
+            status = self.waiter.wait(self.job_id, self.timeout_seconds)
+            logger.info(f"Textract notification for job {self.job_id}: {status}")
+            if status is None:
+                logger.warning(f"No Textract notification for job {self.job_id}, polling instead")
+
+        delay = self.initial_delay
+        deadline = time.monotonic() + self.timeout_seconds
+        while True:
+            response = self._get()
+            self.polls += 1
+            status = response['JobStatus']
+            logger.info(f"Job status: {status}")
+            if status == 'SUCCEEDED' or status == 'PARTIAL_SUCCESS':
+                return response
+            if status == 'FAILED':
+                logger.error("Textract job failed")
+                raise TextractJobFailed(f"Textract job {self.job_id} failed: {response.get('StatusMessage')}")
+            if time.monotonic() + delay > deadline:
+                raise TextractJobFailed(f"Textract job {self.job_id} did not finish in {self.timeout_seconds} seconds")
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    def page_lines(self):
+        """Yield (page_number, text) for each LINE block."""
+        response = self.wait()
+        logger.info(f"Textract job with ID: {self.job_id} complete!")
+        while True:
+            self.result_pages += 1
+            for block in response['Blocks']:
+                if block['BlockType'] == 'LINE':
+                    yield block.get('Page', 1), block['Text']
+            if 'NextToken' not in response:
+                return
+            response = self._get(response['NextToken'])
+
+    def lines(self):
+        for _, text in self.page_lines():
+            yield text
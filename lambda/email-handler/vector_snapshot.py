@@ -0,0 +1,135 @@
+import json
+import logging
+import math
+import struct
+import time
+from kb_layout import EMBEDDING_MODEL_ID, MANIFEST_KEY, SNAPSHOT_PREFIX
+
+logger = logging.getLogger()
+
+
+def chunk_text(text, max_words=300, overlap_words=60):
+    """Split text into overlapping word windows, roughly the size of the knowledge base chunks."""
+    words = text.split()
+    chunks = []
+    step = max_words - overlap_words
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + max_words]))
+        if start + max_words >= len(words):
+            break
+    return chunks
+
+
+def embed_text(bedrock_runtime, text):
+    """Return the unit-length Titan embedding of a piece of text."""
+    response = bedrock_runtime.invoke_model(
+        modelId=EMBEDDING_MODEL_ID,
+        body=json.dumps({'inputText': text})
+    )
+    embedding = json.loads(response['body'].read())['embedding']
+    norm = math.sqrt(sum(value * value for value in embedding)) or 1.0
+    return [value / norm for value in embedding]
+
+
+def to_npy(vectors):
+    """Serialize float32 row vectors in the .npy format so the reader can memory-map them without NumPy here."""
+    rows = len(vectors)
+    dimension = len(vectors[0]) if rows else 0
+    header = f"{{'descr': '<f4', 'fortran_order': False, 'shape': ({rows}, {dimension}), }}"
+    # Pad the header so the data starts on a 64 byte boundary, as numpy.lib.format does
+    padding = 64 - (10 + len(header) + 1) % 64
+    header = header + " " * padding + "\n"
+    body = b"".join(struct.pack(f"<{dimension}f", *vector) for vector in vectors)
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode('latin1') + body
+
+
+def _stamp():
+    """Sortable time of a snapshot part, its keys are never overwritten."""
+    return f"{time.time():017.6f}"
+
+
+def write_source_snapshot(s3, bedrock_runtime, bucket, source, text, source_uri):
+    """Chunk and embed one knowledge base document and store its part of the snapshot.
+
+    The part is written under a new key, vectors first, so the .json listed by write_manifest always
+    has its complete .npy.
+    """
+    started = time.time()
+    chunks = chunk_text(text)
+    vectors = [embed_text(bedrock_runtime, chunk) for chunk in chunks]
+    key = f"{SNAPSHOT_PREFIX}{source}/{_stamp()}"
+    s3.put_object(Bucket=bucket, Key=f"{key}.npy", Body=to_npy(vectors))
+    s3.put_object(
+        Bucket=bucket,
+        Key=f"{key}.json",
+        Body=json.dumps({'uri': source_uri, 'chunks': chunks}).encode('utf-8'),
+        ContentType='application/json'
+    )
+    logger.info(f"Wrote [{len(chunks)}] chunk snapshot [{key}] for [{source}] in {time.time() - started:.1f}s")
+
+
+def delete_source_snapshot(s3, bucket, source):
+    """Mark the source deleted from now on, manifests of earlier ingestion jobs still use its last part."""
+    s3.put_object(Bucket=bucket, Key=f"{SNAPSHOT_PREFIX}{source}/{_stamp()}.deleted", Body=b'')
+    logger.info(f"Deleted snapshot for [{source}]")
+
+
+def _list(s3, bucket, prefix):
+    keys = []
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        keys.extend(item['Key'] for item in response.get('Contents', []))
+        if not response.get('IsTruncated'):
+            return keys
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def _load_manifest(s3, bucket):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=MANIFEST_KEY)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def write_manifest(s3, bucket, kb_version, written_before=None):
+    """Point readers at the snapshot parts of a knowledge base version and record the version they match.
+
+    Each source gets its last part written before written_before, the time the ingestion job of
+    kb_version was claimed, so a part written for a later job is not paired with this version.
+    Parts older than those and not in the previous manifest are deleted.
+    """
+    previous = _load_manifest(s3, bucket)
+    kept = {key for part in (previous or {}).get('parts', {}).values() for key in part.values()}
+    cutoff = f"{written_before:017.6f}" if written_before is not None else None
+    by_source = {}
+    obsolete = []
+    for key in _list(s3, bucket, SNAPSHOT_PREFIX):
+        source, _, name = key[len(SNAPSHOT_PREFIX):].rpartition('/')
+        if not source:
+            if key != MANIFEST_KEY:
+                # A part written under the fixed keys of earlier versions
+                obsolete.append(key)
+            continue
+        stamp, _, kind = name.rpartition('.')
+        by_source.setdefault(source, []).append((stamp, kind, key))
+
+    parts = {}
+    for source, entries in by_source.items():
+        # The last complete part (or deletion) of the source written before the cutoff
+        markers = sorted(entry for entry in entries
+                         if entry[1] in ('json', 'deleted') and (cutoff is None or entry[0] <= cutoff))
+        if not markers:
+            continue
+        stamp, kind, key = markers[-1]
+        if kind == 'json':
+            parts[source] = {'vectors': key[:-len('.json')] + '.npy', 'chunks': key}
+        obsolete.extend(entry[2] for entry in entries if entry[0] < stamp)
+    manifest = {'kb_version': kb_version, 'sources': sorted(parts), 'parts': parts, 'created_at': time.time()}
+    s3.put_object(Bucket=bucket, Key=MANIFEST_KEY, Body=json.dumps(manifest).encode('utf-8'), ContentType='application/json')
+    logger.info(f"Published vector snapshot manifest for knowledge base version [{kb_version}] with sources {manifest['sources']}")
+    # A reader may still be loading the parts of the previous manifest
+    for key in obsolete:
+        if key not in kept:
+            s3.delete_object(Bucket=bucket, Key=key)
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from kb_layout import KB_VERSION_KEY
+from text_normalize import normalize
+
+UNVERSIONED = 'unversioned'
+
+
+def cache_key(prompt, language_code, kb_version):
+    # Trivially different questions (case, accents, punctuation) share an entry
+    raw = f"{kb_version}|{language_code}|{normalize(prompt)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class MemoryBackend:
+    """LRU of answers held by the container, entries also expire after their TTL."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl_seconds):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class S3Backend:
+    """Answers shared by every container, stored as JSON objects.
+
+    Any client exposing get_object/put_object and exceptions.NoSuchKey can stand in for S3.
+    """
+
+    def __init__(self, s3, bucket, prefix='answer-cache/'):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}.json")
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        entry = json.loads(response['Body'].read().decode('utf-8'))
+        if entry['expires_at'] <= time.time():
+            return None
+        return entry['value']
+
+    def put(self, key, value, ttl_seconds):
+        entry = {'value': value, 'expires_at': time.time() + ttl_seconds}
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{key}.json",
+            Body=json.dumps(entry).encode('utf-8'),
+            ContentType='application/json'
+        )
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=f"{self.prefix}{key}.json")
+
+    def clear(self):
+        # Keys embed the knowledge base version so stale entries are never read, the bucket lifecycle removes them
+        pass
+
+
+class KnowledgeBaseVersion:
+    """Reads the knowledge base version marker, re-checking it at most once per refresh interval."""
+
+    def __init__(self, s3, bucket, refresh_seconds=30):
+        self.s3 = s3
+        self.bucket = bucket
+        self.refresh_seconds = refresh_seconds
+        self._version = None
+        self._checked_at = 0.0
+
+    def current(self):
+        if self._version is not None and time.monotonic() - self._checked_at < self.refresh_seconds:
+            return self._version
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=KB_VERSION_KEY)
+            self._version = json.loads(response['Body'].read().decode('utf-8'))['version']
+        except self.s3.exceptions.NoSuchKey:
+            self._version = UNVERSIONED
+        self._checked_at = time.monotonic()
+        return self._version
+
+
+class AnswerCache:
+    """Complete answers keyed on the normalized question, the language and the knowledge base version.
+
+    A None version (marker unreadable) bypasses the cache.
+    """
+
+    def __init__(self, backend, ttl_seconds=3600):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self._last_version = None
+
+    def _check_version(self, kb_version):
+        if self._last_version is not None and kb_version != self._last_version:
+            print(f"Knowledge base version changed from [{self._last_version}] to [{kb_version}], clearing answer cache")
+            self.backend.clear()
+        self._last_version = kb_version
+
+    def get(self, prompt, language_code, kb_version):
+        if kb_version is None:
+            return None
+        self._check_version(kb_version)
+        try:
+            return self.backend.get(cache_key(prompt, language_code, kb_version))
+        except Exception as e:
+            print(f"Answer cache lookup failed, answering without it: {str(e)}")
+            return None
+
+    def put(self, prompt, language_code, kb_version, answer):
+        if kb_version is None or not answer:
+            return
+        try:
+            self.backend.put(cache_key(prompt, language_code, kb_version), answer, self.ttl_seconds)
+        except Exception as e:
+            print(f"Answer cache write failed: {str(e)}")
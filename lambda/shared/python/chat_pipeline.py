@@ -0,0 +1,426 @@
+"""Retrieval, generation and streaming of an answer, shared by get-response-from-bedrock and the
+inline mode of web-socket-handler."""
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import client_pool
+import instrumentation
+import intent_router
+from answer_cache import AnswerCache, KnowledgeBaseVersion, MemoryBackend, S3Backend
+from context_packer import pack_context, reformulate, retrieve_all
+from frame_coalescer import ConnectionGone, FrameCoalescer
+from kb_layout import EMBEDDING_MODEL_ID
+from local_index import LocalIndex
+import prompts
+import session_store
+
+# Environment is read once per container
+URL = os.environ['URL']
+KNOWLEDGE_BASE_ID = os.environ['KNOWLEDGE_BASE_ID']
+BEDROCK_REGION = os.environ.get('BEDROCK_REGION', 'us-west-2')
+FRAME_MAX_BYTES = int(os.environ.get('FRAME_MAX_BYTES', '1024'))
+FRAME_MAX_MS = int(os.environ.get('FRAME_MAX_MS', '200'))
+FRAME_FLUSH_ON_SENTENCE = os.environ.get('FRAME_FLUSH_ON_SENTENCE', 'true').lower() == 'true'
+STATE_BUCKET = os.environ.get('STATE_BUCKET_NAME')
+ANSWER_CACHE_BACKEND = os.environ.get('ANSWER_CACHE_BACKEND', 'memory').lower()  # 'memory', 's3' or 'none'
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get('ANSWER_CACHE_TTL_SECONDS', '3600'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', '256'))
+KB_VERSION_REFRESH_SECONDS = int(os.environ.get('KB_VERSION_REFRESH_SECONDS', '30'))
+LOCAL_INDEX_ENABLED = os.environ.get('LOCAL_INDEX_ENABLED', 'false').lower() == 'true'
+LOCAL_INDEX_TOP_K = int(os.environ.get('LOCAL_INDEX_TOP_K', '5'))
+# Comma separated 'source' metadata values (handbook, newsletter) to retrieve from, empty for every document
+RETRIEVAL_SOURCES = [source.strip() for source in os.environ.get('RETRIEVAL_SOURCES', '').split(',') if source.strip()]
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '2000'))
+CONTEXT_DEDUPE_THRESHOLD = float(os.environ.get('CONTEXT_DEDUPE_THRESHOLD', '0.8'))
+CONTEXT_MULTI_QUERY = os.environ.get('CONTEXT_MULTI_QUERY', 'false').lower() == 'true'
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 's3').lower()  # 's3', 'memory' (one container only) or 'none'
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', '1800'))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', '512'))
+SESSION_TOKEN_BUDGET = int(os.environ.get('SESSION_TOKEN_BUDGET', '1500'))
+MODEL_ID = os.environ.get('MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+PROMPT_CACHING = os.environ.get('PROMPT_CACHING', 'false').lower() == 'true'
+INTENT_ROUTING = os.environ.get('INTENT_ROUTING', 'true').lower() == 'true'
+MAX_OUTPUT_TOKENS = 1000
+# web-socket-handler marks a connection closed on $disconnect, the mark outlives any answer still being generated
+CLOSED_CONNECTION_TTL_SECONDS = 3600
+
+# Time from routing a message until its answer was sent, per route
+ROUTE_METRICS = {
+    intent_router.SMALL_TALK: "SmallTalkRoute",
+    intent_router.OUT_OF_SCOPE: "OutOfScopeRoute",
+    intent_router.SCHOOL: "SchoolRoute",
+}
+
+kb_version_reader = None
+answer_cache = None
+local_index = None
+sessions = None
+closed_connections = None
+# Checks for a closed connection while the model call is made
+background = ThreadPoolExecutor(max_workers=2)
+# Output tokens and generation time of the answers completed in this container, a disconnect is measured against them
+completed_answers = {'count': 0, 'output_tokens': 0, 'seconds': 0.0}
+request_builder = prompts.RequestBuilder(max_tokens=MAX_OUTPUT_TOKENS, prompt_caching=PROMPT_CACHING)
+
+def current_kb_version():
+    """Version marker of the knowledge base content, None when it cannot be read."""
+    global kb_version_reader
+    if not STATE_BUCKET:
+        return None
+    if kb_version_reader is None:
+        kb_version_reader = KnowledgeBaseVersion(client_pool.get_client("s3"), STATE_BUCKET, refresh_seconds=KB_VERSION_REFRESH_SECONDS)
+    try:
+        return kb_version_reader.current()
+    except Exception as e:
+        print(f"Could not read the knowledge base version: {str(e)}")
+        return None
+
+def get_answer_cache():
+    """Build the answer cache on first use, None when caching is turned off."""
+    global answer_cache
+    if answer_cache is None and ANSWER_CACHE_BACKEND != 'none' and STATE_BUCKET:
+        if ANSWER_CACHE_BACKEND == 's3':
+            backend = S3Backend(client_pool.get_client("s3"), STATE_BUCKET)
+        else:
+            backend = MemoryBackend(max_entries=ANSWER_CACHE_MAX_ENTRIES)
+        answer_cache = AnswerCache(backend, ttl_seconds=ANSWER_CACHE_TTL_SECONDS)
+    return answer_cache
+
+def get_local_index():
+    """Build the local vector index on first use, None when it is turned off or NumPy is missing."""
+    global local_index
+    if local_index is None and LOCAL_INDEX_ENABLED and STATE_BUCKET and LocalIndex.available():
+        local_index = LocalIndex(client_pool.get_client("s3"), STATE_BUCKET, embed_query)
+    return local_index
+
+def get_session_store():
+    """Build the conversation session store on first use, None when history is turned off."""
+    global sessions
+    if sessions is None and SESSION_BACKEND != 'none':
+        if SESSION_BACKEND == 's3' and STATE_BUCKET:
+            backend = session_store.S3Backend(client_pool.get_client("s3"), STATE_BUCKET, prefix='sessions/')
+        else:
+            backend = session_store.MemoryBackend(max_entries=SESSION_MAX_ENTRIES)
+        sessions = session_store.SessionStore(backend, summarize_turns, token_budget=SESSION_TOKEN_BUDGET, ttl_seconds=SESSION_TTL_SECONDS)
+    return sessions
+
+def get_closed_connections():
+    """Closed connection marks shared by every function, None without a state bucket."""
+    global closed_connections
+    if closed_connections is None and STATE_BUCKET:
+        closed_connections = S3Backend(client_pool.get_client("s3"), STATE_BUCKET, prefix='closed-connections/')
+    return closed_connections
+
+def mark_connection_closed(connection_id):
+    marks = get_closed_connections()
+    if marks and connection_id:
+        marks.put(connection_id, True, CLOSED_CONNECTION_TTL_SECONDS)
+
+def connection_closed(connection_id):
+    """True when $disconnect has marked the connection closed, False when it cannot be told."""
+    marks = get_closed_connections()
+    try:
+        return bool(marks and marks.get(connection_id))
+    except Exception as e:
+        print(f"Could not read the connection state: {str(e)}")
+        return False
+
+def record_disconnect(trace, output_tokens, generation_seconds=None):
+    """Metrics of an answer cut short by a disconnect.
+
+    The savings are estimated from the average answer completed in this container, from max_tokens
+    and the pace of the cut answer before any has completed.
+    """
+    if completed_answers['count']:
+        expected_tokens = completed_answers['output_tokens'] / completed_answers['count']
+        seconds_per_token = completed_answers['seconds'] / max(1, completed_answers['output_tokens'])
+    else:
+        expected_tokens = MAX_OUTPUT_TOKENS
+        seconds_per_token = generation_seconds / output_tokens if output_tokens and generation_seconds else None
+    tokens_saved = max(0, round(expected_tokens - output_tokens))
+    trace.record("ClientDisconnected", 1, "Count")
+    trace.record("OutputTokensSaved", tokens_saved, "Count")
+    if seconds_per_token:
+        trace.record("GenerationSecondsSaved", tokens_saved * seconds_per_token, "Seconds")
+    print(f"Client disconnected after [{output_tokens}] output tokens, stopped the answer saving about [{tokens_saved}] tokens")
+
+def end_session(session_id):
+    store = get_session_store()
+    if store:
+        store.end(session_id)
+
+@instrumentation.timed("SessionSummary")
+def summarize_turns(summary, turns):
+    """Fold older conversation turns into the running summary with the model."""
+    bedrock = client_pool.get_client("bedrock-runtime", region_name=BEDROCK_REGION)
+    transcript = "\n".join(f"User: {question}\nAssistant: {answer}" for question, answer in turns)
+    instruction = f"""Summary so far: {summary or "(none)"}
+
+Conversation turns to add:
+{transcript}
+
+Rewrite the summary so it also covers these turns in at most 120 words. Keep the details a follow-up question may refer to, such as grades, dates, programs and names. Reply with the summary only."""
+    response = bedrock.invoke_model(
+        modelId=MODEL_ID,
+        contentType="application/json",
+        accept="application/json",
+        body=json.dumps({
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": 300,
+            "messages": [{"role": "user", "content": [{"type": "text", "text": instruction}]}]
+        })
+    )
+    return json.loads(response['body'].read())['content'][0]['text'].strip()
+
+def embed_query(text):
+    bedrock = client_pool.get_client("bedrock-runtime", region_name=BEDROCK_REGION)
+    response = bedrock.invoke_model(modelId=EMBEDDING_MODEL_ID, body=json.dumps({"inputText": text}))
+    return json.loads(response['body'].read())['embedding']
+
+def retrieval_filter(sources):
+    """Retrieve metadata filter on the source attribute of the section documents, None for no filter."""
+    if not sources:
+        return None
+    if len(sources) == 1:
+        return {"equals": {"key": "source", "value": sources[0]}}
+    return {"in": {"key": "source", "value": list(sources)}}
+
+def retrieve_from_knowledge_base(prompt, kb_version, sources=RETRIEVAL_SOURCES):
+    #Answer from the in-container snapshot when it matches the current knowledge base, otherwise call Retrieve.
+    #The snapshot holds whole documents without section metadata, so a filtered retrieval always calls Retrieve
+    index = get_local_index()
+    if index and kb_version is not None and not sources:
+        try:
+            if index.load(kb_version):
+                print(f"Retrieving from the local vector index...")
+                return index.retrieve(prompt, top_k=LOCAL_INDEX_TOP_K)
+        except Exception as e:
+            print(f"Local retrieval failed, falling back to the knowledge base: {str(e)}")
+
+    print(f"Finding in Knowledge Base with ID: [{KNOWLEDGE_BASE_ID}]...")
+    agent = client_pool.get_client("bedrock-agent-runtime")
+    query = {"text": prompt}
+    metadata_filter = retrieval_filter(sources)
+    if metadata_filter:
+        return agent.retrieve(
+            knowledgeBaseId=KNOWLEDGE_BASE_ID,
+            retrievalQuery=query,
+            retrievalConfiguration={"vectorSearchConfiguration": {"filter": metadata_filter}}
+        )
+    return agent.retrieve(knowledgeBaseId=KNOWLEDGE_BASE_ID, retrievalQuery=query)
+
+def new_coalescer(connection_id, trace):
+    gateway = client_pool.get_client("apigatewaymanagementapi", endpoint_url=URL)
+    return FrameCoalescer(
+        gateway,
+        connection_id,
+        max_bytes=FRAME_MAX_BYTES,
+        max_ms=FRAME_MAX_MS,
+        flush_on_sentence=FRAME_FLUSH_ON_SENTENCE,
+        trace=trace
+    )
+
+def replay_answer_to_api(answer, connection_id, trace):
+    #A cached or canned answer goes out through the same start/delta/end frames as a live one
+    coalescer = new_coalescer(connection_id, trace)
+    coalescer.start()
+    coalescer.add(answer)
+    coalescer.end()
+    trace.record("FramesSent", coalescer.frames_sent, "Count")
+    print(f"Replayed the answer in [{coalescer.frames_sent}] frames")
+
+def streamResponseToAPI(response, connectionId, trace=instrumentation.NOOP_TRACE, invoked_at=None):
+    print(f"Received response from LLM! Streaming to url: [{URL}]")
+    coalescer = new_coalescer(connectionId, trace)
+    answer = []
+    invoked_at = invoked_at or time.perf_counter()
+    first_token_at = None
+    output_tokens = None
+    usage = {}
+
+    #Convert the model specific API response into general packet with start/stop info, here converts from Claude API response (Could be done for any model)
+    stream = response.get('body')
+    try:
+        #for each returned token from the model:
+        for token in stream or []:
+
+            #The "chunk" contains the model-specific response
+            chunk = token.get('chunk')
+            if chunk:
+                
+                #Decode the LLm response body from bytes
+                chunk_text = json.loads(chunk['bytes'].decode('utf-8'))
+                
+                #Map the LLM response onto the start/delta/end frames, batching the deltas in between.
+                #Other events (message_start, message_delta, ...) carry no text and are not sent to the client
+                if chunk_text['type'] == "content_block_start":
+                    coalescer.start()
+                    
+                elif chunk_text['type'] == "content_block_delta":
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        trace.record("TimeToFirstToken", (first_token_at - invoked_at) * 1000)
+                    text = chunk_text['delta'].get('text', "")
+                    answer.append(text)
+                    coalescer.add(text)
+                    
+                elif chunk_text['type'] == "content_block_stop":
+                    coalescer.end()
+
+                elif chunk_text['type'] == "message_start":
+                    usage = chunk_text.get('message', {}).get('usage', {})
+
+                elif chunk_text['type'] == "message_delta":
+                    output_tokens = chunk_text.get('usage', {}).get('output_tokens')
+    except ConnectionGone:
+        #Closing the stream ends the generation, the rest of the answer would only be posted to a closed connection
+        stream.close()
+        record_disconnect(trace, coalescer.deltas_received,
+                         time.perf_counter() - first_token_at if first_token_at is not None else None)
+        raise
+
+    if first_token_at is not None:
+        output_tokens = output_tokens or coalescer.deltas_received
+        generation_seconds = time.perf_counter() - first_token_at
+        trace.record("OutputTokens", output_tokens, "Count")
+        completed_answers['count'] += 1
+        completed_answers['output_tokens'] += output_tokens
+        completed_answers['seconds'] += generation_seconds
+        if generation_seconds > 0:
+            trace.record("TokensPerSecond", output_tokens / generation_seconds, "Count/Second")
+    if usage:
+        #Prompt cache reads are billed at a fraction of input tokens, writes at a premium
+        trace.record("InputTokens", usage.get('input_tokens', 0), "Count")
+        trace.record("CacheReadInputTokens", usage.get('cache_read_input_tokens', 0), "Count")
+        trace.record("CacheWriteInputTokens", usage.get('cache_creation_input_tokens', 0), "Count")
+        print(f"Input tokens: [{usage.get('input_tokens', 0)}], read from prompt cache: [{usage.get('cache_read_input_tokens', 0)}], "
+              f"written to prompt cache: [{usage.get('cache_creation_input_tokens', 0)}]")
+    trace.record("FramesSent", coalescer.frames_sent, "Count")
+    print(f"Streamed [{coalescer.deltas_received}] deltas in [{coalescer.frames_sent}] frames")
+    return "".join(answer)
+
+def answer_question(connection_id, prompt, language_code, trace=instrumentation.NOOP_TRACE, session_id=None):
+    """Answer one message over the WebSocket connection, routing it first.
+
+    Small talk and out of scope messages get a canned reply without retrieval, school questions
+    the full answer of answer_from_knowledge_base. The time of each route is recorded as its own metric.
+    """
+    language = prompts.language_name(language_code)
+
+    print(f"Question asked: [{prompt}]")
+    print(f"Received Language Code: [{language_code}], Output language parameter: [{language}]")
+    
+    if prompt:
+        started = time.perf_counter()
+        route = route_message(prompt, language_code, trace)
+        try:
+            if route.name != intent_router.SCHOOL:
+                return reply_without_retrieval(route, connection_id, language_code, trace)
+            return answer_from_knowledge_base(connection_id, prompt, language_code, trace, session_id)
+        finally:
+            trace.record(ROUTE_METRICS[route.name], (time.perf_counter() - started) * 1000)
+    return {
+        'statusCode': 200
+    }
+
+def route_message(prompt, language_code, trace):
+    """Route of the message, a school question when routing is off or there is no canned reply in the language."""
+    with trace.timer("Routing"):
+        route = intent_router.route(prompt) if INTENT_ROUTING else intent_router.Route(intent_router.SCHOOL)
+        if route.intent and prompts.canned_reply(language_code, route.intent) is None:
+            route = intent_router.Route(intent_router.SCHOOL)
+    print(f"Routed the message to [{route.name}]{f', intent [{route.intent}]' if route.intent else ''}")
+    return route
+
+def reply_without_retrieval(route, connection_id, language_code, trace):
+    #Small talk is not kept in the history, a following question still counts as a fresh conversation
+    try:
+        replay_answer_to_api(prompts.canned_reply(language_code, route.intent), connection_id, trace)
+    except ConnectionGone:
+        print(f"Connection [{connection_id}] is gone, the reply was not delivered")
+    return {
+        'statusCode': 200
+    }
+
+def answer_from_knowledge_base(connection_id, prompt, language_code, trace, session_id):
+    """Retrieve, generate and stream the answer to a school question.
+
+    History is kept per session_id, the frontend sends one per page load since it opens a new
+    connection for every question. Without one the connection ID is used.
+    """
+    kb_version = current_kb_version()
+    store = get_session_store()
+    session_id = session_id or connection_id
+    session = store.load(session_id) if store else session_store.Session()
+    trace.record("SessionTurns", len(session.turns), "Count")
+
+    #A follow-up depends on the earlier turns, so only a fresh conversation can share cached answers
+    cache = get_answer_cache() if session.empty() else None
+    cached_answer = cache.get(prompt, language_code, kb_version) if cache else None
+    if cache:
+        trace.record("AnswerCacheHit", 1 if cached_answer else 0, "Count")
+    if cached_answer:
+        print(f"Answer cache hit for knowledge base version [{kb_version}]")
+        try:
+            replay_answer_to_api(cached_answer, connection_id, trace)
+        except ConnectionGone:
+            print(f"Connection [{connection_id}] is gone, the cached answer was not delivered")
+            return {
+                'statusCode': 200
+            }
+        if store:
+            store.append(session_id, session, prompt, cached_answer)
+        return {
+            'statusCode': 200
+        }
+
+    queries = reformulate(prompt) if CONTEXT_MULTI_QUERY else [prompt]
+    if session.last_question():
+        #Follow-ups like "what about for 8th grade?" also retrieve with the previous question for context
+        queries.append(f"{session.last_question()} {prompt}")
+    with trace.timer("Retrieve"):
+        results = retrieve_all(lambda query: retrieve_from_knowledge_base(query, kb_version), queries)
+    print(f"Updating the prompt for LLM...")
+    context = pack_context(results, token_budget=CONTEXT_TOKEN_BUDGET, dedupe_threshold=CONTEXT_DEDUPE_THRESHOLD)
+    print(f"Packed [{len(context.texts)}] of [{len(results)}] chunks from [{len(queries)}] queries into [{context.tokens}] tokens, "
+          f"saved [{context.tokens_saved}] tokens ([{context.duplicates}] duplicates, [{context.over_budget}] over budget)")
+    trace.record("ContextTokensSaved", context.tokens_saved, "Count")
+    full_prompt = prompts.user_prompt(language_code, context.texts, prompt)
+
+    bedrock = client_pool.get_client("bedrock-runtime", region_name=BEDROCK_REGION)
+
+    kwargs = {
+        "modelId": MODEL_ID,
+        "contentType": "application/json",
+        "accept": "application/json",
+        "body": request_builder.body(language_code, session.messages(full_prompt))
+    }
+    print(f"Sending query to LLM...")
+    #A parent who closed the tab while the context was retrieved is known before the first token arrives
+    closed = background.submit(connection_closed, connection_id)
+    invoked_at = time.perf_counter()
+    response = bedrock.invoke_model_with_response_stream(**kwargs)
+    if closed.result():
+        print(f"Connection [{connection_id}] was closed before the answer started")
+        response['body'].close()
+        record_disconnect(trace, 0)
+        return {
+            'statusCode': 200
+        }
+    try:
+        answer = streamResponseToAPI(response, connection_id, trace, invoked_at)
+    except ConnectionGone:
+        #Returning normally keeps the async invocation from being retried for a client that is gone.
+        #The partial answer is neither cached nor kept in the history
+        return {
+            'statusCode': 200
+        }
+    if cache:
+        cache.put(prompt, language_code, kb_version, answer)
+    if store:
+        store.append(session_id, session, prompt, answer)
+    print("Response processing complete!")
+    return {
+        'statusCode': 200
+    }
\ No newline at end of file
@@ -0,0 +1,44 @@
+import os
+import threading
+
+# Connection tuning, read once per container
+MAX_POOL_CONNECTIONS = int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', '20'))
+CONNECT_TIMEOUT = int(os.environ.get('CLIENT_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = int(os.environ.get('CLIENT_READ_TIMEOUT', '120'))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _create_client(service_name, **kwargs):
+    # boto3 is imported on first use so the module itself is cheap to import during a cold start
+    import boto3
+    from botocore.config import Config
+
+    config = Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        retries={'max_attempts': 3, 'mode': 'standard'}
+    )
+    return boto3.client(service_name, config=config, **kwargs)
+
+
+def get_client(service_name, **kwargs):
+    """Return the container-wide client for a service, creating it on first use."""
+    key = (service_name, tuple(sorted(kwargs.items())))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _create_client(service_name, **kwargs)
+                _clients[key] = client
+    return client
+
+
+def reset():
+    """Drop every pooled client, the next request builds them again."""
+    with _lock:
+        _clients.clear()
@@ -0,0 +1,94 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# Words dropped when building the keyword-only reformulation of a question
+STOPWORDS = set("""
+a an and are at be can do does for from how i in is it me my of on or our the there this to us was we what
+when where which who why will with you your
+a al como con cual cuales cuando de del donde el en es esta hay la las lo los me mi mis para por que quien
+se su sus un una y yo cómo cuál cuáles cuándo dónde está qué quién
+""".split())
+
+
+def estimate_tokens(text):
+    """Rough Claude token count, about four characters per token."""
+    return max(1, len(text) // 4)
+
+
+def _shingles(text, size=5):
+    words = re.findall(r'\w+', text.lower())
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _overlap(a, b):
+    # Containment rather than Jaccard so a chunk repeated inside a longer one also counts as a duplicate
+    return len(a & b) / (min(len(a), len(b)) or 1)
+
+
+class PackedContext:
+    def __init__(self, texts, tokens, original_tokens, duplicates, over_budget):
+        self.texts = texts
+        self.tokens = tokens
+        self.original_tokens = original_tokens
+        self.duplicates = duplicates
+        self.over_budget = over_budget
+
+    @property
+    def tokens_saved(self):
+        return self.original_tokens - self.tokens
+
+
+def pack_context(results, token_budget=2000, dedupe_threshold=0.8):
+    """Order retrieval results by score, drop near-duplicates and stop at the token budget."""
+    ordered = sorted(results, key=lambda result: result.get('score', 0.0), reverse=True)
+    texts, kept_shingles = [], []
+    tokens = original_tokens = duplicates = over_budget = 0
+
+    for result in ordered:
+        text = result['content']['text'].strip()
+        chunk_tokens = estimate_tokens(text)
+        original_tokens += chunk_tokens
+
+        shingles = _shingles(text)
+        if any(_overlap(shingles, kept) >= dedupe_threshold for kept in kept_shingles):
+            duplicates += 1
+            continue
+        if tokens + chunk_tokens > token_budget:
+            over_budget += 1
+            continue
+
+        # Section documents carry their section in the metadata, the label tells the model where a chunk is from
+        section = result.get('metadata', {}).get('section')
+        texts.append(f"[{section}] {text}" if section else text)
+        kept_shingles.append(shingles)
+        tokens += chunk_tokens
+
+    return PackedContext(texts, tokens, original_tokens, duplicates, over_budget)
+
+
+def reformulate(prompt):
+    """Extra queries for the same question, currently the question reduced to its keywords."""
+    queries = [prompt]
+    keywords = " ".join(word for word in re.findall(r'\w+', prompt.lower()) if word not in STOPWORDS)
+    if keywords and keywords != prompt.lower().strip():
+        queries.append(keywords)
+    return queries
+
+
+def retrieve_all(retrieve_fn, queries):
+    """Run the queries in parallel and merge the results, keeping the best score of each chunk."""
+    if len(queries) == 1:
+        return retrieve_fn(queries[0])['retrievalResults']
+
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        responses = list(executor.map(retrieve_fn, queries))
+
+    merged = {}
+    for response in responses:
+        for result in response['retrievalResults']:
+            text = result['content']['text']
+            if text not in merged or result.get('score', 0.0) > merged[text].get('score', 0.0):
+                merged[text] = result
+    return list(merged.values())
@@ -0,0 +1,81 @@
+import json
+import time
+import instrumentation
+
+# A delta ending in one of these closes a sentence (or a markdown line) and is a natural point to flush
+SENTENCE_ENDINGS = ('.', '!', '?', ':', ';', '\n')
+
+
+class ConnectionGone(Exception):
+    """The client has disconnected, API Gateway answered a post to its connection with 410 Gone."""
+
+
+class FrameCoalescer:
+    """Batches model deltas into fewer WebSocket frames while keeping the start/delta/end protocol."""
+
+    def __init__(self, gateway, connection_id, max_bytes=1024, max_ms=200, flush_on_sentence=True,
+                 trace=instrumentation.NOOP_TRACE):
+        self.gateway = gateway
+        self.connection_id = connection_id
+        self.max_bytes = max_bytes
+        self.max_ms = max_ms
+        self.flush_on_sentence = flush_on_sentence
+        self.trace = trace
+        self.frames_sent = 0
+        self.deltas_received = 0
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+
+    def _post(self, block_type, text=""):
+        data = {
+            'statusCode': 200,
+            'type': block_type,
+            'text': text
+        }
+        with self.trace.timer("PostToConnection"):
+            try:
+                self.gateway.post_to_connection(ConnectionId=self.connection_id, Data=json.dumps(data))
+            except self.gateway.exceptions.GoneException as e:
+                raise ConnectionGone(self.connection_id) from e
+        self.frames_sent += 1
+        self._last_flush = time.monotonic()
+
+    def start(self):
+        self._post("start")
+
+    def add(self, text):
+        """Queue a delta, flushing when the policy says the buffer is due."""
+        if not text:
+            return
+        self.deltas_received += 1
+
+        #Send the very first delta on its own so the time to first token is not delayed by batching
+        if self.deltas_received == 1:
+            self._post("delta", text)
+            return
+
+        self._buffer.append(text)
+        self._buffered_bytes += len(text.encode('utf-8'))
+        if self._should_flush(text):
+            self.flush()
+
+    def _should_flush(self, text):
+        if self._buffered_bytes >= self.max_bytes:
+            return True
+        if self.flush_on_sentence and text.rstrip(' ').endswith(SENTENCE_ENDINGS):
+            return True
+        #The age of the buffer is checked as deltas arrive, the model streams steadily enough that no timer is needed
+        return (time.monotonic() - self._last_flush) * 1000 >= self.max_ms
+
+    def flush(self):
+        if not self._buffer:
+            return
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._post("delta", text)
+
+    def end(self):
+        self.flush()
+        self._post("end")
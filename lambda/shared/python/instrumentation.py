@@ -0,0 +1,131 @@
+"""Per-request stage timings published as CloudWatch Embedded Metric Format log lines.
+
+Shared by every Lambda through the kp-shared-layer. With METRICS_ENABLED unset or 'false'
+start_trace() hands out a no-op trace and timed() returns the function untouched, so
+instrumented code costs next to nothing when the switch is off.
+"""
+import contextvars
+import functools
+import json
+import os
+import time
+import uuid
+
+ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'KelvynParkChatAssistant')
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+class _Timer:
+    """Context manager that records the elapsed milliseconds of a stage."""
+
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.record(self.stage, (time.perf_counter() - self.started) * 1000)
+        return False
+
+
+class Trace:
+    """Metrics of one request, emitted as a single EMF record."""
+
+    def __init__(self, function_name, trace_id=None):
+        self.function_name = function_name
+        self.trace_id = trace_id or new_trace_id()
+        self.metrics = {}
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def record(self, name, value, unit='Milliseconds'):
+        self.metrics.setdefault(name, (unit, []))[1].append(value)
+
+    def emit(self):
+        if not self.metrics:
+            return
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in self.metrics.items()]
+                }]
+            },
+            'Function': self.function_name,
+            'TraceId': self.trace_id,
+        }
+        # A list value is published as several samples, CloudWatch keeps the distribution for percentiles
+        for name, (_, values) in self.metrics.items():
+            record[name] = values[0] if len(values) == 1 else values
+        print(json.dumps(record))
+        self.metrics = {}
+
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class _NoopTrace:
+    """Stands in for Trace when metrics are disabled, every method does nothing."""
+
+    function_name = None
+    metrics = {}
+
+    def __init__(self):
+        self.trace_id = None
+        self._timer = _NoopTimer()
+
+    def timer(self, stage):
+        return self._timer
+
+    def record(self, name, value, unit='Milliseconds'):
+        pass
+
+    def emit(self):
+        pass
+
+
+NOOP_TRACE = _NoopTrace()
+
+
+def start_trace(function_name, trace_id=None):
+    """Begin the trace of a request and make it the current one for timed() functions."""
+    if not ENABLED:
+        return NOOP_TRACE
+    trace = Trace(function_name, trace_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get() or NOOP_TRACE
+
+
+def timed(stage):
+    """Decorator recording each call of the function as a stage of the current trace."""
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with current_trace().timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,76 @@
+"""Local routing of a chat message before retrieval: small talk, out of scope or a school question.
+
+Only a message made of nothing but small talk phrases ("Hello!", "¿Cómo estás?", "Thanks") and
+off-topic requests ("Tell me a joke", "What's the weather today?") is routed away from retrieval.
+A message with any other word, such as "What is the weather forecast for the field day?", is a
+school question, so a misrouted message costs a full answer rather than a wrong one.
+"""
+import re
+from text_normalize import normalize
+
+SMALL_TALK = 'small_talk'
+OUT_OF_SCOPE = 'out_of_scope'
+SCHOOL = 'school'
+
+# Small talk intents in priority order, the first one found in a message picks the reply.
+# Patterns match the normalized message: lower case, no accents, no punctuation
+SMALL_TALK_PATTERNS = [
+    ('who_are_you', r"who are you|what are you|what s your name|whats your name|what is your name"
+                    r"|quien eres|quien es usted|como te llamas|cual es tu nombre"),
+    ('how_are_you', r"how are you( doing)?|how s it going|hows it going|what s up|whats up"
+                    r"|como estas|como esta usted|como te va|que tal"),
+    ('help', r"can you help( me)?|could you help( me)?|i need help|help me"
+             r"|puedes ayudarme|me puedes ayudar|puede ayudarme|me puede ayudar|necesito ayuda"),
+    ('thanks', r"thank you( very much| so much)?|thanks( a lot| so much)?|thx"
+               r"|muchas gracias|gracias|muy amable"),
+    ('goodbye', r"goodbye|bye|see you( later)?|adios|hasta luego|hasta pronto|chao"),
+    ('greeting', r"hello|hi|hey|hiya|good (morning|afternoon|evening)"
+                 r"|hola|buenos dias|buenas tardes|buenas noches|buenas|saludos"),
+]
+# Words that may be left around the phrases of a small talk message
+FILLER_WORDS = set("""
+luisa there please ok okay oh so and again all everyone you very much
+por favor y pues muy
+""".split())
+
+# Whole requests for something unrelated to school, out of scope only when nothing else is left in the message
+OFF_TOPIC_PATTERNS = [
+    r"((can|could) you )?(tell me|tell|know|say) (a|any|some|another|me a) (funny |good )?jokes?",
+    r"(cuentame|dime|cuenteme|sabes) (un|algun|otro) chiste( gracioso)?",
+    r"(what s|whats|what is|how s|hows|how is) the weather( like)?( today| tomorrow| this weekend)?",
+    r"(what s|whats|what is) the (weather )?forecast( for)?( today| tomorrow| this weekend)?",
+    r"(que tiempo hace|como esta el clima|como estara el clima|cual es el pronostico)( hoy| manana| este fin de semana)?",
+    r"((can|could) you )?write (me )?(a|another) (poem|song)",
+    r"(escribeme|escribe) (un|otro) (poema|cancion)",
+    r"(what s|whats|what is|read) my horoscope( today)?|(cual es )?mi horoscopo( de hoy)?",
+    r"(what s|whats|what is) the (bitcoin|stock) price( today)?|(cual es )?el precio del bitcoin( hoy)?",
+]
+
+_small_talk = [(intent, re.compile(rf"\b({pattern})\b")) for intent, pattern in SMALL_TALK_PATTERNS]
+_off_topic = re.compile(rf"\b({'|'.join(OFF_TOPIC_PATTERNS)})\b")
+
+
+class Route:
+    """Where a message goes, intent names the canned reply of a small talk or out of scope message."""
+
+    def __init__(self, name, intent=None):
+        self.name = name
+        self.intent = intent
+
+
+def route(message):
+    text = normalize(message)
+    intents = []
+    remaining = text
+    for intent, pattern in _small_talk:
+        remaining, found = pattern.subn(" ", remaining)
+        if found:
+            intents.append(intent)
+    remaining, off_topic = _off_topic.subn(" ", remaining)
+    if set(remaining.split()) - FILLER_WORDS:
+        return Route(SCHOOL)
+    if off_topic:
+        return Route(OUT_OF_SCOPE, OUT_OF_SCOPE)
+    if intents:
+        return Route(SMALL_TALK, intents[0])
+    return Route(SCHOOL)
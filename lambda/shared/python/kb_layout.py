@@ -0,0 +1,9 @@
+"""Names shared by email-handler, which writes the knowledge base state, and the chat functions that read it."""
+
+# Written by email-handler whenever the knowledge base content changes
+KB_VERSION_KEY = 'kb-version.json'
+
+# Chunk embedding snapshots of the email-handler documents, for local retrieval
+SNAPSHOT_PREFIX = 'vector-index/'
+MANIFEST_KEY = f'{SNAPSHOT_PREFIX}manifest.json'
+EMBEDDING_MODEL_ID = 'amazon.titan-embed-text-v1'
@@ -0,0 +1,116 @@
+import hashlib
+import importlib.util
+import json
+import os
+import threading
+import time
+from kb_layout import MANIFEST_KEY
+
+# NumPy is optional (without it every query goes to the managed Retrieve API) and imported only once the index is used
+np = None
+
+
+class LocalIndex:
+    """Top-k cosine search over the chunk snapshot of the knowledge base, memory-mapped from /tmp.
+
+    The snapshot covers the documents written by email-handler only, not the web crawler data source.
+    load() is safe to call from the retrieval worker threads. Each version is downloaded to its own
+    files, so a snapshot still memory-mapped by a running search is never overwritten.
+    """
+
+    def __init__(self, s3, bucket, embed_fn, cache_dir='/tmp/vector-index', recheck_seconds=60):
+        self.s3 = s3
+        self.bucket = bucket
+        self.embed_fn = embed_fn
+        self.cache_dir = cache_dir
+        self.recheck_seconds = recheck_seconds
+        self._version = None
+        self._parts = []
+        self._stale_version = None
+        self._stale_checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def available():
+        return importlib.util.find_spec('numpy') is not None
+
+    def load(self, kb_version):
+        """Make the snapshot for kb_version searchable, False when it is missing or stale."""
+        if self._version == kb_version:
+            return True
+        with self._lock:
+            return self._load(kb_version)
+
+    def _load(self, kb_version):
+        # Another thread may have loaded this version while this one waited for the lock
+        if self._version == kb_version:
+            return True
+        if self._stale_version == kb_version and time.monotonic() - self._stale_checked_at < self.recheck_seconds:
+            return False
+
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=MANIFEST_KEY)
+            manifest = json.loads(response['Body'].read().decode('utf-8'))
+        except self.s3.exceptions.NoSuchKey:
+            manifest = None
+        if manifest is None or manifest['kb_version'] != kb_version or not manifest.get('parts'):
+            print(f"Local vector snapshot does not match knowledge base version [{kb_version}]")
+            self._stale_version = kb_version
+            self._stale_checked_at = time.monotonic()
+            return False
+
+        global np
+        if np is None:
+            import numpy as np
+        started = time.perf_counter()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        version_tag = hashlib.sha256(str(kb_version).encode('utf-8')).hexdigest()[:16]
+        parts = []
+        paths = set()
+        # Parts are never overwritten, so the vectors and chunks of a source always belong together
+        for source, part in sorted(manifest['parts'].items()):
+            path = os.path.join(self.cache_dir, f"{source}-{version_tag}.npy")
+            paths.add(path)
+            response = self.s3.get_object(Bucket=self.bucket, Key=part['vectors'])
+            with open(path + '.tmp', 'wb') as snapshot_file:
+                for data in iter(lambda: response['Body'].read(1024 * 1024), b''):
+                    snapshot_file.write(data)
+            os.replace(path + '.tmp', path)
+            response = self.s3.get_object(Bucket=self.bucket, Key=part['chunks'])
+            metadata = json.loads(response['Body'].read().decode('utf-8'))
+            parts.append((np.load(path, mmap_mode='r'), metadata))
+        self._parts = parts
+        self._version = kb_version
+        # Snapshots of older versions are unlinked, a search still mapping one keeps reading it until it unmaps
+        for name in os.listdir(self.cache_dir):
+            if os.path.join(self.cache_dir, name) not in paths:
+                os.remove(os.path.join(self.cache_dir, name))
+        print(f"Loaded local vector snapshot {manifest['sources']} in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return True
+
+    def retrieve(self, query_text, top_k=5):
+        """Return the top_k chunks in the shape of a bedrock-agent-runtime Retrieve response."""
+        query = np.asarray(self.embed_fn(query_text), dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        candidates = []
+        for vectors, metadata in self._parts:
+            if len(vectors) == 0:
+                continue
+            # Rows are stored unit-length, so the dot product is the cosine similarity
+            scores = vectors @ query
+            k = min(top_k, len(scores))
+            for row in np.argpartition(-scores, k - 1)[:k]:
+                candidates.append((float(scores[row]), metadata['chunks'][row], metadata['uri']))
+
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        return {
+            'retrievalResults': [
+                {
+                    'content': {'text': text},
+                    'location': {'type': 'S3', 's3Location': {'uri': uri}},
+                    'score': score
+                }
+                for score, text, uri in candidates[:top_k]
+            ]
+        }
@@ -0,0 +1,118 @@
+"""Prompt templates of the chat assistant, rendered once per supported language at import.
+
+To support another language add it to LANGUAGES, the frontend sends its code as 'Language'.
+"""
+import json
+
+LANGUAGES = {
+    'EN': 'English',
+    'ES': 'Spanish',
+}
+DEFAULT_LANGUAGE = 'EN'
+
+SYSTEM_TEMPLATE = """You are Luisa, a friendly assistant for Kelvyn Park Junior & Senior High School. Your role is to help parents and students with information about the school. Always respond in {language}, even if the query is in another language. Be concise, warm, and conversational, like a helpful school staff member.
+For general queries, be friendly and offer school-related help. Examples:
+- "Hello!": "Hello, I am Luisa! How can I assist you with Kelvyn Park Junior & Senior High School today?"
+- "How are you?": "I'm well, thanks! What would you like to know about our school?"
+- "Can you help?": "Absolutely! What Kelvyn Park Junior & Senior High School information do you need?"
+- "Who are you?": "Hi! I'm Luisa, your guide to Kelvyn Park Junior & Senior High School. How can I help you today?"
+
+Guidelines:
+1. Always respond ONLY in {language}.
+2. Do NOT introduce yourself in every message. Assume the conversation is ongoing.
+3. DO NOT use phrases like "Based on the information provided" or "According to the search results" in your responses.
+4. Use the information you have about the school to answer questions directly and confidently.
+5. If unsure, politely say so and offer to help with other information.
+6. Verify any information mentioned by the user against what you know about the school.
+7. Stay positive and supportive in your responses.
+8. Provide concise answers. Offer to elaborate if the user wants more details.
+9. Gently redirect non-school topics to school matters.
+
+Your goal: Have helpful, natural conversations about Kelvyn Park Junior & Senior High School in {language}, as if you are a knowledegeable staff member."""
+
+# The question and the retrieved text are concatenated between these parts, they may contain braces
+CONTEXT_PREFIX_TEMPLATE = """Use the following information about Kelvyn Park Junior & Senior High School to help answer the user's question. Respond naturally in {language} without mentioning the source of this information:
+
+RELEVENT SCHOOL INFORMATION:
+"""
+QUESTION_PREFIX = "\nUser's question: "
+CLOSING_TEMPLATE = "\n\nProvide a natural, conversational response to the user's message in {language}."
+
+SYSTEM_PROMPTS = {code: SYSTEM_TEMPLATE.format(language=name) for code, name in LANGUAGES.items()}
+CONTEXT_PREFIXES = {code: CONTEXT_PREFIX_TEMPLATE.format(language=name) for code, name in LANGUAGES.items()}
+CLOSINGS = {code: CLOSING_TEMPLATE.format(language=name) for code, name in LANGUAGES.items()}
+
+CACHE_CHECKPOINT = {"type": "ephemeral"}
+
+# Replies to messages the intent router sends past retrieval, the exchanges of the system prompt in each language
+CANNED_REPLIES = {
+    'EN': {
+        'greeting': "Hello, I am Luisa! How can I assist you with Kelvyn Park Junior & Senior High School today?",
+        'how_are_you': "I'm well, thanks! What would you like to know about our school?",
+        'help': "Absolutely! What Kelvyn Park Junior & Senior High School information do you need?",
+        'who_are_you': "Hi! I'm Luisa, your guide to Kelvyn Park Junior & Senior High School. How can I help you today?",
+        'thanks': "You're welcome! Is there anything else you would like to know about our school?",
+        'goodbye': "Goodbye! Come back any time you have a question about Kelvyn Park Junior & Senior High School.",
+        'out_of_scope': "I can only help with questions about Kelvyn Park Junior & Senior High School. "
+                        "What would you like to know about our school?",
+    },
+    'ES': {
+        'greeting': "¡Hola, soy Luisa! ¿Cómo puedo ayudarle hoy con Kelvyn Park Junior & Senior High School?",
+        'how_are_you': "¡Estoy bien, gracias! ¿Qué le gustaría saber sobre nuestra escuela?",
+        'help': "¡Por supuesto! ¿Qué información de Kelvyn Park Junior & Senior High School necesita?",
+        'who_are_you': "¡Hola! Soy Luisa, su guía de Kelvyn Park Junior & Senior High School. ¿Cómo puedo ayudarle hoy?",
+        'thanks': "¡De nada! ¿Hay algo más que le gustaría saber sobre nuestra escuela?",
+        'goodbye': "¡Adiós! Vuelva cuando tenga alguna pregunta sobre Kelvyn Park Junior & Senior High School.",
+        'out_of_scope': "Solo puedo ayudar con preguntas sobre Kelvyn Park Junior & Senior High School. "
+                        "¿Qué le gustaría saber sobre nuestra escuela?",
+    },
+}
+
+
+def language_name(language_code):
+    return LANGUAGES.get(language_code, LANGUAGES[DEFAULT_LANGUAGE])
+
+
+def canned_reply(language_code, intent):
+    """Reply for the intent in the language, None when there is none and the model should answer."""
+    code = language_code if language_code in LANGUAGES else DEFAULT_LANGUAGE
+    return CANNED_REPLIES.get(code, {}).get(intent)
+
+
+def user_prompt(language_code, context_texts, question):
+    """The retrieval wrapped question sent as the last user message."""
+    code = language_code if language_code in LANGUAGES else DEFAULT_LANGUAGE
+    return CONTEXT_PREFIXES[code] + "\n".join(context_texts) + "\n" + QUESTION_PREFIX + question + CLOSINGS[code]
+
+
+class RequestBuilder:
+    """Serializes invoke_model request bodies from a skeleton prebuilt per language.
+
+    The anthropic_version, max_tokens and system prompt are serialized once, each request only
+    serializes its messages. With prompt_caching the system prompt, and the conversation history when
+    there is one, end with a cache checkpoint so repeated requests read the prefix from the Bedrock
+    prompt cache instead of processing it again. Bedrock only caches prefixes above a model specific
+    minimum length on models that support prompt caching, it ignores the checkpoints otherwise.
+    """
+
+    def __init__(self, max_tokens=1000, prompt_caching=False):
+        self.prompt_caching = prompt_caching
+        self._skeletons = {}
+        for code, system_prompt in SYSTEM_PROMPTS.items():
+            system = {"type": "text", "text": system_prompt}
+            if prompt_caching:
+                system["cache_control"] = CACHE_CHECKPOINT
+            skeleton = json.dumps({
+                "anthropic_version": "bedrock-2023-05-31",
+                "max_tokens": max_tokens,
+                "system": [system],
+            })
+            # Drop the closing brace, the messages are appended per request
+            self._skeletons[code] = skeleton[:-1] + ', "messages": '
+
+    def body(self, language_code, messages):
+        code = language_code if language_code in self._skeletons else DEFAULT_LANGUAGE
+        if self.prompt_caching and len(messages) > 1:
+            # The history before the new question is the same on the next turn
+            messages[-2]["content"][-1]["cache_control"] = CACHE_CHECKPOINT
+        return self._skeletons[code] + json.dumps(messages) + "}"
@@ -0,0 +1,106 @@
+import hashlib
+
+from answer_cache import MemoryBackend, S3Backend  # noqa: F401 - the session backends are the answer cache ones
+from context_packer import estimate_tokens
+
+
+def session_key(session_id):
+    return hashlib.sha256(session_id.encode('utf-8')).hexdigest()
+
+
+class Session:
+    """Conversation so far: a running summary of the older turns and the recent (question, answer) turns."""
+
+    def __init__(self, summary='', turns=None):
+        self.summary = summary
+        self.turns = turns or []
+
+    def empty(self):
+        return not self.summary and not self.turns
+
+    def tokens(self):
+        return estimate_tokens(self.summary) + sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns)
+
+    def last_question(self):
+        return self.turns[-1][0] if self.turns else None
+
+    def messages(self, prompt):
+        """Alternating user/assistant messages of the history, ending with the new prompt."""
+        messages = []
+        for question, answer in self.turns:
+            messages.append({"role": "user", "content": [{"type": "text", "text": question}]})
+            messages.append({"role": "assistant", "content": [{"type": "text", "text": answer}]})
+        messages.append({"role": "user", "content": [{"type": "text", "text": prompt}]})
+        if self.summary:
+            first = messages[0]["content"][0]
+            first["text"] = f"Summary of the conversation so far: {self.summary}\n\n{first['text']}"
+        return messages
+
+    def to_dict(self):
+        return {'summary': self.summary, 'turns': self.turns}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('summary', ''), [tuple(turn) for turn in data.get('turns', [])])
+
+
+class SessionStore:
+    """Bounded conversation history per session, kept in a MemoryBackend or S3Backend (prefix 'sessions/').
+
+    Once the history passes token_budget, all but the newest turns that fit are folded into the running
+    summary by summarize_fn(summary, turns), so the messages sent to the model stay within the budget
+    however long the conversation gets. Sessions expire ttl_seconds after their last turn.
+    """
+
+    def __init__(self, backend, summarize_fn, token_budget=1500, ttl_seconds=1800):
+        self.backend = backend
+        self.summarize_fn = summarize_fn
+        self.token_budget = token_budget
+        self.ttl_seconds = ttl_seconds
+
+    def load(self, session_id):
+        try:
+            data = self.backend.get(session_key(session_id))
+        except Exception as e:
+            print(f"Session lookup failed, answering without history: {str(e)}")
+            data = None
+        return Session.from_dict(data) if data else Session()
+
+    def append(self, session_id, session, question, answer):
+        if not answer:
+            return
+        session.turns.append((question, answer))
+        if session.tokens() > self.token_budget:
+            self._compact(session)
+        try:
+            self.backend.put(session_key(session_id), session.to_dict(), self.ttl_seconds)
+        except Exception as e:
+            print(f"Session write failed: {str(e)}")
+
+    def end(self, session_id):
+        try:
+            self.backend.delete(session_key(session_id))
+        except Exception as e:
+            print(f"Session delete failed: {str(e)}")
+
+    def _compact(self, session):
+        #The summary gets a third of the budget, the newest turns that fit in the rest are kept verbatim
+        summary_budget = self.token_budget // 3
+        kept, used = [], 0
+        for question, answer in reversed(session.turns):
+            turn_tokens = estimate_tokens(question) + estimate_tokens(answer)
+            if used + turn_tokens > self.token_budget - summary_budget:
+                break
+            kept.insert(0, (question, answer))
+            used += turn_tokens
+        folded = session.turns[:len(session.turns) - len(kept)]
+        max_chars = summary_budget * 4
+        try:
+            summary = self.summarize_fn(session.summary, folded)[:max_chars]
+        except Exception as e:
+            #Without the model the newest questions are kept, the oldest text is dropped first
+            print(f"Session summary failed, keeping the questions only: {str(e)}")
+            summary = " ".join([session.summary] + [question for question, _ in folded]).strip()[-max_chars:]
+        session.summary = summary
+        session.turns = kept
+        print(f"Folded [{len(folded)}] turns into the session summary, kept [{len(kept)}]")
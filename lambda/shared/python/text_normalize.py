@@ -0,0 +1,9 @@
+import re
+import unicodedata
+
+
+def normalize(text):
+    """Fold case, accents, punctuation and spacing, so trivially different texts compare equal."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text).split())
@@ -1,31 +1,78 @@
 import os
 import json
+import time
 import boto3
+import instrumentation
+from prompts import DEFAULT_LANGUAGE, LANGUAGES
+
+# 'async' hands the question to get-response-from-bedrock, 'inline' answers it in this function
+CHAT_MODE = os.environ.get('CHAT_MODE', 'async').lower()
 
 lambda_client = boto3.client('lambda')
 api_client = boto3.client('apigatewaymanagementapi')
 
-def handle_message(event, connection_id):
-    response_function_arn = os.environ['RESPONSE_FUNCTION_ARN']
+def parse_message(event):
+    """Parse and validate the sendMessage body once, None when it is not a usable question."""
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except json.JSONDecodeError:
+        return None
+    prompt = body.get('prompt')
+    language = body.get('Language')
+    if not isinstance(prompt, str) or not prompt.strip():
+        return None
+    session_id = body.get('sessionId')
+    if language not in LANGUAGES:
+        language = DEFAULT_LANGUAGE
+    if not isinstance(session_id, str) or not session_id.strip():
+        session_id = None
+    return prompt, language, session_id
+
+def handle_message(event, connection_id, trace_id, trace):
+    message = parse_message(event)
+    if message is None:
+        return {'statusCode': 400, 'body': 'Invalid message'}
+    prompt, language, session_id = message
 
-    prompt = json.loads(event.get('body', '{}')).get('prompt')
-    language = json.loads(event.get('body', '{}')).get('Language')
-    
     print("Language from request: [" + language + "]")
     print("Prompt from user: [" + prompt + "]")
-    
+    print("Trace ID: [" + trace_id + "]")
+
+    if CHAT_MODE == 'inline':
+        return answer_inline(prompt, connection_id, language, session_id, trace)
+
     input = {
         "prompt": prompt,
         "connectionId": connection_id,
-        "language": language
+        "language": language,
+        "sessionId": session_id,
+        "traceId": trace_id,
+        "sentAt": time.time() * 1000
     }
 
-    lambda_client.invoke(
-        FunctionName=response_function_arn,
-        InvocationType='Event',
-        Payload=json.dumps(input)
-    )
-    
+    with trace.timer("Invoke"):
+        lambda_client.invoke(
+            FunctionName=os.environ['RESPONSE_FUNCTION_ARN'],
+            InvocationType='Event',
+            Payload=json.dumps(input)
+        )
+
+    return {'statusCode': 200}
+
+def answer_inline(prompt, connection_id, language, session_id, trace):
+    #The answer is streamed before returning, a background thread would be frozen with the container once the handler returns.
+    #Frames still reach the client if the answer outlasts the 29 second WebSocket integration timeout
+    import chat_pipeline
+    with trace.timer("Answer"):
+        return chat_pipeline.answer_question(connection_id, prompt, language, trace, session_id)
+
+def end_session(connection_id):
+    #Sessions keyed on the connection end with it, the ones keyed on a frontend sessionId expire after their TTL.
+    #With the memory backend this only reaches the history held by this container (inline mode)
+    import chat_pipeline
+    chat_pipeline.end_session(connection_id)
+    #An answer still being retrieved for this connection is dropped before the model is called
+    chat_pipeline.mark_connection_closed(connection_id)
     return {'statusCode': 200}
 
 def lambda_handler(event, context):
@@ -33,6 +80,13 @@ def lambda_handler(event, context):
     connection_id = event.get('requestContext', {}).get('connectionId')
 
     if route_key == 'sendMessage':
-        return handle_message(event, connection_id)
+        trace_id = instrumentation.new_trace_id()
+        trace = instrumentation.start_trace("web-socket-handler", trace_id)
+        try:
+            return handle_message(event, connection_id, trace_id, trace)
+        finally:
+            trace.emit()
+    elif route_key == '$disconnect':
+        return end_session(connection_id)
     else:
-        return {'statusCode': 400, 'body': 'Unsupported route'}
\ No newline at end of file
+        return {'statusCode': 400, 'body': 'Unsupported route'}
@@ -2,10 +2,15 @@ import * as cdk from 'aws-cdk-lib';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
 import * as apigatewayv2 from '@aws-cdk/aws-apigatewayv2-alpha';
 import * as apigatewayv2_integrations from '@aws-cdk/aws-apigatewayv2-integrations-alpha';
+import * as events from 'aws-cdk-lib/aws-events';
+import * as eventsTargets from 'aws-cdk-lib/aws-events-targets';
 import * as iam from 'aws-cdk-lib/aws-iam';
 import * as s3 from 'aws-cdk-lib/aws-s3';
 import * as ses from 'aws-cdk-lib/aws-ses';
 import * as sesActions from 'aws-cdk-lib/aws-ses-actions';
+import * as sns from 'aws-cdk-lib/aws-sns';
+import * as snsSubscriptions from 'aws-cdk-lib/aws-sns-subscriptions';
+import * as sqs from 'aws-cdk-lib/aws-sqs';
 import { bedrock } from '@cdklabs/generative-ai-cdk-constructs';
 import * as amplify from '@aws-cdk/aws-amplify-alpha';
 import * as secretsmanager from 'aws-cdk-lib/aws-secretsmanager';
@@ -41,6 +46,9 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
       overlapPercentage: 20,
     });
 
+    // Days archived emails are kept, a backfill can only rebuild the documents from the emails still archived
+    const archiveRetentionDays = 365;
+
     // Create the S3 bucket to house the incoming emails
     const email_bucket = new s3.Bucket(this, 'kp-email-bucket', {
       lifecycleRules: [
@@ -48,7 +56,7 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
           id: 'Delete archived emails',
           enabled: true,
           prefix: 'archive/',
-          expiration: cdk.Duration.days(7),
+          expiration: cdk.Duration.days(archiveRetentionDays),
         },
         {
           id: 'Delete error emails',
@@ -67,11 +75,83 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
       removalPolicy: cdk.RemovalPolicy.DESTROY,
     });
 
+    // Create the S3 bucket to house runtime state (knowledge base version marker, shared answer cache)
+    const state_bucket = new s3.Bucket(this, 'kp-state-bucket', {
+      lifecycleRules: [
+        {
+          id: 'Delete cached answers',
+          enabled: true,
+          prefix: 'answer-cache/',
+          expiration: cdk.Duration.days(7),
+        },
+        {
+          id: 'Delete email processing checkpoints',
+          enabled: true,
+          prefix: 'checkpoints/',
+          expiration: cdk.Duration.days(7),
+        },
+        {
+          id: 'Delete conversation sessions',
+          enabled: true,
+          prefix: 'sessions/',
+          expiration: cdk.Duration.days(1),
+        },
+        {
+          id: 'Delete closed connection marks',
+          enabled: true,
+          prefix: 'closed-connections/',
+          expiration: cdk.Duration.days(1),
+        },
+      ],
+      autoDeleteObjects: true,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    // Layer with the Python modules shared by the Lambda functions (instrumentation, chat pipeline)
+    const sharedLayer = new lambda.LayerVersion(this, 'kp-shared-layer', {
+      code: lambda.Code.fromAsset('lambda/shared'),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_12],
+      description: 'Python modules shared by the Kelvyn Park chat assistant functions',
+    });
+
+    // Set to true for email-handler to wait on Textract completion notifications instead of polling the job status
+    const textractNotifications = false;
+    let textractNotificationEnvironment = {};
+    let textractNotificationQueue: sqs.Queue | undefined;
+    let textractNotificationRole: iam.Role | undefined;
+    if (textractNotifications) {
+      const textractTopic = new sns.Topic(this, 'kp-textract-topic', {
+        topicName: 'AmazonTextract-kp-job-completion',
+      });
+      textractNotificationQueue = new sqs.Queue(this, 'kp-textract-queue', {
+        retentionPeriod: cdk.Duration.hours(1),
+        visibilityTimeout: cdk.Duration.seconds(30),
+      });
+      textractTopic.addSubscription(new snsSubscriptions.SqsSubscription(textractNotificationQueue));
+      textractNotificationRole = new iam.Role(this, 'kp-textract-notification-role', {
+        assumedBy: new iam.ServicePrincipal('textract.amazonaws.com'),
+      });
+      textractTopic.grantPublish(textractNotificationRole);
+      textractNotificationEnvironment = {
+        TEXTRACT_NOTIFICATION_TOPIC_ARN: textractTopic.topicArn,
+        TEXTRACT_NOTIFICATION_ROLE_ARN: textractNotificationRole.roleArn,
+        TEXTRACT_NOTIFICATION_QUEUE_URL: textractNotificationQueue.queueUrl,
+      };
+    }
+
     // email-handler Lambda function
     const emailHandler = new lambda.Function(this, 'kp-email-handler', {
       runtime: lambda.Runtime.PYTHON_3_12,
-      code: lambda.Code.fromAsset('lambda/email-handler'),
+      // requirements.txt (pypdf for the PDF text layer, an SDK with S3 conditional writes for the ingestion state)
+      // is installed next to the handler code
+      code: lambda.Code.fromAsset('lambda/email-handler', {
+        bundling: {
+          image: lambda.Runtime.PYTHON_3_12.bundlingImage,
+          command: ['bash', '-c', 'pip install -r requirements.txt -t /asset-output && cp -au . /asset-output'],
+        },
+      }),
       handler: 'index.lambda_handler',
+      layers: [sharedLayer],
       memorySize: 2048,
       timeout: cdk.Duration.minutes(15),
       environment: {
@@ -79,13 +159,30 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
         DESTINATION_BUCKET_NAME: kb_bucket.bucketName,
         KNOWLEDGE_BASE_ID: kb.knowledgeBaseId,
         DATA_SOURCE_ID: s3_data_source.dataSourceId,
+        STATE_BUCKET_NAME: state_bucket.bucketName,
+        LOCAL_INDEX_ENABLED: 'false',  // Set to 'true' to publish chunk embedding snapshots for local retrieval
         MAX_RETRIES: '3',
         ENABLE_LIFECYCLE_RULE: 'true',  // Set to 'true' or 'false'
+        ARCHIVE_RETENTION_DAYS: String(archiveRetentionDays),  // Expiration of archive/ in the lifecycle rule
+        METRICS_ENABLED: 'true',  // Set to 'true' or 'false'
+        NEWSLETTER_MODEL_ID: 'anthropic.claude-3-sonnet-20240229-v1:0',  // Extracts the items of each newsletter issue
+        NEWSLETTER_DATED_RETENTION_DAYS: '7',  // Dated items leave the newsletter documents this long after their last date, undated ones stay until a new handbook
+        PDF_EXTRACTION: 'auto',  // Set to 'auto' (text layer first, pypdf is bundled from requirements.txt) or 'textract'
+        TEXTRACT_POLL_INITIAL_SECONDS: '1',  // First Textract status check, doubling up to the maximum
+        TEXTRACT_POLL_MAX_SECONDS: '10',
+        ATTACHMENT_SPOOL_MB: '8',  // Attachments larger than this are decoded to /tmp instead of memory
+        UPLOAD_PART_MB: '8',  // Multipart upload part size for attachments
+        ATTACHMENT_WORKERS: '2',  // Attachments of one email processed concurrently
+        INGESTION_DEBOUNCE_SECONDS: '60',  // Sync requests within this window share one ingestion job
+        BACKFILL_WORKERS: '8',  // Archived emails extracted concurrently by a backfill invocation
+        BACKFILL_TIME_MARGIN_SECONDS: '180',  // A backfill saves its progress and returns with this much time left
+        ...textractNotificationEnvironment,
       },
     })
 
     email_bucket.grantReadWrite(emailHandler);
     kb_bucket.grantReadWrite(emailHandler);
+    state_bucket.grantReadWrite(emailHandler);
 
     // Add Textract permissions to the Lambda function's role
     emailHandler.addToRolePolicy(new iam.PolicyStatement({
@@ -96,12 +193,18 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
       resources: ['*'],
     }));
 
+    if (textractNotificationQueue && textractNotificationRole) {
+      textractNotificationQueue.grantConsumeMessages(emailHandler);
+      textractNotificationRole.grantPassRole(emailHandler.grantPrincipal);
+    }
+
     // Additional permissions for S3 lifecycle management and SES
     emailHandler.addToRolePolicy(new iam.PolicyStatement({
       actions: [
         's3:PutLifecycleConfiguration',
         's3:GetLifecycleConfiguration',
         'bedrock:StartIngestionJob',
+        'bedrock:GetIngestionJob',
       ],
       resources: [
         email_bucket.bucketArn,
@@ -131,6 +234,12 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
 
     emailHandler.addToRolePolicy(bedrockPolicy);
 
+    // Starts debounced ingestion jobs and records finished ones, publishing the knowledge base version
+    new events.Rule(this, 'kp-ingestion-check', {
+      schedule: events.Schedule.rate(cdk.Duration.minutes(1)),
+      targets: [new eventsTargets.LambdaFunction(emailHandler)],
+    });
+
     // Create SES Receipt Rule Set
     const sesRuleSet = new ses.ReceiptRuleSet(this, 'kp-email-receipt-rule-set', {
       receiptRuleSetName: 'kp-email-processing-rule-set',
@@ -173,20 +282,38 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
 
     const webSocketApiArn = `arn:aws:execute-api:${this.region}:${this.account}:${webSocketApi.apiId}/${webSocketStage.stageName}/POST/@connections/*`;
 
-    // get-response-from-bedrock Lambda function
-    const getResponseFromBedrockLambda = new lambda.Function(this, 'kp-get-response-from-bedrock', {
-      runtime: lambda.Runtime.PYTHON_3_12,
-      code: lambda.Code.fromAsset('lambda/get-response-from-bedrock'),
-      handler: 'index.lambda_handler',
-      environment: {
-        URL: webSocketStage.callbackUrl,
-        KNOWLEDGE_BASE_ID: kb.knowledgeBaseId,
-      },
-      timeout: cdk.Duration.seconds(300),
-      memorySize: 256
-    });
-
-    getResponseFromBedrockLambda.addToRolePolicy(new iam.PolicyStatement({
+    // Model answering the questions, prompt caching needs a model that supports it on Bedrock
+    const chatModelId = 'anthropic.claude-3-haiku-20240307-v1:0';
+
+    // Settings of the shared chat pipeline, used by get-response-from-bedrock and by web-socket-handler in inline mode
+    const chatEnvironment = {
+      URL: webSocketStage.callbackUrl,
+      KNOWLEDGE_BASE_ID: kb.knowledgeBaseId,
+      MODEL_ID: chatModelId,
+      PROMPT_CACHING: 'false',  // Set to 'true' to add Bedrock prompt cache checkpoints to the system prompt and history
+      FRAME_MAX_BYTES: '1024',  // Flush buffered tokens once this many bytes are waiting
+      FRAME_MAX_MS: '200',  // Flush buffered tokens once the oldest one has waited this long
+      FRAME_FLUSH_ON_SENTENCE: 'true',  // Set to 'true' or 'false'
+      STATE_BUCKET_NAME: state_bucket.bucketName,
+      ANSWER_CACHE_BACKEND: 'memory',  // Set to 'memory', 's3' or 'none'
+      ANSWER_CACHE_TTL_SECONDS: '3600',
+      ANSWER_CACHE_MAX_ENTRIES: '256',
+      KB_VERSION_REFRESH_SECONDS: '30',  // How often the knowledge base version marker is re-read
+      LOCAL_INDEX_ENABLED: 'false',  // Set to 'true' to search the snapshot in-process (requires NumPy in the function)
+      LOCAL_INDEX_TOP_K: '5',
+      CONTEXT_TOKEN_BUDGET: '2000',  // Approximate cap on retrieved text tokens in the prompt
+      CONTEXT_DEDUPE_THRESHOLD: '0.8',  // Shingle overlap above which a chunk counts as a duplicate
+      CONTEXT_MULTI_QUERY: 'false',  // Set to 'true' to also retrieve with a keyword-only reformulation
+      RETRIEVAL_SOURCES: '',  // Set to a comma separated list ('handbook', 'newsletter') to retrieve only from those documents
+      INTENT_ROUTING: 'true',  // Set to 'false' to send greetings and off-topic messages through retrieval too
+      SESSION_BACKEND: 's3',  // Set to 's3', 'memory' (history kept per container, for local tests only) or 'none'
+      SESSION_TTL_SECONDS: '1800',  // Conversation history expires this long after the last question
+      SESSION_MAX_ENTRIES: '512',
+      SESSION_TOKEN_BUDGET: '1500',  // Older turns are folded into a summary past this many history tokens
+      METRICS_ENABLED: 'true',  // Set to 'true' or 'false'
+    };
+
+    const chatPolicy = new iam.PolicyStatement({
       actions: [
         'bedrock:InvokeModel',
         'bedrock-agent-runtime:Retrieve',
@@ -199,23 +326,47 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
       ],
       resources: [
         `arn:aws:bedrock:${this.region}:${this.account}:knowledge-base/${kb.knowledgeBaseId}`,
-        `arn:aws:bedrock:${this.region}::foundation-model/anthropic.claude-3-haiku-20240307-v1:0`,
+        `arn:aws:bedrock:${this.region}::foundation-model/${chatModelId}`,
+        `arn:aws:bedrock:${this.region}::foundation-model/amazon.titan-embed-text-v1`,
         `arn:aws:bedrock:${this.region}:${this.account}:agent-runtime/*`,
         `arn:aws:bedrock:${this.region}:${this.account}:*`,
         webSocketApiArn
       ]
-    }));
+    });
+
+    // get-response-from-bedrock Lambda function
+    const getResponseFromBedrockLambda = new lambda.Function(this, 'kp-get-response-from-bedrock', {
+      runtime: lambda.Runtime.PYTHON_3_12,
+      code: lambda.Code.fromAsset('lambda/get-response-from-bedrock'),
+      handler: 'index.lambda_handler',
+      layers: [sharedLayer],
+      environment: chatEnvironment,
+      timeout: cdk.Duration.seconds(300),
+      memorySize: 256
+    });
+
+    getResponseFromBedrockLambda.addToRolePolicy(chatPolicy);
+    state_bucket.grantReadWrite(getResponseFromBedrockLambda);
 
     // web-socket-handler Lambda function
     const webSocketHandler = new lambda.Function(this, 'kp-web-socket-handler', {
       runtime: lambda.Runtime.PYTHON_3_12,
       code: lambda.Code.fromAsset('lambda/web-socket-handler'),
       handler: 'index.lambda_handler',
+      layers: [sharedLayer],
       environment: {
-        RESPONSE_FUNCTION_ARN: getResponseFromBedrockLambda.functionArn
-      }
+        ...chatEnvironment,
+        RESPONSE_FUNCTION_ARN: getResponseFromBedrockLambda.functionArn,
+        CHAT_MODE: 'async',  // Set to 'async' (invoke get-response-from-bedrock) or 'inline' (answer in this function)
+      },
+      timeout: cdk.Duration.seconds(300),
+      memorySize: 256
     });
 
+    // Needed when CHAT_MODE is 'inline'
+    webSocketHandler.addToRolePolicy(chatPolicy);
+    state_bucket.grantReadWrite(webSocketHandler);
+
     getResponseFromBedrockLambda.grantInvoke(webSocketHandler);
 
     const webSocketIntegration = new apigatewayv2_integrations.WebSocketLambdaIntegration('kp-web-socket-integration', webSocketHandler);
@@ -227,6 +378,13 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
       }
     );
 
+    // Ends the conversation history of sessions keyed on the connection and marks it closed for answers in flight
+    webSocketApi.addRoute('$disconnect',
+      {
+        integration: webSocketIntegration
+      }
+    );
+
     webSocketHandler.addToRolePolicy(new iam.PolicyStatement({
       actions: ['execute-api:ManageConnections'],
       resources: [webSocketApiArn],
@@ -309,6 +467,11 @@ export class KelvynParkChatAssistantStack extends cdk.Stack {
       description: 'Document S3 Bucket Name',
     });
 
+    new cdk.CfnOutput(this, 'StateBucketName', {
+      value: state_bucket.bucketName,
+      description: 'State S3 Bucket Name',
+    });
+
     new cdk.CfnOutput(this, 'KnowledgeBaseId', {
       value: kb.knowledgeBaseId,
       description: 'Bedrock Knowledge Base ID'
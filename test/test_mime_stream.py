@@ -0,0 +1,110 @@
+"""The streaming MIME parser of email-handler against the stdlib parser it replaces.
+
+    python -m unittest discover -s test
+"""
+import email
+import hashlib
+import io
+import os
+import sys
+import unittest
+from email import policy
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'email-handler'))
+
+import mime_stream  # noqa: E402
+
+PDF = b"%PDF-1.7\n" + bytes(range(256)) * 40 + b"\n%%EOF\n"
+
+
+def new_message(subject):
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = 'office@kelvynpark.example'
+    message['To'] = 'assistant@kelvynpark.example'
+    return message
+
+
+def stdlib_attachments(raw):
+    """(file name, content) of the parts process_email picked from msg.walk()."""
+    found = []
+    for part in email.message_from_bytes(raw, policy=policy.default).walk():
+        if part.get_content_maintype() == 'multipart' or part.get('Content-Disposition') is None:
+            continue
+        content = part.get_payload(decode=True)
+        # A forwarded message is walked into, it has no content of its own
+        if part.get_filename() and content is not None:
+            found.append((part.get_filename(), content))
+    return found
+
+
+def stream_attachments(raw, chunk_size=97, spool_bytes=1024):
+    found = []
+    stream = mime_stream.MessageStream(mime_stream.read_chunks(io.BytesIO(raw), chunk_size), spool_bytes=spool_bytes)
+    for attachment in stream.attachments():
+        with attachment:
+            content = attachment.read()
+            assert attachment.size == len(content)
+            assert attachment.sha256 == hashlib.sha256(content).hexdigest()
+            found.append((attachment.file_name, content))
+    return found
+
+
+class MessageStreamTest(unittest.TestCase):
+
+    def assertSameAttachments(self, message, count):
+        # SES stores messages with CRLF line ends
+        for raw in (message.as_bytes(), message.as_bytes(policy=policy.SMTP)):
+            expected = stdlib_attachments(raw)
+            self.assertEqual(len(expected), count)
+            for chunk_size in (1, 97, 1024 * 1024):
+                self.assertEqual(stream_attachments(raw, chunk_size), expected)
+
+    def test_base64(self):
+        message = new_message('Handbook')
+        message.set_content("The handbook is attached.")
+        message.add_attachment(PDF, maintype='application', subtype='pdf', filename='HANDBOOK - Students & Parents.pdf')
+        self.assertSameAttachments(message, 1)
+
+    def test_quoted_printable(self):
+        message = new_message('Notes')
+        message.set_content("See the notes.")
+        text = "Café hours: 7:30 – 8:00 AM, señor.\n" + "A long line that needs a soft line break " * 5 + "\n"
+        message.add_attachment(text, subtype='plain', filename='notes.txt', cte='quoted-printable')
+        self.assertSameAttachments(message, 1)
+
+    def test_nested(self):
+        message = new_message('Pencil It In')
+        message.set_content("Plain body")
+        message.add_alternative("<p>HTML body</p>", subtype='html')
+        message.get_payload()[1].add_related(b"GIF89a" + b"\x00" * 64, maintype='image', subtype='gif',
+                                             cid='<logo>', disposition='inline', filename='logo.gif')
+        message.add_attachment(PDF, maintype='application', subtype='pdf', filename='Pencil It In.pdf')
+        message.add_attachment(PDF[::-1], maintype='application', subtype='pdf', filename='HANDBOOK - Students & Parents.pdf')
+        self.assertSameAttachments(message, 3)
+
+    def test_forwarded(self):
+        inner = new_message('Pencil It In')
+        inner.set_content("This week's newsletter.")
+        inner.add_attachment(PDF, maintype='application', subtype='pdf', filename='Pencil It In inner.pdf')
+        message = new_message('Fwd: Pencil It In')
+        message.set_content("Forwarding the newsletter.")
+        message.add_attachment(PDF[:500], maintype='application', subtype='pdf', filename='HANDBOOK - Students & Parents.pdf')
+        message.add_attachment(inner, filename='Pencil It In.eml')
+        message.add_attachment(b"after the forwarded message", maintype='application', subtype='octet-stream',
+                               filename='trailer.bin')
+        self.assertSameAttachments(message, 3)
+
+    def test_forwarded_without_file_name(self):
+        inner = new_message('Pencil It In')
+        inner.set_content("This week's newsletter.")
+        inner.add_attachment(PDF, maintype='application', subtype='pdf', filename='Pencil It In.pdf')
+        message = new_message('Fwd: Pencil It In')
+        message.set_content("Forwarding the newsletter.")
+        message.add_attachment(inner)
+        self.assertSameAttachments(message, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()